@@ -0,0 +1,500 @@
+import os
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from similarity_index import SimilarItem, SimilarityIndex, _collection_fingerprint_conn, _collection_rows, _normalize
+
+ANN_KINDS = ("ivf", "hnsw")
+IVF_NPROBE = int(os.getenv("LABEL_MAKER_IVF_NPROBE", "16"))
+HNSW_EF = int(os.getenv("LABEL_MAKER_HNSW_EF", "64"))
+
+
+class _ReadWriteLock:
+    """Lets any number of readers in at once, or one writer alone; a waiting writer holds off new readers."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writing = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        with self._cond:
+            self._cond.wait_for(lambda: not self._writing and not self._writers_waiting)
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        with self._cond:
+            self._writers_waiting += 1
+            self._cond.wait_for(lambda: not self._writing and not self._readers)
+            self._writers_waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+
+class _AnnIndex(ABC):
+    """
+    Shared persistence and incremental sync for the ANN indexes.
+
+    An index is saved next to the database, e.g. `issues.gh-issues.ivf.npz` for
+    `issues.db`, together with the `updated` watermark of the newest row it holds.
+    Opening it only adds the rows updated since, and `add` inserts a single row in
+    memory, so `store_embedding` never waits for a rebuild. Deleted rows trigger
+    a full rebuild on the next sync.
+
+    Writes are serialized by the caller, and searches only wait for an HNSW
+    resize: each index publishes the state a query reads in a single
+    assignment, and a rebuild keeps serving the old state until the new one is ready.
+    """
+    kind = ""
+
+    def __init__(self, database: str, collection: str):
+        self.database = database
+        self.collection = collection
+        self.updated = 0
+
+    @property
+    def path(self) -> str:
+        return f"{os.path.splitext(self.database)[0]}.{self.collection}.{self.kind}"
+
+    @classmethod
+    def open(cls, database: str, collection: str) -> "_AnnIndex":
+        """
+        Loads the saved index for a collection, bringing it up to date with the database.
+
+        Args:
+            database (str): The path to the SQLite database file.
+            collection (str): The name of the collection in the database.
+
+        Returns:
+            _AnnIndex: The loaded index.
+        """
+        index = cls(database, collection)
+        try:
+            index.load()
+        except FileNotFoundError:
+            pass
+        except (OSError, KeyError, ValueError, RuntimeError) as e:
+            logging.error(f"Rebuilding unreadable {cls.kind} index for {collection}: {e}")
+            index = cls(database, collection)
+        index.sync()
+        return index
+
+    def sync(self) -> int:
+        """
+        Adds the rows updated since the index was saved, rebuilding it if rows were deleted.
+
+        Returns:
+            int: The number of rows added.
+        """
+        with sqlite3.connect(self.database) as conn:
+            count, updated = _collection_fingerprint_conn(conn, self.collection)
+            if len(self) == count and self.updated == (updated or 0):
+                return 0
+            if len(self) > count or self.needs_rebuild(count):
+                logging.info(f"Rebuilding {self.kind} index for {self.collection}: {len(self)} vectors for {count} rows")
+                ids, matrix, updated = [], [], 0
+                for chunk_ids, chunk, chunk_updated in _collection_rows(conn, self.collection):
+                    ids.extend(chunk_ids)
+                    matrix.append(chunk)
+                    updated = max(updated, chunk_updated)
+                if ids:
+                    self.build(ids, _normalize(np.vstack(matrix)))
+                else:
+                    self.reset()
+                self.updated = updated
+                added = len(ids)
+            else:
+                added = 0
+                for chunk_ids, chunk, chunk_updated in _collection_rows(conn, self.collection, self.updated):
+                    self.add_batch(chunk_ids, _normalize(chunk.copy()))
+                    self.updated = max(self.updated, chunk_updated)
+                    added += len(chunk_ids)
+        if len(self) != count:
+            self.reset()
+            return self.sync()
+        if added:
+            self.save()
+        return added
+
+    def add(self, id: str, vector: Any) -> None:
+        """Adds or replaces a single vector in memory; the next sync persists it."""
+        self.add_batch([str(id)], _normalize(np.array(vector, dtype=np.float32, ndmin=2)))
+
+    def search(self, vector: Any, k: int = 6) -> List[SimilarItem]:
+        """
+        Finds approximately the k most similar vectors to a query vector.
+
+        Args:
+            vector (Any): The query embedding.
+            k (int, optional): The number of results to return. Defaults to 6.
+
+        Returns:
+            List[SimilarItem]: The results with exact cosine scores, most similar first.
+        """
+        return self.search_batch([vector], k)[0]
+
+    def search_batch(self, vectors: Any, k: int = 6) -> List[List[SimilarItem]]:
+        """Finds approximately the k most similar vectors for each of a batch of query vectors."""
+        queries = _normalize(np.array(vectors, dtype=np.float32, ndmin=2))
+        if not len(self) or k <= 0:
+            return [[] for _ in range(len(queries))]
+        return [self.query(query, min(k, len(self))) for query in queries]
+
+    def needs_rebuild(self, count: int) -> bool:
+        return False
+
+    @abstractmethod
+    def __len__(self) -> int:
+        ...
+
+    @abstractmethod
+    def reset(self) -> None:
+        """Empties the index."""
+
+    @abstractmethod
+    def build(self, ids: List[str], matrix: np.ndarray) -> None:
+        """Replaces the whole index with normalized vectors."""
+
+    @abstractmethod
+    def add_batch(self, ids: List[str], matrix: np.ndarray) -> None:
+        """Adds or replaces normalized vectors."""
+
+    @abstractmethod
+    def query(self, query: np.ndarray, k: int) -> List[SimilarItem]:
+        """Finds approximately the k most similar vectors to a normalized query."""
+
+    @abstractmethod
+    def load(self) -> None:
+        """Reads the saved index, raising FileNotFoundError if there is none."""
+
+    @abstractmethod
+    def save(self) -> None:
+        """Writes the index next to the database."""
+
+
+def _kmeans(matrix: np.ndarray, n_clusters: int, iterations: int = 12, seed: int = 0) -> np.ndarray:
+    """Spherical k-means on normalized rows, returning normalized centroids."""
+    rng = np.random.default_rng(seed)
+    centroids = matrix[rng.choice(len(matrix), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(matrix @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, matrix)
+        empty = ~np.any(sums, axis=1)
+        sums[empty] = matrix[rng.choice(len(matrix), int(empty.sum()))]  # reseed empty clusters
+        centroids = _normalize(sums)
+    return centroids
+
+
+class IVFIndex(_AnnIndex):
+    """
+    An inverted-file index in plain numpy.
+
+    Vectors are clustered into about 2 * sqrt(n) lists around k-means centroids.
+    A query scores the centroids, then scans only the `nprobe` closest lists, so
+    the work grows with sqrt(n) rather than n. The index is retrained from
+    scratch once the collection has doubled since the centroids were fitted.
+
+    The centroids and inverted lists are published together as `state` and
+    never mutated; writes copy the lists they change and swap in a new state.
+    """
+    kind = "ivf"
+
+    def __init__(self, database: str, collection: str, nprobe: int = IVF_NPROBE):
+        super().__init__(database, collection)
+        self.nprobe = nprobe
+        self.reset()
+
+    def reset(self) -> None:
+        self.state: Tuple[Optional[np.ndarray], List[Tuple[List[str], np.ndarray]]] = (None, [])
+        self.positions: Dict[str, Tuple[int, int]] = {}
+        self.trained_size = 0
+        self.updated = 0
+
+    @property
+    def centroids(self) -> Optional[np.ndarray]:
+        return self.state[0]
+
+    @property
+    def lists(self) -> List[Tuple[List[str], np.ndarray]]:
+        return self.state[1]
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def needs_rebuild(self, count: int) -> bool:
+        return self.centroids is None or count > 2 * max(self.trained_size, 64)
+
+    def build(self, ids: List[str], matrix: np.ndarray) -> None:
+        n_lists = max(1, min(len(ids), int(2 * np.sqrt(len(ids)))))
+        rng = np.random.default_rng(0)
+        sample = matrix[rng.choice(len(matrix), min(len(matrix), n_lists * 64), replace=False)]
+        centroids = _kmeans(sample, n_lists)
+        lists = [([], np.zeros((0, matrix.shape[1]), dtype=np.float32)) for _ in range(n_lists)]
+        positions: Dict[str, Tuple[int, int]] = {}
+        lists = self._insert(centroids, lists, positions, ids, matrix)
+        self.trained_size = len(ids)
+        self.state, self.positions = (centroids, lists), positions
+
+    def add_batch(self, ids: List[str], matrix: np.ndarray) -> None:
+        centroids, lists = self.state
+        if centroids is None:
+            self.build(ids, matrix)
+            return
+        self.state = (centroids, self._insert(centroids, list(lists), self.positions, ids, matrix))
+
+    @staticmethod
+    def _insert(centroids: np.ndarray, lists: List[Tuple[List[str], np.ndarray]], positions: Dict[str, Tuple[int, int]],
+                ids: List[str], matrix: np.ndarray) -> List[Tuple[List[str], np.ndarray]]:
+        """Adds rows to `lists`, replacing each inverted list they touch with a new one rather than changing it."""
+        assignment = np.argmax(matrix @ centroids.T, axis=1)
+        for id, row, list_number in zip(ids, matrix, assignment):
+            existing = positions.get(id)
+            if existing is not None:
+                old_ids, old_vectors = list(lists[existing[0]][0]), lists[existing[0]][1].copy()
+                # Swap-remove the old entry; the moved id's position changes with it.
+                last = len(old_ids) - 1
+                old_ids[existing[1]], old_vectors[existing[1]] = old_ids[last], old_vectors[last]
+                positions[old_ids[existing[1]]] = existing
+                del old_ids[last]
+                lists[existing[0]] = (old_ids, old_vectors[:last])
+                del positions[id]
+            list_ids, vectors = lists[list_number]
+            lists[list_number] = (list_ids + [id], np.vstack([vectors, row[None, :]]))
+            positions[id] = (int(list_number), len(list_ids))
+        return lists
+
+    def query(self, query: np.ndarray, k: int) -> List[SimilarItem]:
+        centroids, lists = self.state
+        nprobe = min(self.nprobe, len(lists))
+        probes = np.argpartition(-(centroids @ query), nprobe - 1)[:nprobe]
+        ids = [id for probe in probes for id in lists[probe][0]]
+        if not ids:
+            return []
+        scores = np.vstack([lists[probe][1] for probe in probes]) @ query
+        top = np.argsort(-scores)[:k]
+        return [SimilarItem(ids[i], float(scores[i])) for i in top]
+
+    def load(self) -> None:
+        with np.load(f"{self.path}.npz", allow_pickle=False) as data:
+            centroids = data["centroids"]
+            offsets, ids, vectors = data["offsets"], data["ids"].tolist(), data["vectors"]
+            self.trained_size = int(data["trained_size"])
+            self.updated = int(data["updated"])
+        lists = [(ids[start:end], vectors[start:end].copy()) for start, end in zip(offsets[:-1], offsets[1:])]
+        self.positions = {id: (n, i) for n, (list_ids, _) in enumerate(lists) for i, id in enumerate(list_ids)}
+        self.state = (centroids, lists)
+
+    def save(self) -> None:
+        centroids, lists = self.state
+        if centroids is None:
+            return
+        offsets = np.cumsum([0] + [len(list_ids) for list_ids, _ in lists])
+        tmp = f"{self.path}.tmp.npz"
+        np.savez(
+            tmp,
+            centroids=centroids,
+            offsets=offsets,
+            ids=np.asarray([id for list_ids, _ in lists for id in list_ids], dtype=str),
+            vectors=np.vstack([vectors for _, vectors in lists]),
+            trained_size=np.int64(self.trained_size),
+            updated=np.int64(self.updated),
+        )
+        os.replace(tmp, f"{self.path}.npz")
+
+
+class HNSWIndex(_AnnIndex):
+    """
+    A hierarchical navigable small-world graph built with `hnswlib`.
+
+    Queries take roughly log(n) time. hnswlib is optional: constructing this
+    index without it raises ImportError, and get_index falls back to exact search.
+
+    The graph and the ids of its labels are published together as `state`. New
+    ids are appended before their vectors are added to the graph, so every
+    label a query finds already has an id. hnswlib allows queries alongside
+    `add_items` but not alongside `resize_index`, so queries share `_resize_lock`
+    and a resize takes it exclusively.
+    """
+    kind = "hnsw"
+
+    def __init__(self, database: str, collection: str, ef: int = HNSW_EF, m: int = 16, ef_construction: int = 200):
+        try:
+            import hnswlib
+        except ImportError:
+            raise ImportError("HNSWIndex requires hnswlib: pip install hnswlib")
+        super().__init__(database, collection)
+        self._hnswlib = hnswlib
+        self._resize_lock = _ReadWriteLock()
+        self.ef, self.m, self.ef_construction = ef, m, ef_construction
+        self.reset()
+
+    def reset(self) -> None:
+        self.state: Tuple[Any, List[str]] = (None, [])
+        self.labels: Dict[str, int] = {}
+        self.updated = 0
+
+    @property
+    def graph(self) -> Any:
+        return self.state[0]
+
+    @property
+    def ids(self) -> List[str]:
+        return self.state[1]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _new_graph(self, dim: int, capacity: int):
+        graph = self._hnswlib.Index(space="cosine", dim=dim)
+        graph.init_index(max_elements=capacity, ef_construction=self.ef_construction, M=self.m)
+        graph.set_ef(self.ef)
+        return graph
+
+    def build(self, ids: List[str], matrix: np.ndarray) -> None:
+        graph = self._new_graph(matrix.shape[1], max(1024, 2 * len(ids)))
+        self.labels = {id: label for label, id in enumerate(dict.fromkeys(ids))}
+        graph.add_items(matrix, np.asarray([self.labels[id] for id in ids], dtype=np.int64))
+        self.state = (graph, list(self.labels))
+
+    def add_batch(self, ids: List[str], matrix: np.ndarray) -> None:
+        graph, graph_ids = self.state
+        if graph is None:
+            self.build(ids, matrix)
+            return
+        labels = []
+        for id in ids:
+            if id not in self.labels:
+                self.labels[id] = len(graph_ids)
+                graph_ids.append(id)
+            labels.append(self.labels[id])
+        if len(graph_ids) > graph.get_max_elements():
+            with self._resize_lock.write():
+                graph.resize_index(2 * len(graph_ids))
+        # Re-adding an existing label replaces its vector.
+        graph.add_items(matrix, np.asarray(labels, dtype=np.int64))
+
+    def query(self, query: np.ndarray, k: int) -> List[SimilarItem]:
+        graph, ids = self.state
+        with self._resize_lock.read():
+            graph.set_ef(max(self.ef, k))
+            labels, distances = graph.knn_query(query[None, :], k=k)
+        return [SimilarItem(ids[label], float(1 - distance)) for label, distance in zip(labels[0], distances[0])]
+
+    def load(self) -> None:
+        with np.load(f"{self.path}.npz", allow_pickle=False) as data:
+            ids = data["ids"].tolist()
+            dim = int(data["dim"])
+            self.updated = int(data["updated"])
+        self.labels = {id: label for label, id in enumerate(ids)}
+        graph = self._hnswlib.Index(space="cosine", dim=dim)
+        graph.load_index(f"{self.path}.bin", max_elements=max(1024, 2 * len(ids)))
+        graph.set_ef(self.ef)
+        self.state = (graph, ids)
+
+    def save(self) -> None:
+        graph, ids = self.state
+        if graph is None:
+            return
+        graph.save_index(f"{self.path}.bin")
+        tmp = f"{self.path}.tmp.npz"
+        np.savez(tmp, ids=np.asarray(ids, dtype=str), dim=np.int64(graph.dim), updated=np.int64(self.updated))
+        os.replace(tmp, f"{self.path}.npz")
+
+
+ANN_INDEXES = {"ivf": IVFIndex, "hnsw": HNSWIndex}
+
+
+def recall_report(database: str, collection: str, kind: str = "ivf", queries: int = 200, k: int = 6,
+                  noise: float = 0.02, seed: int = 0) -> Dict[str, Any]:
+    """
+    Measures an ANN index against exact search.
+
+    Queries are stored vectors with a little gaussian noise, so each has a known
+    near-duplicate as well as ordinary neighbours.
+
+    Args:
+        database (str): The path to the SQLite database file.
+        collection (str): The name of the collection in the database.
+        kind (str, optional): "ivf" or "hnsw". Defaults to "ivf".
+        queries (int, optional): The number of queries. Defaults to 200.
+        k (int, optional): The number of neighbours compared per query. Defaults to 6.
+        noise (float, optional): The standard deviation of the query noise. Defaults to 0.02.
+        seed (int, optional): The random seed. Defaults to 0.
+
+    Returns:
+        Dict[str, Any]: recall@k, the recall of results above the 0.80 related threshold,
+        and the mean query latency of each index in milliseconds.
+    """
+    exact = SimilarityIndex.from_collection(database, collection)
+    if not len(exact):
+        raise ValueError(f"Collection {collection} is empty")
+    started = time.perf_counter()
+    ann = ANN_INDEXES[kind].open(database, collection)
+    open_seconds = time.perf_counter() - started
+    rng = np.random.default_rng(seed)
+    rows = exact.matrix[rng.choice(len(exact), min(queries, len(exact)), replace=False)]
+    sample = rows + rng.normal(0, noise, rows.shape).astype(np.float32)
+
+    started = time.perf_counter()
+    expected = [exact.search(query, k) for query in sample]
+    exact_ms = (time.perf_counter() - started) / len(sample) * 1000
+    started = time.perf_counter()
+    found = [ann.search(query, k) for query in sample]
+    ann_ms = (time.perf_counter() - started) / len(sample) * 1000
+
+    hits = sum(len({item.id for item in e} & {item.id for item in f}) for e, f in zip(expected, found))
+    related = [(item.id, {item.id for item in f}) for e, f in zip(expected, found) for item in e if item.score > 0.80]
+    return {
+        "kind": kind,
+        "vectors": len(exact),
+        "queries": len(sample),
+        "k": k,
+        "recall": hits / sum(len(e) for e in expected),
+        "related_recall": sum(id in ids for id, ids in related) / len(related) if related else 1.0,
+        "exact_ms": exact_ms,
+        "ann_ms": ann_ms,
+        "open_seconds": open_seconds,
+    }
+
+
+parser = argparse.ArgumentParser(description='Build an approximate nearest-neighbour index and report its recall against exact search.')
+parser.add_argument('--embedding_db', metavar='embedding_db', type=str, help='The database holding the embeddings.', default="github-issues.db")
+parser.add_argument('--collection', metavar='collection', type=str, help='The collection to index.', default="gh-issues")
+parser.add_argument('--kind', metavar='kind', type=str, choices=ANN_KINDS, help='The index type.', default="ivf")
+parser.add_argument('--queries', metavar='queries', type=int, help='The number of queries for the recall report.', default=200)
+parser.add_argument('--k', metavar='k', type=int, help='The number of neighbours compared per query.', default=6)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    logging.basicConfig(filename='/tmp/ai_gh_issues.log', level=logging.INFO)
+    report = recall_report(args.embedding_db, args.collection, args.kind, args.queries, args.k)
+    print(
+        f"{report['kind']}: {report['vectors']} vectors, {report['queries']} queries, "
+        f"recall@{report['k']} {report['recall']:.3f}, related recall {report['related_recall']:.3f}, "
+        f"{report['ann_ms']:.2f} ms/query vs {report['exact_ms']:.2f} ms exact (opened in {report['open_seconds']:.2f}s)"
+    )
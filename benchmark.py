@@ -0,0 +1,563 @@
+import os
+import re
+import json
+import time
+import math
+import base64
+import random
+import shutil
+import struct
+import sqlite3
+import hashlib
+import logging
+import argparse
+import tempfile
+import threading
+import statistics
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from label_prompt import count_tokens
+
+BENCH_EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 768
+
+# Stages timed in each module, in pipeline order. Nested stages are timed separately.
+STAGES = {
+    "label_maker": [
+        "request_labels_list", "shortlist_for_bookmark", "predict_for_bookmark", "pick_labels", "check_if_new_labels_needed",
+        "generate_new_labels", "create_new_labels",
+    ],
+    "github_issues": [
+        "generate_labels", "gh_format_issue_content", "gh_find_similar_issues", "hydrate_issues",
+        "bookmark_to_gh_issues", "save_gh_issue_to_db", "store_embedding", "publish_related",
+    ],
+}
+
+
+def fake_embedding(text: str) -> List[float]:
+    """A deterministic bag-of-words embedding, so near-identical texts score as similar."""
+    vector = [0.0] * EMBEDDING_DIMENSIONS
+    for word in re.findall(r"\w+", text.lower()):
+        digest = hashlib.md5(word.encode()).digest()
+        vector[int.from_bytes(digest[:4], "little") % EMBEDDING_DIMENSIONS] += 1.0 if digest[4] & 1 else -1.0
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
+
+
+class Recorder:
+    """Counts the requests and prompt tokens the fake servers receive."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests: Counter = Counter()
+        self.tokens = 0
+
+    def record(self, service: str, endpoint: str, tokens: int = 0) -> None:
+        with self.lock:
+            self.requests[f"{service} {endpoint}"] += 1
+            self.tokens += tokens
+
+    def snapshot(self) -> Tuple[Counter, int]:
+        with self.lock:
+            return Counter(self.requests), self.tokens
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler, recorder: Recorder, latency: float):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.recorder = recorder
+        self.latency = latency
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self) -> Any:
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"null")
+
+    def send_json(self, status: int, payload: Any = None, headers: Optional[Dict[str, str]] = None) -> None:
+        body = b"" if payload is None else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, method: str) -> None:
+        """Answers a request; the stand-ins override this, and anything they don't serve is a 404."""
+        self.send_json(404, {"message": "Not Found"})
+
+    def dispatch(self, method: str) -> None:
+        time.sleep(self.server.latency)
+        self.handle_request(method)
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_PATCH(self):
+        self.dispatch("PATCH")
+
+
+class FakeGitHub(FakeServer):
+    """Serves the GitHub REST and GraphQL endpoints the pipeline uses, from in-memory state."""
+
+    def __init__(self, recorder: Recorder, latency: float):
+        super().__init__(GitHubHandler, recorder, latency)
+        self.labels: Dict[str, List[Dict[str, Any]]] = {}
+        self.issues: Dict[str, Dict[int, Dict[str, Any]]] = {}
+        self.comments = 0
+
+    def load(self, repo: str, labels: List[Dict[str, Any]], issues: List[Dict[str, Any]]) -> None:
+        with self.lock:
+            self.labels[repo] = labels
+            self.issues[repo] = {issue["number"]: issue for issue in issues}
+
+    def issue(self, repo: str, number: int, title: str, body: str, labels: List[str]) -> Dict[str, Any]:
+        return {
+            "id": 10_000_000 + number, "number": number, "title": title, "body": body,
+            "html_url": f"https://github.com/{repo}/issues/{number}", "state": "open",
+            "user": {"login": "bench"}, "created_at": "2024-03-05T00:00:00Z", "updated_at": "2024-03-05T00:00:00Z",
+            "labels": [{"name": name, "color": "f29513", "default": False, "description": ""} for name in labels],
+        }
+
+
+class GitHubHandler(FakeHandler):
+    def handle_request(self, method: str) -> None:
+        server: FakeGitHub = self.server
+        parsed = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+        if parsed.path == "/graphql":
+            server.recorder.record("github", "POST /graphql")
+            return self.graphql(self.read_json())
+
+        match = re.match(r"^/repos/([^/]+/[^/]+)(/.*)$", parsed.path)
+        if not match:
+            return self.send_json(404, {"message": "Not Found"})
+        repo, rest = match.groups()
+        endpoint = re.sub(r"/\d+", "/{n}", rest)
+        server.recorder.record("github", f"{method} {endpoint}")
+
+        if rest == "/labels" and method == "GET":
+            return self.labels(repo, query)
+        if rest == "/labels" and method == "POST":
+            data = self.read_json()
+            label = {"name": data["name"], "description": data.get("description"), "color": data.get("color"), "default": False}
+            with server.lock:
+                server.labels.setdefault(repo, []).append(label)
+            return self.send_json(201, label)
+        if rest == "/issues" and method == "POST":
+            data = self.read_json()
+            with server.lock:
+                issues = server.issues.setdefault(repo, {})
+                number = max(issues, default=0) + 1
+                issues[number] = server.issue(repo, number, data["title"], data.get("body", ""), data.get("labels", []))
+            return self.send_json(201, issues[number])
+        if rest == "/issues" and method == "GET":
+            issues = sorted(server.issues.get(repo, {}).values(), key=lambda issue: issue["number"])
+            return self.send_page(repo, rest, issues, query)
+        match = re.match(r"^/issues/(\d+)$", rest)
+        if match:
+            issue = server.issues.get(repo, {}).get(int(match.group(1)))
+            if issue is None:
+                return self.send_json(404, {"message": "Not Found"})
+            if method == "PATCH":
+                issue.update({key: value for key, value in self.read_json().items() if key in ("title", "body")})
+            return self.send_json(200, issue)
+        if re.match(r"^/issues/(\d+)/comments$", rest) and method == "POST":
+            self.read_json()
+            with server.lock:
+                server.comments += 1
+                comment_id = server.comments
+            return self.send_json(201, {"id": comment_id})
+        if re.match(r"^/issues/comments/(\d+)$", rest) and method == "PATCH":
+            self.read_json()
+            return self.send_json(200, {"id": int(rest.rsplit("/", 1)[1])})
+        return self.send_json(404, {"message": "Not Found"})
+
+    def send_page(self, repo: str, path: str, items: List[Any], query: Dict[str, str]) -> None:
+        per_page = int(query.get("per_page", 30))
+        page = int(query.get("page", 1))
+        items_page = items[(page - 1) * per_page:page * per_page]
+        etag = '"' + hashlib.md5(json.dumps(items_page, sort_keys=True).encode()).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            return self.send_json(304, headers={"ETag": etag})
+        headers = {"ETag": etag}
+        if page * per_page < len(items):
+            headers["Link"] = f'<{self.server.url}/repos/{repo}{path}?per_page={per_page}&page={page + 1}>; rel="next"'
+        self.send_json(200, items_page, headers)
+
+    def labels(self, repo: str, query: Dict[str, str]) -> None:
+        self.send_page(repo, "/labels", self.server.labels.get(repo, []), query)
+
+    def graphql(self, payload: Dict[str, Any]) -> None:
+        variables = payload.get("variables") or {}
+        repo = f"{variables.get('owner')}/{variables.get('name')}"
+        issues = self.server.issues.get(repo, {})
+        repository = {}
+        for alias, number in re.findall(r"(\w+): issue\(number: (\d+)\)", payload["query"]):
+            issue = issues.get(int(number))
+            repository[alias] = {"number": issue["number"], "title": issue["title"], "body": issue["body"]} if issue else None
+        self.send_json(200, {"data": {"repository": repository}})
+
+
+class FakeOpenAI(FakeServer):
+    """Serves chat completions and embeddings with canned but well-formed answers."""
+
+    def __init__(self, recorder: Recorder, latency: float, new_label_rate: float = 0.0):
+        super().__init__(OpenAIHandler, recorder, latency)
+        self.label_names: List[str] = []
+        self.new_label_rate = new_label_rate
+        self.generated = 0
+
+
+class OpenAIHandler(FakeHandler):
+    def handle_request(self, method: str) -> None:
+        server: FakeOpenAI = self.server
+        path = urlparse(self.path).path
+        request = self.read_json() if method == "POST" else {}
+        if path.endswith("/embeddings"):
+            inputs = request["input"] if isinstance(request["input"], list) else [request["input"]]
+            server.recorder.record("openai", "POST /embeddings", sum(count_tokens(str(text)) for text in inputs))
+            return self.embeddings(request, inputs)
+        if path.endswith("/chat/completions"):
+            prompt = "\n".join(str(message.get("content") or "") for message in request.get("messages", []))
+            tokens = count_tokens(prompt) + (count_tokens(json.dumps(request["tools"])) if request.get("tools") else 0)
+            server.recorder.record("openai", "POST /chat/completions", tokens)
+            return self.chat(request, prompt, tokens)
+        self.send_json(404, {"error": {"message": "Not Found"}})
+
+    def embeddings(self, request: Dict[str, Any], inputs: List[Any]) -> None:
+        data = []
+        for index, text in enumerate(inputs):
+            vector = fake_embedding(str(text))
+            if request.get("encoding_format") == "base64":
+                vector = base64.b64encode(struct.pack(f"<{len(vector)}f", *vector)).decode()
+            data.append({"object": "embedding", "index": index, "embedding": vector})
+        self.send_json(200, {"object": "list", "data": data, "model": request.get("model"), "usage": {"prompt_tokens": 0, "total_tokens": 0}})
+
+    def chat(self, request: Dict[str, Any], prompt: str, tokens: int) -> None:
+        server: FakeOpenAI = self.server
+        message: Dict[str, Any] = {"role": "assistant", "content": None}
+        logprobs = None
+        function = ((request.get("tool_choice") or {}).get("function") or {}).get("name")
+        if function == "assign_labels":
+            picked = [name for name in server.label_names if name in prompt][:6] or server.label_names[:1]
+            message["tool_calls"] = [self.tool_call(function, {"label_names": ",".join(picked)})]
+        elif function == "create_new_label":
+            with server.lock:
+                server.generated += 1
+                name = f"bench-new-{server.generated}"
+            message["tool_calls"] = [self.tool_call(function, {"label-name": name, "label-description": "A generated label.", "gh-repo": ""})]
+        elif request.get("logprobs") and "CANDIDATE 1:" in prompt:
+            # Duplicate adjudication: the fake never calls a benchmark bookmark a duplicate.
+            message["content"] = "0"
+            top = [{"token": "0", "logprob": -0.01, "bytes": None}, {"token": "1", "logprob": -4.6, "bytes": None}]
+            logprobs = {"content": [{"token": "0", "logprob": -0.01, "bytes": None, "top_logprobs": top}]}
+        elif request.get("logprobs"):
+            needed = int(hashlib.md5(prompt.encode()).hexdigest(), 16) % 1000 < server.new_label_rate * 1000
+            answer, other = ("True", "False") if needed else ("False", "True")
+            message["content"] = answer
+            top = [{"token": answer, "logprob": -0.001, "bytes": None}, {"token": other, "logprob": -7.0, "bytes": None}]
+            logprobs = {"content": [{"token": answer, "logprob": -0.001, "bytes": None, "top_logprobs": top}]}
+        else:
+            match = re.search(r"/START_CONTENT:/(.*)/END_CONTENT/", prompt, re.S)
+            message["content"] = match.group(1).strip() if match else "Benchmark title"
+
+        usage = {"prompt_tokens": tokens, "completion_tokens": 1, "total_tokens": tokens + 1}
+        if request.get("stream"):
+            return self.stream(request, message["content"] or "", usage)
+        self.send_json(200, {
+            "id": "chatcmpl-bench", "object": "chat.completion", "created": int(time.time()), "model": request.get("model"),
+            "choices": [{"index": 0, "message": message, "finish_reason": "stop", "logprobs": logprobs}],
+            "usage": usage,
+        })
+
+    @staticmethod
+    def tool_call(name: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
+        return {"id": "call_bench", "type": "function", "function": {"name": name, "arguments": json.dumps(arguments)}}
+
+    def stream(self, request: Dict[str, Any], content: str, usage: Dict[str, int]) -> None:
+        def chunk(delta, finish_reason=None, **extra):
+            payload = {
+                "id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": int(time.time()),
+                "model": request.get("model"), "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}], **extra,
+            }
+            return f"data: {json.dumps(payload)}\n\n"
+
+        body = (chunk({"role": "assistant", "content": content}) + chunk({}, "stop", usage=usage) + "data: [DONE]\n\n").encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def load_source_issues(source_db: str) -> List[Dict[str, Any]]:
+    with sqlite3.connect(source_db) as conn:
+        conn.row_factory = sqlite3.Row
+        return [dict(row) for row in conn.execute("SELECT number, title, body, labels_src FROM github_issues ORDER BY number")]
+
+
+def make_labels(source: List[Dict[str, Any]], count: int, rng: random.Random) -> List[Dict[str, Any]]:
+    """Returns `count` labels: the fixture's real labels, padded with synthetic topics."""
+    labels = {}
+    for issue in source:
+        for label in json.loads(issue["labels_src"] or "[]"):
+            labels.setdefault(label["name"], label.get("description") or "")
+    words = sorted({word for issue in source for word in re.findall(r"[a-z]{5,}", (issue["title"] or "").lower())})
+    while len(labels) < count:
+        topic = "-".join(rng.sample(words, 2))
+        labels.setdefault(topic, f"Content about {topic.replace('-', ' ')}.")
+    return [
+        {"id": i, "node_id": f"LA_{i}", "url": "", "name": name, "color": "f29513", "default": False, "description": description}
+        for i, (name, description) in enumerate(list(labels.items())[:count])
+    ]
+
+
+def build_fixture(source_db: str, path: str, source: List[Dict[str, Any]], issue_count: int) -> List[Dict[str, Any]]:
+    """
+    Builds a fixture issues DB of `issue_count` issues by cycling through the source issues.
+
+    Embeddings are recomputed with the same fake embedding the fake OpenAI server
+    returns, so similarity scores between bookmarks and issues stay meaningful.
+    """
+    import llm
+
+    shutil.copy(source_db, path)
+    issues = []
+    with sqlite3.connect(path) as conn:
+        conn.execute("DELETE FROM embeddings")
+        conn.execute("DELETE FROM github_issues")
+        conn.execute("UPDATE collections SET model = ? WHERE name = 'gh-issues'", (BENCH_EMBEDDING_MODEL,))
+        collection_id = conn.execute("SELECT id FROM collections WHERE name = 'gh-issues'").fetchone()[0]
+        for i in range(issue_count):
+            base = source[i % len(source)]
+            copy = i // len(source)
+            title = base["title"] + (f" (copy {copy})" if copy else "")
+            body = base["body"] or ""
+            issue = {"number": i + 1, "title": title, "body": body}
+            issues.append(issue)
+            content = f"{title} {body}"
+            conn.execute(
+                "INSERT INTO github_issues (number, title, body, labels_src, labels) VALUES (?, ?, ?, ?, ?)",
+                (issue["number"], title, body, base["labels_src"],
+                 json.dumps({label["name"]: True for label in json.loads(base["labels_src"] or "[]")})),
+            )
+            conn.execute(
+                "INSERT INTO embeddings (collection_id, id, embedding, content, content_hash, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                (collection_id, str(issue["number"]), llm.encode(fake_embedding(content)), content,
+                 llm.Collection.content_hash(content), int(time.time())),
+            )
+    return issues
+
+
+def make_bookmarks(source: List[Dict[str, Any]], count: int, rng: random.Random, resave_rate: float) -> List[Dict[str, str]]:
+    """Builds a workload mixing new pages with pages that were already saved."""
+    words = [word for issue in source for word in re.findall(r"\w+", issue["body"] or "")]
+    bookmarks = []
+    for i in range(count):
+        if rng.random() < resave_rate:
+            issue = rng.choice(source)
+            link = re.search(r"\((https?://[^)\s]+)\)", issue["body"] or "")
+            bookmarks.append({
+                "url": link.group(1) if link else f"https://example.com/saved/{issue['number']}",
+                "title": issue["title"], "snippet": (issue["body"] or "")[:400],
+            })
+        else:
+            bookmarks.append({
+                "url": f"https://example.com/bench/{i}",
+                "title": " ".join(rng.sample(words, 6)), "snippet": " ".join(rng.sample(words, 60)),
+            })
+    return bookmarks
+
+
+class StageTimer:
+    """Wraps the pipeline's stage functions to record how long each call takes."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations: Dict[str, List[float]] = defaultdict(list)
+
+    def wrap(self, name: str, func: Callable) -> Callable:
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.durations[name].append(time.perf_counter() - start)
+        return timed
+
+    def install(self, modules: Dict[str, Any]) -> None:
+        for module_name, names in STAGES.items():
+            for name in names:
+                # github_issues imports generate_labels and friends by name, so patch every module holding a reference.
+                original = getattr(modules[module_name], name)
+                timed = self.wrap(name, original)
+                for module in modules.values():
+                    if getattr(module, name, None) is original:
+                        setattr(module, name, timed)
+
+    def take(self) -> Dict[str, float]:
+        with self.lock:
+            totals = {name: sum(values) for name, values in self.durations.items()}
+            self.durations.clear()
+        return totals
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def run_scenario(github_issues, github: FakeGitHub, openai: FakeOpenAI, recorder: Recorder, timer: StageTimer,
+                 labels: List[Dict[str, Any]], fixture: str, issues: List[Dict[str, Any]],
+                 bookmarks: List[Dict[str, str]], max_labels: int, pipeline_args: List[str] = ()) -> Dict[str, Any]:
+    repo = f"bench-{len(labels)}-{len(issues)}/undecidability"
+    github.load(repo, [dict(label) for label in labels], [
+        github.issue(repo, issue["number"], issue["title"], issue["body"], []) for issue in issues
+    ])
+    openai.label_names = [label["name"] for label in labels]
+
+    e2e, stages, round_trips, tokens = [], defaultdict(list), [], []
+    for bookmark in bookmarks:
+        args = github_issues.parser.parse_args([
+            "--url", bookmark["url"], "--title", bookmark["title"], "--snippet", bookmark["snippet"],
+            "--repo", repo, "--embedding_db", fixture, "--no-browser", "--max-labels", str(max_labels), *pipeline_args,
+        ])
+        before_requests, before_tokens = recorder.snapshot()
+        timer.take()
+        start = time.perf_counter()
+        github_issues.main(args)
+        e2e.append(time.perf_counter() - start)
+        for name, duration in timer.take().items():
+            stages[name].append(duration)
+        after_requests, after_tokens = recorder.snapshot()
+        round_trips.append(after_requests - before_requests)
+        tokens.append(after_tokens - before_tokens)
+
+    requests_total = sum(round_trips, Counter())
+    return {
+        "labels": len(labels),
+        "issues": len(issues),
+        "bookmarks": len(bookmarks),
+        "e2e_p50": percentile(e2e, 0.5),
+        "e2e_p95": percentile(e2e, 0.95),
+        "stages_p50": {name: percentile(values, 0.5) for name, values in stages.items()},
+        "round_trips_per_bookmark": {name: count / len(bookmarks) for name, count in sorted(requests_total.items())},
+        "tokens_per_bookmark": statistics.mean(tokens) if tokens else 0,
+    }
+
+
+def print_report(results: List[Dict[str, Any]]) -> None:
+    for result in results:
+        print(f"\n== {result['labels']} labels, {result['issues']} issues, {result['bookmarks']} bookmarks ==")
+        print(f"end-to-end      p50 {result['e2e_p50'] * 1000:8.1f} ms   p95 {result['e2e_p95'] * 1000:8.1f} ms")
+        print(f"tokens sent     {result['tokens_per_bookmark']:8.0f} per bookmark")
+        print("stages (p50 per bookmark):")
+        for name in STAGES["label_maker"] + STAGES["github_issues"]:
+            if name in result["stages_p50"]:
+                print(f"  {name:<28} {result['stages_p50'][name] * 1000:8.1f} ms")
+        print("round trips per bookmark:")
+        for name, count in result["round_trips_per_bookmark"].items():
+            print(f"  {name:<40} {count:6.2f}")
+
+
+def main(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    workdir = tempfile.mkdtemp(prefix="label-maker-bench-")
+    recorder = Recorder()
+    github = FakeGitHub(recorder, args.github_latency)
+    openai = FakeOpenAI(recorder, args.openai_latency, args.new_label_rate)
+
+    # The pipeline modules read these when they are imported, so set them first. Spans and
+    # log lines go to the workdir, not the files the real pipeline appends to.
+    logging.basicConfig(filename=os.path.join(workdir, "bench.log"), level=logging.INFO)
+    os.environ.update({
+        "GITHUB_API_URL": github.url, "GITHUB_TOKEN": "bench",
+        "OPENAI_BASE_URL": f"{openai.url}/v1", "OPENAI_API_KEY": "bench",
+        "LABEL_MAKER_EMBEDDING_MODEL": BENCH_EMBEDDING_MODEL,
+        "LABEL_MAKER_CACHE_DB": os.path.join(workdir, "labels.db"),
+        "LABEL_MAKER_LLM_CACHE_DB": os.path.join(workdir, "llm_cache.db"),
+        "LABEL_MAKER_TRACE_FILE": os.path.join(workdir, "spans.jsonl"),
+    })
+    if not args.llm_cache:
+        os.environ["LABEL_MAKER_NO_LLM_CACHE"] = "1"
+    import github_issues
+    import label_maker
+
+    timer = StageTimer()
+    timer.install({"label_maker": label_maker, "github_issues": github_issues})
+
+    rng = random.Random(args.seed)
+    source = load_source_issues(args.source_db)
+    bookmarks = make_bookmarks(source, args.bookmarks, rng, args.resave_rate)
+    results = []
+    try:
+        for issue_count in args.issues:
+            base_fixture = os.path.join(workdir, f"issues-{issue_count}.db")
+            issues = build_fixture(args.source_db, base_fixture, source, issue_count)
+            for label_count in args.labels:
+                # Each scenario saves its bookmarks, so later scenarios would find them all as duplicates.
+                fixture = os.path.join(workdir, f"issues-{issue_count}-labels-{label_count}.db")
+                shutil.copyfile(base_fixture, fixture)
+                labels = make_labels(source, label_count, rng)
+                results.append(run_scenario(
+                    github_issues, github, openai, recorder, timer, labels, fixture, issues, bookmarks, args.max_labels,
+                    ["--llm-format"] if args.llm_format else [],
+                ))
+    finally:
+        github.shutdown()
+        openai.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(",") if item]
+
+
+parser = argparse.ArgumentParser(description='Benchmark the bookmark pipeline against local GitHub and OpenAI stand-ins.')
+parser.add_argument('--labels', metavar='labels', type=_int_list, help='Comma-separated label catalog sizes.', default=[85, 400, 1600])
+parser.add_argument('--issues', metavar='issues', type=_int_list, help='Comma-separated issue counts.', default=[361, 5000])
+parser.add_argument('--bookmarks', metavar='bookmarks', type=int, help='Bookmarks per scenario.', default=10)
+parser.add_argument('--github-latency', metavar='seconds', type=float, help='Latency injected into each GitHub request.', default=0.05)
+parser.add_argument('--openai-latency', metavar='seconds', type=float, help='Latency injected into each OpenAI request.', default=0.3)
+parser.add_argument('--new-label-rate', metavar='rate', type=float, help='Fraction of bookmarks the fake model says need new labels.', default=0.0)
+parser.add_argument('--resave-rate', metavar='rate', type=float, help='Fraction of bookmarks that re-save an existing issue.', default=0.2)
+parser.add_argument('--max-labels', metavar='max_labels', type=int, help='Label shortlist size passed to the pipeline.', default=40)
+parser.add_argument('--llm-format', action='store_true', help='Have the LLM format issues instead of the local formatter.')
+parser.add_argument('--llm-cache', action='store_true', help='Leave the LLM response cache enabled.')
+parser.add_argument('--source-db', metavar='source_db', type=str, help='The issues DB fixtures are built from.', default="undecidability_gh_issues.db")
+parser.add_argument('--seed', metavar='seed', type=int, help='Random seed for the workload.', default=0)
+parser.add_argument('--json', metavar='path', type=str, help='Also write the results to this JSON file.')
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    results = main(args)
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
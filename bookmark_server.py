@@ -0,0 +1,228 @@
+import os
+import hmac
+import json
+import argparse
+import logging
+import secrets
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from functools import partial
+from typing import Any, Dict, Optional, Sequence
+
+import github_issues
+from duplicate_prefilter import refresh_index
+from job_queue import JOB_QUEUE_DB, JobQueue, WorkerPool
+from label_maker import request_labels_list
+from rate_limit import get_rate_limiter
+from repo_shards import Shard, load_shards
+from similarity_index import get_index
+
+BOOKMARK_FIELDS = ("url", "title", "snippet", "repo", "draft", "llm_format")
+TOKEN_HEADER = "X-Label-Maker-Token"
+SERVER_TOKEN_FILE = os.getenv("LABEL_MAKER_SERVER_TOKEN_FILE", os.path.expanduser("~/.cache/label-maker/server_token"))
+
+
+def load_token(path: str = SERVER_TOKEN_FILE) -> str:
+    """
+    Returns the secret clients must send in the X-Label-Maker-Token header.
+
+    The secret is $LABEL_MAKER_SERVER_TOKEN if set, otherwise the contents of
+    `path`, which is created with a random secret readable only by its owner.
+
+    Args:
+        path (str, optional): The token file. Defaults to $LABEL_MAKER_SERVER_TOKEN_FILE.
+
+    Returns:
+        str: The shared secret.
+    """
+    token = os.getenv("LABEL_MAKER_SERVER_TOKEN")
+    if token:
+        return token
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(secrets.token_urlsafe(32))
+    with open(path) as f:
+        return f.read().strip()
+
+
+def bookmark_args(fields: Dict[str, Any], shards: Sequence[Shard] = ()) -> argparse.Namespace:
+    """
+    Builds the argument namespace `github_issues.main` expects from a request payload.
+
+    Args:
+        fields (Dict[str, Any]): The submitted bookmark fields.
+        shards (Sequence[Shard], optional): The server's repository shards. A bookmark is stored
+            in the shard of its repo, and every shard is searched for related issues. Defaults to ().
+
+    Returns:
+        argparse.Namespace: The CLI defaults overridden by the submitted fields.
+
+    Raises:
+        ValueError: If the bookmark names a repo that isn't one of the shards.
+    """
+    args = github_issues.parser.parse_args([])
+    for name in BOOKMARK_FIELDS:
+        value = fields.get(name)
+        if value is None or value == "":
+            continue
+        if name in ("draft", "llm_format") and isinstance(value, str):
+            value = value.lower() in ("1", "true", "yes")
+        setattr(args, name, value)
+    shard = next((shard for shard in shards if shard.repo == args.repo), None)
+    if shards and shard is None:
+        raise ValueError(f"Unknown repo: {args.repo}")
+    if shard:
+        args.embedding_db, args.collection = shard.database, shard.collection
+    args.shard = [f"{shard.repo}={shard.database}#{shard.collection}" for shard in shards]
+    return args
+
+
+def warm_up(shards: Sequence[Shard]) -> None:
+    """Loads the models, and every shard's label list, similarity index and duplicate prefilter, before the first bookmark arrives."""
+    github_issues.get_embedding_model()
+    github_issues.get_llm_model()
+    for shard in shards:
+        request_labels_list(shard.repo)
+        try:
+            get_index(shard.database, shard.collection)
+        except Exception as e:
+            logging.error(f"Failed to load similarity index of {shard.repo}: {e}")
+        try:
+            refresh_index(shard.database)
+        except Exception as e:
+            logging.error(f"Failed to index {shard.repo} for the duplicate prefilter: {e}")
+
+
+def run_bookmark(fields: Dict[str, Any], shards: Sequence[Shard] = ()) -> Optional[str]:
+    """Runs the bookmark pipeline for one queued capture, returning the new issue's URL."""
+    issue = github_issues.main(bookmark_args(fields, shards))
+    return issue["html_url"] if issue else None
+
+
+class BookmarkHandler(BaseHTTPRequestHandler):
+    """
+    Serves `POST /bookmark` by queueing the capture for the worker pool.
+
+    The response is sent as soon as the capture is committed to the queue; `GET
+    /jobs/<id>` reports its progress, `GET /jobs` the queue size, and `GET
+    /metrics` the queue size with each API's remaining budget and waiting requests.
+
+    Every path but /health needs the shared secret in the X-Label-Maker-Token
+    header, and bookmarks must be posted as JSON. A web page can send neither
+    without a CORS preflight, which this server doesn't answer, so pages open
+    in the browser can't file issues through it.
+    """
+    queue: JobQueue
+    pool: WorkerPool
+    shards: Sequence[Shard]
+    token: str
+
+    def _send_json(self, status: int, payload: Dict[str, Any]) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self) -> bool:
+        if hmac.compare_digest(self.headers.get(TOKEN_HEADER, "").encode(), self.token.encode()):
+            return True
+        self._send_json(401, {"error": f"Missing or wrong {TOKEN_HEADER} header"})
+        return False
+
+    def _read_fields(self) -> Dict[str, Any]:
+        length = int(self.headers.get("Content-Length", 0))
+        fields = json.loads(self.rfile.read(length).decode() or "{}")
+        if not isinstance(fields, dict):
+            raise ValueError("Expected a JSON object")
+        return fields
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif not self._authorized():
+            return
+        elif self.path == "/jobs":
+            self._send_json(200, self.queue.counts())
+        elif self.path == "/metrics":
+            self._send_json(200, {"jobs": self.queue.counts(), "rate_limits": get_rate_limiter().metrics()})
+        elif self.path.startswith("/jobs/") and self.path[len("/jobs/"):].isdigit():
+            job = self.queue.get(int(self.path[len("/jobs/"):]))
+            self._send_json(200 if job else 404, job or {"error": f"Unknown job: {self.path}"})
+        else:
+            self._send_json(404, {"error": f"Unknown path: {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/bookmark":
+            self._send_json(404, {"error": f"Unknown path: {self.path}"})
+            return
+        if not self._authorized():
+            return
+        if self.headers.get("Content-Type", "").split(";")[0].strip() != "application/json":
+            self._send_json(415, {"error": "Bookmarks must be posted as application/json"})
+            return
+        try:
+            fields = self._read_fields()
+            bookmark_args(fields, self.shards)  # reject malformed captures now rather than in a worker
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        fields = {name: fields[name] for name in BOOKMARK_FIELDS if name in fields}
+        job_id, coalesced = self.queue.enqueue(fields)
+        self.pool.notify()
+        self._send_json(202, {"job": job_id, "coalesced": coalesced})
+
+    def log_message(self, format, *args):
+        logging.info("bookmark_server: " + format % args)
+
+
+def serve(host: str, port: int, args: argparse.Namespace) -> None:
+    """
+    Runs the bookmark server and its worker pool until interrupted.
+
+    Captures are queued durably and processed by `args.workers` workers, so a
+    burst of bookmarks never runs more pipelines at once than that, and captures
+    still queued when the server stops are picked up on the next start.
+
+    Args:
+        host (str): The interface to bind, normally localhost.
+        port (int): The port to listen on.
+        args (argparse.Namespace): The default repo and its shards, warmed up before serving, plus the queue settings.
+    """
+    logging.basicConfig(filename='/tmp/ai_gh_issues.log', level=logging.INFO)
+    shards = load_shards(args.shard, Shard(args.repo, args.embedding_db, args.collection))
+    warm_up(shards)
+    BookmarkHandler.shards = shards
+    BookmarkHandler.token = load_token(args.token_file)
+    BookmarkHandler.queue = JobQueue(args.queue_db)
+    BookmarkHandler.pool = WorkerPool(BookmarkHandler.queue, partial(run_bookmark, shards=shards), workers=args.workers)
+    BookmarkHandler.pool.start()
+    server = ThreadingHTTPServer((host, port), BookmarkHandler)
+    logging.info(f"bookmark_server listening on {host}:{port} with {args.workers} workers")
+    print(f"Listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        BookmarkHandler.pool.stop(timeout=5)
+
+
+parser = argparse.ArgumentParser(description='Serve the bookmark pipeline from a warm, long-running process.')
+parser.add_argument('--host', metavar='host', type=str, help='The interface to listen on.', default="127.0.0.1")
+parser.add_argument('--port', metavar='port', type=int, help='The port to listen on.', default=8765)
+parser.add_argument('--repo', metavar='repo', type=str, help='The repo of bookmarks that do not name one.', default="irthomasthomas/undecidability")
+parser.add_argument('--embedding_db', metavar='embedding_db', type=str, help='The database to warm the similarity index for.', default="github-issues.db")
+parser.add_argument('--collection', metavar='collection', type=str, help='The collection to warm the similarity index for.', default="gh-issues")
+parser.add_argument('--shard', metavar='shard', action='append', default=[], help='Another repo, as owner/repo[=database[#collection]]. Bookmarks for it are stored in its shard, and every shard is searched for related issues.')
+parser.add_argument('--workers', metavar='workers', type=int, help='The number of bookmarks processed concurrently.', default=2)
+parser.add_argument('--queue-db', metavar='queue_db', type=str, help='The job queue database.', default=JOB_QUEUE_DB)
+parser.add_argument('--token-file', metavar='token_file', type=str, help='The file holding the secret clients send in the X-Label-Maker-Token header, created if missing.', default=SERVER_TOKEN_FILE)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    serve(args.host, args.port, args)
@@ -0,0 +1,263 @@
+import re
+import sqlite3
+import hashlib
+import logging
+import argparse
+from typing import List, NamedTuple, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+SIMHASH_BITS = 64
+SIMHASH_MAX_DISTANCE = 3
+SIMHASH_MIN_TOKENS = 8
+# With at most 3 differing bits, at least one of the four 16-bit bands matches exactly.
+SIMHASH_BANDS = 4
+
+TRACKING_PARAMS = {"fbclid", "gclid", "dclid", "msclkid", "mc_cid", "mc_eid", "ref", "ref_src", "ref_url", "igshid", "si"}
+
+PREFILTER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS bookmark_urls (
+    url TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    PRIMARY KEY (url, number)
+);
+CREATE TABLE IF NOT EXISTS bookmark_simhashes (
+    number INTEGER PRIMARY KEY,
+    simhash INTEGER NOT NULL,
+    band0 INTEGER, band1 INTEGER, band2 INTEGER, band3 INTEGER,
+    updated_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_bookmark_simhashes_band0 ON bookmark_simhashes (band0);
+CREATE INDEX IF NOT EXISTS idx_bookmark_simhashes_band1 ON bookmark_simhashes (band1);
+CREATE INDEX IF NOT EXISTS idx_bookmark_simhashes_band2 ON bookmark_simhashes (band2);
+CREATE INDEX IF NOT EXISTS idx_bookmark_simhashes_band3 ON bookmark_simhashes (band3);
+"""
+
+_LINK = re.compile(r"""https?://[^\s<>()\[\]"'`]+""")
+_TASK_LINK = re.compile(r"^- \[[ x]\] \[.*?\]\((https?://[^\s)]+)\)")
+# What gh_issue_body and format_issue_content put around the snippet.
+_BODY_LAYOUT = [
+    re.compile(r"\A\s*- \[[ x]\] \[.*?\]\(.*?\)[ \t]*$", re.M),
+    re.compile(r"\A\s*# .*$", re.M),
+    re.compile(r"^\*\*Description:\*\*[ \t]*$", re.M),
+    re.compile(r"^\*\*URL:\*\* \[.*\]\(\S*\)[ \t]*$", re.M),
+    re.compile(r"^[ \t]*(```|~~~).*$", re.M),
+]
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+class DuplicateMatch(NamedTuple):
+    """An existing issue the bookmark duplicates, and why."""
+    number: int
+    reason: str  # "url" or "simhash"
+    distance: int = 0
+
+
+def normalize_url(url: str) -> str:
+    """
+    Reduces a URL to a canonical form so trivially different links compare equal.
+
+    The scheme, `www.`, default ports, fragments, trailing slashes and tracking
+    parameters (utm_*, fbclid, ...) are dropped and the remaining query
+    parameters are sorted.
+
+    Args:
+        url (str): The URL.
+
+    Returns:
+        str: The normalized URL, e.g. "example.com/post?id=1".
+    """
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or "").lower()
+    if host.startswith("www."):
+        host = host[4:]
+    if parts.port and parts.port not in (80, 443):
+        host = f"{host}:{parts.port}"
+    query = sorted(
+        (name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not name.lower().startswith("utm_") and name.lower() not in TRACKING_PARAMS
+    )
+    path = parts.path.rstrip("/")
+    return urlunsplit(("", host, path, urlencode(query), "")).lstrip("/")
+
+
+def bookmark_url(body: str) -> Optional[str]:
+    """
+    Returns the normalized URL an issue was bookmarked from.
+
+    That is the link in the `- [ ] [title](url)` task-list line the pipeline
+    writes, or, for older issues whose body is only a link, that link. Other links
+    in the snippet are ignored, since a page that merely mentions a URL is not a
+    bookmark of it.
+    """
+    body = (body or "").strip()
+    match = _TASK_LINK.match(body)
+    if match:
+        return normalize_url(match.group(1))
+    link = _LINK.match(body)
+    if link and body.split(maxsplit=1)[0] == link.group(0):
+        return normalize_url(link.group(0).rstrip(".,;:!?"))
+    return None
+
+
+def simhash(text: str) -> Optional[int]:
+    """
+    Computes a 64-bit SimHash over the word bigrams of a text.
+
+    Texts that differ by a few words get signatures a few bits apart.
+
+    Args:
+        text (str): The text, typically the title plus the snippet.
+
+    Returns:
+        Optional[int]: The signature, or None if the text is too short to fingerprint reliably.
+    """
+    tokens = _TOKEN.findall((text or "").lower())
+    if len(tokens) < SIMHASH_MIN_TOKENS:
+        return None
+    import numpy as np
+
+    digests = b"".join(
+        hashlib.blake2b(f"{first} {second}".encode(), digest_size=8).digest() for first, second in zip(tokens, tokens[1:])
+    )
+    bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8).reshape(-1, 8), axis=1)
+    votes = 2 * bits.sum(axis=0, dtype=np.int64) - len(bits)
+    return int.from_bytes(np.packbits(votes > 0).tobytes(), "big")
+
+
+def _bands(signature: int) -> List[int]:
+    width = SIMHASH_BITS // SIMHASH_BANDS
+    return [signature >> (band * width) & ((1 << width) - 1) for band in range(SIMHASH_BANDS)]
+
+
+def _to_sqlite(signature: int) -> int:
+    """SQLite integers are signed, so unsigned 64-bit signatures are stored in two's complement."""
+    return signature - (1 << 64) if signature >= 1 << 63 else signature
+
+
+def _issue_text(title: str, body: str) -> str:
+    """
+    The title and snippet of a stored issue, hashed like a bookmark's `title snippet`.
+
+    The task-list link, `# title` heading, "Description:" label, "URL:" line,
+    code fences and suggested labels footer are dropped, so an issue created
+    from a page hashes the same as the page saved again.
+    """
+    body = (body or "").split("#### Suggested labels")[0]
+    for pattern in _BODY_LAYOUT:
+        body = pattern.sub("", body)
+    return f"{title} {body.replace('&lt;', '<')}"
+
+
+def refresh(conn: sqlite3.Connection) -> int:
+    """
+    Indexes the github_issues rows added or updated since the last refresh.
+
+    This runs where issues are written (issue_sync, save_gh_issue_to_db and
+    bookmark_server's warm-up), so find_duplicate only ever reads.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the issues database.
+
+    Returns:
+        int: The number of issues indexed.
+    """
+    conn.executescript(PREFILTER_SCHEMA)
+    rows = conn.execute(
+        """
+        SELECT github_issues.number, github_issues.title, github_issues.body, github_issues.body_url, github_issues.updated_at
+        FROM github_issues LEFT JOIN bookmark_simhashes ON bookmark_simhashes.number = github_issues.number
+        WHERE bookmark_simhashes.number IS NULL
+           OR github_issues.updated_at IS NOT bookmark_simhashes.updated_at
+        """
+    ).fetchall()
+    with conn:
+        for number, title, body, body_url, updated_at in rows:
+            conn.execute("DELETE FROM bookmark_urls WHERE number = ?", (number,))
+            urls = [normalize_url(body_url.split("#")[0])] if body_url else []
+            if bookmark_url(body):
+                urls.append(bookmark_url(body))
+            conn.executemany(
+                "INSERT OR IGNORE INTO bookmark_urls (url, number) VALUES (?, ?)", [(url, number) for url in urls]
+            )
+            signature = simhash(_issue_text(title, body))
+            bands = _bands(signature) if signature is not None else [None] * SIMHASH_BANDS
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO bookmark_simhashes (number, simhash, band0, band1, band2, band3, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (number, _to_sqlite(signature) if signature is not None else 0, *bands, updated_at),
+            )
+    return len(rows)
+
+
+def refresh_index(database: str) -> int:
+    """Indexes the issues of a database added or updated since the last refresh, returning how many."""
+    with sqlite3.connect(database, timeout=30) as conn:
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'github_issues'").fetchone():
+            return 0
+        refreshed = refresh(conn)
+    if refreshed:
+        logging.info(f"refresh_index: indexed {refreshed} issues of {database}")
+    return refreshed
+
+
+def find_duplicate(database: str, url: str, title: str = "", snippet: str = "") -> Optional[DuplicateMatch]:
+    """
+    Looks for an existing issue for a bookmark using only the local database.
+
+    An issue matches if it links to the same normalized URL, or if the SimHash of
+    its title and text is within SIMHASH_MAX_DISTANCE bits of the bookmark's.
+
+    Args:
+        database (str): The path to the issues database.
+        url (str): The bookmark URL.
+        title (str, optional): The page title. Defaults to "".
+        snippet (str, optional): The selected text. Defaults to "".
+
+    Returns:
+        Optional[DuplicateMatch]: The matching issue, or None.
+    """
+    with sqlite3.connect(database, timeout=30) as conn:
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'bookmark_simhashes'").fetchone():
+            logging.info(f"find_duplicate: {database} has not been indexed yet")
+            return None
+
+        if url:
+            row = conn.execute(
+                "SELECT min(number) FROM bookmark_urls WHERE url = ?", (normalize_url(url),)
+            ).fetchone()
+            if row and row[0] is not None:
+                return DuplicateMatch(row[0], "url")
+
+        signature = simhash(f"{title} {snippet}")
+        if signature is None:
+            return None
+        bands = _bands(signature)
+        candidates = conn.execute(
+            f"""
+            SELECT number, simhash FROM bookmark_simhashes
+            WHERE {' OR '.join(f'band{band} = ?' for band in range(SIMHASH_BANDS))}
+            """,
+            bands,
+        ).fetchall()
+    matches = sorted(
+        (bin((stored & (1 << 64) - 1) ^ signature).count("1"), number) for number, stored in candidates
+    )
+    if matches and matches[0][0] <= SIMHASH_MAX_DISTANCE:
+        return DuplicateMatch(matches[0][1], "simhash", matches[0][0])
+    return None
+
+
+parser = argparse.ArgumentParser(description='Check whether a bookmark has already been saved as an issue.')
+parser.add_argument('--url', metavar='url', type=str, help='The url of the bookmark.', default="")
+parser.add_argument('--title', metavar='title', type=str, help='The title of the bookmark.', default="")
+parser.add_argument('--snippet', metavar='snippet', type=str, help='The selected text of the bookmark.', default="")
+parser.add_argument('--embedding_db', metavar='embedding_db', type=str, help='The issues database.', default="github-issues.db")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    refresh_index(args.embedding_db)
+    match = find_duplicate(args.embedding_db, args.url, args.title, args.snippet)
+    print(f"Duplicate of #{match.number} ({match.reason})" if match else "No duplicate found")
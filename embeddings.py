@@ -0,0 +1,12 @@
+import os
+from functools import lru_cache
+
+EMBEDDING_MODEL = os.getenv("LABEL_MAKER_EMBEDDING_MODEL", "jina-embeddings-v2-base-en")
+
+
+@lru_cache(maxsize=None)
+def get_embedding_model(model_id: str = EMBEDDING_MODEL):
+    """Loads an embedding model once per process."""
+    import llm
+
+    return llm.get_embedding_model(model_id)
@@ -0,0 +1,275 @@
+import os
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, Iterator, List, Optional
+
+from rate_limit import GITHUB_MAX_RATE_LIMIT_WAIT, GITHUB_RATE_LIMIT_RETRIES, RateLimiter, get_rate_limiter
+from tracing import record_http
+
+if TYPE_CHECKING:
+    import httpx
+    import requests
+
+GITHUB_API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com")
+
+
+def _default_headers(token: Optional[str]) -> Dict[str, str]:
+    return {
+        "Authorization": f"token {token}",
+        "Accept": "application/vnd.github.v3+json",
+        "Accept-Encoding": "gzip, deflate",
+        "Connection": "keep-alive",
+    }
+
+
+class GitHubClient:
+    """
+    A GitHub REST client that reuses pooled keep-alive connections across calls.
+
+    The underlying `requests.Session` is safe to share between the worker threads
+    used by `map_concurrent`. Every request is scheduled by the rate limiter,
+    which learns the remaining budget from each response's headers.
+    """
+
+    def __init__(self, token: Optional[str] = None, base_url: str = GITHUB_API_URL, pool_size: int = 10, timeout: float = 30,
+                 limiter: Optional[RateLimiter] = None):
+        """
+        Args:
+            token (Optional[str], optional): The GitHub token. Defaults to $GITHUB_TOKEN.
+            base_url (str, optional): The API root. Defaults to $GITHUB_API_URL or api.github.com.
+            pool_size (int, optional): The number of pooled connections. Defaults to 10.
+            timeout (float, optional): The per-request timeout in seconds. Defaults to 30.
+            limiter (Optional[RateLimiter], optional): The request scheduler. Defaults to the process-wide one.
+        """
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.base_url = base_url.rstrip("/")
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.limiter = limiter or get_rate_limiter()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update(_default_headers(token or os.getenv("GITHUB_TOKEN")))
+
+    def url(self, path: str) -> str:
+        """Resolves an API path, leaving absolute URLs such as pagination links untouched."""
+        return path if path.startswith("http") else f"{self.base_url}{path}"
+
+    def request(self, method: str, path: str, data: Any = None, params: Optional[Dict[str, Any]] = None,
+                headers: Optional[Dict[str, str]] = None) -> "requests.Response":
+        """
+        Sends a request with any HTTP verb.
+
+        The request waits for its share of the rate limit, at the priority of the
+        current context. If GitHub throttles it anyway and asks to wait at most
+        GITHUB_MAX_RATE_LIMIT_WAIT seconds, it is retried after the wait.
+
+        Args:
+            method (str): The HTTP method (e.g., "GET", "PATCH").
+            path (str): The API path (e.g., "/repos/owner/repo/labels") or an absolute URL.
+            data (Any, optional): A JSON payload. Defaults to None.
+            params (Optional[Dict[str, Any]], optional): Query parameters. Defaults to None.
+            headers (Optional[Dict[str, str]], optional): Extra request headers. Defaults to None.
+
+        Returns:
+            requests.Response: The response.
+        """
+        for attempt in range(GITHUB_RATE_LIMIT_RETRIES + 1):
+            self.limiter.acquire_github(path)
+            response = self.session.request(
+                method.upper(), self.url(path), json=data, params=params, headers=headers, timeout=self.timeout
+            )
+            record_http(response)
+            wait = self.limiter.observe_github(path, response.status_code, response.headers)
+            if wait is None or wait > GITHUB_MAX_RATE_LIMIT_WAIT:
+                break
+            logging.info(f"GitHub rate limited {method.upper()} {path}, retrying in {wait:.0f}s")
+        return response
+
+    def get(self, path: str, **kwargs) -> "requests.Response":
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, data: Any = None, **kwargs) -> "requests.Response":
+        return self.request("POST", path, data=data, **kwargs)
+
+    def patch(self, path: str, data: Any = None, **kwargs) -> "requests.Response":
+        return self.request("PATCH", path, data=data, **kwargs)
+
+    def put(self, path: str, data: Any = None, **kwargs) -> "requests.Response":
+        return self.request("PUT", path, data=data, **kwargs)
+
+    def delete(self, path: str, **kwargs) -> "requests.Response":
+        return self.request("DELETE", path, **kwargs)
+
+    def graphql(self, query: str, variables: Optional[Dict[str, Any]] = None) -> "requests.Response":
+        """
+        Runs a GraphQL query.
+
+        Args:
+            query (str): The GraphQL query.
+            variables (Optional[Dict[str, Any]], optional): The query variables. Defaults to None.
+
+        Returns:
+            requests.Response: The response; GraphQL errors are reported in its JSON body.
+        """
+        return self.post("/graphql", data={"query": query, "variables": variables or {}})
+
+    def paginate(self, path: str, params: Optional[Dict[str, Any]] = None, per_page: int = 100) -> Iterator[Dict[str, Any]]:
+        """
+        Yields every item of a list endpoint, following the `Link: rel="next"` headers.
+
+        Args:
+            path (str): The API path of the list endpoint.
+            params (Optional[Dict[str, Any]], optional): Query parameters for the first page. Defaults to None.
+            per_page (int, optional): The page size. Defaults to 100, GitHub's maximum.
+
+        Raises:
+            requests.HTTPError: If a page cannot be fetched.
+
+        Yields:
+            Dict[str, Any]: The items of each page, in order.
+        """
+        url: Optional[str] = path
+        params = {"per_page": per_page, **(params or {})}
+        while url:
+            response = self.get(url, params=params)
+            response.raise_for_status()
+            yield from response.json()
+            url = response.links.get("next", {}).get("url")
+            params = None  # the next link already carries the query string
+
+    def map_concurrent(self, func: Callable[[Any], Any], items: Iterable[Any], max_workers: Optional[int] = None) -> List[Any]:
+        """
+        Calls `func` on every item concurrently, bounded by the connection pool size.
+
+        Args:
+            func (Callable[[Any], Any]): The function to call, usually one that makes a request.
+            items (Iterable[Any]): The items to fan out over.
+            max_workers (Optional[int], optional): The concurrency limit. Defaults to the pool size.
+
+        Returns:
+            List[Any]: The results, in the same order as `items`.
+        """
+        items = list(items)
+        if len(items) <= 1:
+            return [func(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(max_workers or self.pool_size, len(items))) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, func, item) for item in items]
+            return [future.result() for future in futures]
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class AsyncGitHubClient:
+    """
+    The asyncio counterpart of GitHubClient, built on a pooled `httpx.AsyncClient`.
+
+    Requests share the rate limiter's budgets with the synchronous client, and
+    wait for them in a worker thread so the event loop keeps running.
+    """
+
+    def __init__(self, token: Optional[str] = None, base_url: str = GITHUB_API_URL, pool_size: int = 10, timeout: float = 30,
+                 limiter: Optional[RateLimiter] = None):
+        try:
+            import httpx
+        except ImportError:
+            raise ImportError("AsyncGitHubClient requires httpx: pip install httpx")
+        self.pool_size = pool_size
+        self.limiter = limiter or get_rate_limiter()
+        self.client = httpx.AsyncClient(
+            base_url=base_url.rstrip("/"),
+            headers=_default_headers(token or os.getenv("GITHUB_TOKEN")),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=timeout,
+        )
+
+    async def request(self, method: str, path: str, data: Any = None, params: Optional[Dict[str, Any]] = None,
+                      headers: Optional[Dict[str, str]] = None) -> "httpx.Response":
+        """Sends a request with any HTTP verb; see GitHubClient.request."""
+        import asyncio
+
+        for attempt in range(GITHUB_RATE_LIMIT_RETRIES + 1):
+            # to_thread copies the context, so the request keeps the caller's priority.
+            await asyncio.to_thread(self.limiter.acquire_github, path)
+            response = await self.client.request(method.upper(), path, json=data, params=params, headers=headers)
+            record_http(response)
+            wait = self.limiter.observe_github(path, response.status_code, response.headers)
+            if wait is None or wait > GITHUB_MAX_RATE_LIMIT_WAIT:
+                break
+            logging.info(f"GitHub rate limited {method.upper()} {path}, retrying in {wait:.0f}s")
+        return response
+
+    async def get(self, path: str, **kwargs) -> "httpx.Response":
+        return await self.request("GET", path, **kwargs)
+
+    async def post(self, path: str, data: Any = None, **kwargs) -> "httpx.Response":
+        return await self.request("POST", path, data=data, **kwargs)
+
+    async def patch(self, path: str, data: Any = None, **kwargs) -> "httpx.Response":
+        return await self.request("PATCH", path, data=data, **kwargs)
+
+    async def put(self, path: str, data: Any = None, **kwargs) -> "httpx.Response":
+        return await self.request("PUT", path, data=data, **kwargs)
+
+    async def delete(self, path: str, **kwargs) -> "httpx.Response":
+        return await self.request("DELETE", path, **kwargs)
+
+    async def graphql(self, query: str, variables: Optional[Dict[str, Any]] = None) -> "httpx.Response":
+        """Runs a GraphQL query; see GitHubClient.graphql."""
+        return await self.post("/graphql", data={"query": query, "variables": variables or {}})
+
+    async def paginate(self, path: str, params: Optional[Dict[str, Any]] = None, per_page: int = 100) -> AsyncIterator[Dict[str, Any]]:
+        """Yields every item of a list endpoint; see GitHubClient.paginate."""
+        url: Optional[str] = path
+        params = {"per_page": per_page, **(params or {})}
+        while url:
+            response = await self.get(url, params=params)
+            response.raise_for_status()
+            for item in response.json():
+                yield item
+            url = response.links.get("next", {}).get("url")
+            params = None
+
+    async def gather(self, awaitables: Iterable[Awaitable[Any]], max_concurrency: Optional[int] = None) -> List[Any]:
+        """
+        Awaits many requests concurrently, at most `max_concurrency` at a time.
+
+        Args:
+            awaitables (Iterable[Awaitable[Any]]): The requests to run.
+            max_concurrency (Optional[int], optional): The concurrency limit. Defaults to the pool size.
+
+        Returns:
+            List[Any]: The results, in the same order as `awaitables`.
+        """
+        import asyncio
+
+        semaphore = asyncio.Semaphore(max_concurrency or self.pool_size)
+
+        async def bounded(awaitable):
+            async with semaphore:
+                return await awaitable
+
+        return await asyncio.gather(*(bounded(awaitable) for awaitable in awaitables))
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+
+_client: Optional[GitHubClient] = None
+_client_lock = threading.Lock()
+
+
+def get_github_client() -> GitHubClient:
+    """Returns the process-wide GitHubClient, creating it on first use."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            logging.info(f"Creating GitHub client for {GITHUB_API_URL}")
+            _client = GitHubClient()
+        return _client
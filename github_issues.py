@@ -4,74 +4,165 @@ import shlex
 import sqlite3
 import subprocess
 import time
-import llm
 import os
 import argparse
 import logging
-import sqlite_utils
-from label_maker import gh_api_request, generate_labels
-from openai import OpenAI
-from typing import Any, Optional, Dict, Union, List, Tuple
+import threading
+from functools import lru_cache
+from itertools import islice
+from duplicate_prefilter import find_duplicate, refresh as refresh_prefilter
+from embeddings import get_embedding_model
+from gh_client import get_github_client
+from label_maker import get_client, gh_api_request, generate_labels, redirect_stdout_to_terminal
+from issue_format import format_issue_content, title_from_url
+from issue_hydration import hydrate_issues
+from issue_sync import embed_issues, setup_tables, upsert_issues
+from label_shortlist import LABEL_SHORTLIST_SIZE
+from llm_cache import cached_chat_completion, cached_prompt
+from pipeline import Stage, run_pipeline
+from related_refresh import RELATED_THRESHOLD, publish_related
+from repo_shards import Shard, load_shards, search_shards, shard_database
+from tracing import current_span, span, traced
+from typing import TYPE_CHECKING, Any, Optional, Dict, Iterable, Iterator, Union, List, Sequence, Tuple
+
+if TYPE_CHECKING:
+    import sqlite_utils
+
+_local = threading.local()
+
+
+@lru_cache(maxsize=None)
+def get_llm_model(model_id: str = "gpt-3.5-turbo"):
+    """Loads a chat model once per process."""
+    import llm
+
+    model = llm.get_model(model_id)
+    model.key = os.getenv("OPENAI_API_KEY")
+    return model
 
-client = OpenAI(
-    api_key=os.environ["OPENAI_API_KEY"],
-)
 
+def get_db(database: str) -> "sqlite_utils.Database":
+    """
+    Returns an open database for the current thread, reusing it across calls.
 
-def logprobs_duplicate_check(title: str, issue_body: str, result_title: str, result_body: str, related: Any) -> None:
+    sqlite3 connections may only be used by the thread that opened them, so the
+    cache is kept per thread.
+    """
+    databases = getattr(_local, "databases", None)
+    if databases is None:
+        databases = _local.databases = {}
+    if database not in databases:
+        import sqlite_utils
+
+        databases[database] = sqlite_utils.Database(database)
+    return databases[database]
+
+
+def logprobs_duplicate_check(title: str, issue_body: str, result_title: str, result_body: str, related: Any, cache: bool = True) -> float:
     """
     Checks if two sets of titles and bodies are likely duplicates using OpenAI's GPT-3.5 Turbo model.
 
+    A single-candidate call to adjudicate_duplicates, which judges several candidates at once.
+
     Args:
         title (str): The title of the first set.
         issue_body (str): The body of the first set.
         result_title (str): The title of the second set.
         result_body (str): The body of the second set.
         related (Any): The related score between the two sets.
+        cache (bool, optional): Whether to answer repeated checks from the LLM response cache. Defaults to True.
 
     Returns:
-        None
+        float: The probability that the two are duplicates.
     """
-    
-    system_message = f"""You are a helpful assistant trained to answer binary questions with True or False.\nNEVER say anything else but True or False."""
+    probabilities = adjudicate_duplicates(title, issue_body, [(related, {"title": result_title, "body": result_body})], cache)
+    return probabilities[str(related.id)]
+
 
-    duplicate_query_prompt = f"""
-        Are these links likely duplicates? True or False.
-        RESULT ONE:
+DUPLICATE_PROBABILITY = float(os.getenv("LABEL_MAKER_DUPLICATE_PROBABILITY", "0.5"))
+COSINE_DUPLICATE_THRESHOLD = 0.94
+MAX_ADJUDICATED_CANDIDATES = 9  # answers must stay single tokens: "0" to "9"
+
+
+def adjudicate_duplicates(title: str, issue_body: str, candidates: List[Tuple[Any, Dict[str, Any]]],
+                          cache: bool = True, max_chars: int = 1200) -> Dict[str, float]:
+    """
+    Estimates, in one LLM round trip, the probability that the bookmark duplicates each candidate.
+
+    The candidates are numbered in a single prompt and the model answers with the
+    number of the duplicate, or 0 for none. The top logprobs of that one-token
+    answer, renormalized over the valid answers, give a probability per candidate.
+    If the call fails or yields no usable answer, the cosine rule is used instead:
+    1.0 above COSINE_DUPLICATE_THRESHOLD, otherwise 0.0.
+
+    Args:
+        title (str): The bookmark title.
+        issue_body (str): The bookmark issue body.
+        candidates (List[Tuple[SimilarItem, Dict[str, Any]]]): Similarity hits with their hydrated issues.
+        cache (bool, optional): Whether to answer repeated checks from the LLM response cache. Defaults to True.
+        max_chars (int, optional): How much of each body is shown to the model. Defaults to 1200.
+
+    Returns:
+        Dict[str, float]: The duplicate probability of each candidate, keyed by issue id.
+    """
+    candidates = sorted(candidates, key=lambda candidate: -candidate[0].score)[:MAX_ADJUDICATED_CANDIDATES]
+    probabilities = {
+        str(related.id): 1.0 if related.score > COSINE_DUPLICATE_THRESHOLD else 0.0 for related, _ in candidates
+    }
+    if not candidates:
+        return probabilities
+
+    listing = "\n\n".join(
+        f"CANDIDATE {number}:\n{entry['title']}\n\n{(entry['body'] or '')[:max_chars]}\n"
+        f"cosine similarity: {round(related.score, 3)}\nEND CANDIDATE {number}"
+        for number, (related, entry) in enumerate(candidates, start=1)
+    )
+    prompt = f"""
+        Is the NEW BOOKMARK a duplicate of one of the saved candidates?
+        NEW BOOKMARK:
         {title}
-                    
-        {issue_body}
-        END RESULT ONE
-                    
-        RESULT TWO:
-        {result_title}
-                    
-        {result_body}
-        END RESULT TWO
-                    
-        cosine similarity: {related.score}
-                    
+
+        {issue_body[:max_chars]}
+        END NEW BOOKMARK
+
+        {listing}
+
         IMPORTANT: The text does not have to be identical to be a duplicate. It is enough if the content is nearly identical.
-        ONLY ANSWER TRUE OR FALSE."""
-    
+        Answer with the number of the duplicate candidate, or 0 if none is a duplicate. ONLY ANSWER WITH A SINGLE NUMBER."""
     messages = [
-        {"role": "system", "content": system_message},
-        {"role": "user", "content": duplicate_query_prompt}
+        {"role": "system", "content": "You are a helpful assistant that identifies duplicate bookmarks. NEVER say anything but a number."},
+        {"role": "user", "content": prompt},
     ]
-    
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo-0125",
-        messages=messages,
-        temperature=0,
-        seed=1234,
-        max_tokens=1,
-        logprobs=True,
-        top_logprobs=2,
-    )
-    
-    top_two_logprobs = response.choices[0].logprobs.content[0].top_logprobs
-    for logprob in top_two_logprobs:
-        logging.info(f"{logprob.token}: {round(exp(logprob.logprob)*100,2)}%")
+    try:
+        response = cached_chat_completion(
+            get_client(),
+            cache=cache,
+            model="gpt-3.5-turbo-0125",
+            messages=messages,
+            temperature=0,
+            seed=1234,
+            max_tokens=1,
+            logprobs=True,
+            top_logprobs=min(20, len(candidates) + 1),
+        )
+        top_logprobs = response.choices[0].logprobs.content[0].top_logprobs
+    except Exception as e:
+        logging.error(f"Duplicate adjudication failed, using cosine similarity: {e}")
+        return probabilities
+
+    answers: Dict[int, float] = {}
+    for logprob in top_logprobs:
+        token = logprob.token.strip()
+        if token.isdigit() and int(token) <= len(candidates):
+            answers[int(token)] = answers.get(int(token), 0.0) + exp(logprob.logprob)
+    total = sum(answers.values())
+    if not total:
+        logging.error(f"Duplicate adjudication gave no usable answer: {[logprob.token for logprob in top_logprobs]}")
+        return probabilities
+    for number, (related, _) in enumerate(candidates, start=1):
+        probabilities[str(related.id)] = answers.get(number, 0.0) / total
+    logging.info(f"Duplicate probabilities: {probabilities} (none: {answers.get(0, 0.0) / total:.3f})")
+    return probabilities
 
 
 def format_md_hidden_note(note, title="Expand for details"):
@@ -87,6 +178,7 @@ def format_md_hidden_note(note, title="Expand for details"):
     return f"<details>\n<summary>{title}</summary>\n\n{note}\n\n</details>"
 
 
+@traced("issue_create")
 def bookmark_to_gh_issues(page_title: str, labels: Dict[str, Any], repo: str, body: str, draft: bool = False) -> Optional[Dict[str, Any]]:
     """
     Creates a GitHub issue based on the provided parameters.
@@ -125,11 +217,40 @@ def gh_format_issue(page_title: str, page_url: str, page_snippet: str, new_label
     Returns:
         tuple: A tuple containing the formatted page title and body.
     """
-    
-    model = llm.get_model("gpt-3.5-turbo")
-    model.key = os.getenv("OPENAI_API_KEY")
+    page_title, page_snippet = gh_format_issue_content(page_title, page_url, page_snippet)
+    return page_title, gh_issue_body(page_title, page_url, page_snippet, new_label_note)
+
+
+@traced("format")
+def gh_format_issue_content(page_title: str, page_url: str, page_snippet: str, cache: bool = True,
+                            llm: bool = False) -> Tuple[str, str]:
+    """
+    Finds a title if one is missing and reformats the snippet into markdown.
+
+    By default this is done locally and deterministically: the title is made from
+    the URL, and the snippet is converted by issue_format. With `llm` the model writes the title and markdown.
+
+    This does not depend on the labels, so it can run while labeling is in progress.
+
+    Args:
+        page_title (str): The title of the page.
+        page_url (str): The URL of the page.
+        page_snippet (str): The snippet of the page content.
+        cache (bool, optional): Whether to answer repeated prompts from the LLM response cache. Defaults to True.
+        llm (bool, optional): Whether to have the LLM format the content. Defaults to False.
+
+    Returns:
+        Tuple[str, str]: The page title and the formatted snippet.
+    """
+    if not llm:
+        current_span().set(formatter="local")
+        page_title = page_title or title_from_url(page_url)
+        return page_title, format_issue_content(page_title, page_url, page_snippet)
+
+    current_span().set(formatter="llm")
+    model = get_llm_model("gpt-3.5-turbo")
     if not page_title:
-        page_title = model.prompt(f"generate a title from this url:{page_url}:quote:{page_snippet}", temperature=0.4).text()
+        page_title = cached_prompt(model, f"generate a title from this url:{page_url}:quote:{page_snippet}", cache=cache, temperature=0.4)
 
     content = f"""TITLE:{page_title}
     DESCRIPTION:{page_snippet}
@@ -146,16 +267,28 @@ def gh_format_issue(page_title: str, page_url: str, page_snippet: str, new_label
     /END_CONTENT/
     """
     
-    page_snippet = model.prompt(description_prompt, temperature=0.1).text()
-    
-    description_prompt = description_prompt.replace("{content}", content)
+    page_snippet = cached_prompt(model, description_prompt, cache=cache, temperature=0.1)
+    return page_title, page_snippet
+
+
+def gh_issue_body(page_title: str, page_url: str, formatted_snippet: str, new_label_note: str = "") -> str:
+    """
+    Assembles the issue body from the formatted content and the new label note.
 
+    Args:
+        page_title (str): The title of the page.
+        page_url (str): The URL of the page.
+        formatted_snippet (str): The snippet as formatted by gh_format_issue_content.
+        new_label_note (str, optional): Additional note for new labels. Defaults to "".
+
+    Returns:
+        str: The issue body.
+    """
     task_list = f"- [ ] [{page_title}]({page_url})"
     
     suggested_labels = f"#### Suggested labels\n#### {new_label_note}"
 
-    body = f"{task_list}\n\n{page_snippet}\n\n{suggested_labels}"
-    return page_title,body
+    return f"{task_list}\n\n{formatted_snippet}\n\n{suggested_labels}"
 
 
 def gh_create_draft_issue(gh_repo: str, issue_title: str, issue_body: str, issue_labels: str) -> None:
@@ -182,7 +315,7 @@ def gh_create_draft_issue(gh_repo: str, issue_title: str, issue_body: str, issue
     return
 
 
-def gh_view_issue(issue_number: int, web: bool = False, pretty_print: bool = False) -> Tuple[str, str]:
+def gh_view_issue(issue_number: int, web: bool = False, pretty_print: bool = False, repo: str = "irthomasthomas/undecidability") -> Tuple[str, str]:
     """
     View a GitHub issue.
 
@@ -190,6 +323,7 @@ def gh_view_issue(issue_number: int, web: bool = False, pretty_print: bool = Fal
         issue_number (int): The number of the issue to view.
         web (bool, optional): Whether to open the issue in a web browser. Defaults to False.
         pretty_print (bool, optional): Whether to pretty print the output. Defaults to False.
+        repo (str, optional): The repository of the issue. Defaults to "irthomasthomas/undecidability".
 
     Returns:
         Tuple[str, str]: A tuple containing the title and body of the issue.
@@ -201,13 +335,14 @@ def gh_view_issue(issue_number: int, web: bool = False, pretty_print: bool = Fal
     logging.info(f"pretty_print: {pretty_print}")
     
     if pretty_print:
+        command = f"gh issue view {issue_number} -R {shlex.quote(repo)}"
         subprocess.run(shlex.split(command)) # pretty print gh output
     elif web:
-        command = f"gh issue view {issue_number} -R 'irthomasthomas/undecidability' --web"
+        command = f"gh issue view {issue_number} -R {shlex.quote(repo)} --web"
         logging.info(f"command: {command}")
         subprocess.run(shlex.split(command))
     else:
-        command = f"gh issue view {issue_number} -R 'irthomasthomas/undecidability' --json body,title"
+        command = f"gh issue view {issue_number} -R {shlex.quote(repo)} --json body,title"
         logging.info(f"command: {command}")
         response = subprocess.run(shlex.split(command), capture_output=True)
         
@@ -248,9 +383,30 @@ def gh_create_issue(gh_repo: str, issue_title: str, issue_body: str, issue_label
         return None
     
 
+def gh_iter_issues(gh_repo: str, state: str = "all", per_page: int = 100) -> Iterator[Dict[str, Any]]:
+    """
+    Streams the issues of a GitHub repository page by page, skipping pull requests.
+
+    Args:
+        gh_repo (str): The name of the GitHub repository.
+        state (str, optional): "open", "closed" or "all". Defaults to "all".
+        per_page (int, optional): The page size. Defaults to 100.
+
+    Raises:
+        requests.HTTPError: If a page cannot be fetched.
+
+    Yields:
+        Dict[str, Any]: Each issue as returned by the GitHub API.
+    """
+    logging.info(f"gh_iter_issues: gh_repo: {gh_repo} state: {state}")
+    for issue in get_github_client().paginate(f"/repos/{gh_repo}/issues", params={"state": state}, per_page=per_page):
+        if "pull_request" not in issue:
+            yield issue
+
+
 def gh_get_all_issues(gh_repo: str) -> Optional[List[Dict[str, Any]]]:
     """
-    Fetches all issues from a GitHub repository.
+    Fetches all open issues from a GitHub repository.
 
     Args:
         gh_repo (str): The name of the GitHub repository.
@@ -259,12 +415,13 @@ def gh_get_all_issues(gh_repo: str) -> Optional[List[Dict[str, Any]]]:
         Optional[List[Dict[str, Any]]]: A list of dictionaries representing the issues,
         or None if the request fails.
     """
+    import requests
+
     logging.info(f"gh_get_all_issues: gh_repo: {gh_repo} ")
-    response = gh_api_request(gh_repo, method="GET", endpoint="/issues")
-    if response.ok:
-        return response.json()
-    else:
-        logging.error(f"Failed to fetch issues: {response.text}")
+    try:
+        return list(gh_iter_issues(gh_repo, state="open"))
+    except requests.HTTPError as e:
+        logging.error(f"Failed to fetch issues: {e.response.text}")
         return None
     
 
@@ -316,6 +473,7 @@ def gh_issue_update(gh_repo: str, issue_number: int, issue_title: str = "", issu
     return response.ok
        
 
+@traced("comment")
 def gh_add_issue_comment(gh_repo: str, issue_number: int, comment: str):
     """
     Add a comment to a GitHub issue.
@@ -353,69 +511,79 @@ def create_embedding_vector(title: str, issue_body: str, issue_number: int, data
         None
     """
     
-    db = sqlite_utils.Database(database)
+    import llm
+
+    db = get_db(database)
     collection_obj = llm.Collection(collection, db, create=True)
     content = f"{title} {issue_body}"
     collection_obj.embed(str(issue_number), content, store=True, metadata={"title": title, "issue_body": issue_body, "issue_number": issue_number})
     return issue_number
 
 
-def save_gh_issue_to_db(issue_id: int, gh_issues_db: str) -> None:
+@traced("db_write_issue")
+def save_gh_issue_to_db(issue_id: int, gh_issues_db: str, issue: Optional[Dict[str, Any]] = None, repo: str = "irthomasthomas/undecidability") -> None:
     """
     Saves a GitHub issue to a SQLite database.
 
     Args:
         issue_id (int): The ID of the GitHub issue to save.
         gh_issues_db (str): The path to the SQLite database file.
+        issue (Optional[Dict[str, Any]], optional): The issue as returned by the GitHub API, fetched if not given. Defaults to None.
+        repo (str, optional): The repository the issue belongs to. Defaults to "irthomasthomas/undecidability".
 
     Returns:
         None
     """
+    if issue is None:
+        response = gh_api_request(repo, method="GET", endpoint=f"/issues/{issue_id}")
+        if not response.ok:
+            logging.error(f"Failed to fetch issue {issue_id}: {response.text}")
+            return
+        issue = response.json()
     try:
-        with sqlite3.connect(":memory:") as conn:
-            conn.enable_load_extension(True)
-            conn.load_extension("/home/thomas/steampipe/steampipe_sqlite_github.so")
-            conn.executescript(f"""
-                ATTACH DATABASE "{gh_issues_db}" AS db2;
-            """)
-
-            cursor = conn.cursor()
-            with open("/home/thomas/GITHUB_TOKEN", 'r') as f:
-                token = f.read()
-                token_json = json.dumps({"token": token})
-            query = """
-                INSERT INTO db2.github_issues
-                    (number, title, body, body_url, author_login, created_at, updated_at, labels_src, labels)
-                SELECT number, title, body, body_url, author_login, created_at, updated_at, labels_src, labels
-                FROM github_issue
-                WHERE repository_full_name = ? AND number = ?;
-            """
-            cursor.execute(query, ('irthomasthomas/undecidability', issue_id))
-            conn.commit()
+        db = get_db(gh_issues_db)
+        setup_tables(db)
+        with db.conn:
+            upsert_issues(db, [issue])
+        refresh_prefilter(db.conn)
     except sqlite3.Error as e:
         logging.error(f"Error occurred in insert_github_issue: {e}")
     
     
-def store_embedding_vectors_for_existing_issues(database: str, collection: str, gh_issues: list) -> None:
+def store_embedding_vectors_for_existing_issues(database: str, collection: str, gh_issues: Iterable[Dict[str, Any]], batch_size: int = 100) -> int:
     """
     Store embedding vectors for existing GitHub issues in a database collection.
-    
+
+    Issues are consumed in batches, so `gh_issues` can be a stream such as
+    `gh_iter_issues(repo)`. Issues whose content hash already matches the stored
+    embedding are skipped, and each batch is committed on its own, so an
+    interrupted backfill resumes by simply running it again.
+
     Args:
         database (str): The path to the SQLite database file.
         collection (str): The name of the collection in the database.
-        gh_issues (list): A list of GitHub issues.
-    
+        gh_issues (Iterable[Dict[str, Any]]): GitHub issues as returned by the API.
+        batch_size (int, optional): The number of issues embedded and committed at a time. Defaults to 100.
+
     Returns:
-        None
+        int: The number of issues embedded.
     """
-    
-    db = sqlite_utils.Database(database)
-    collection_obj = llm.Collection(collection, db, create=False)
-    content = [(str(issue["number"]), f"{issue['title']} {issue['body']}", {"issue": issue}) for issue in gh_issues]
-    collection_obj.embed_multi_with_metadata(content, store=True)
-
-
-def gh_find_similar_issues(title: str, issue_body: str, gh_issues_db: str, collection: str, related_threshold: float = 0.80) -> Tuple[List, Any]:
+    db = get_db(database)
+    issues = iter(gh_issues)
+    seen = embedded = 0
+    while True:
+        batch = list(islice(issues, batch_size))
+        if not batch:
+            break
+        with db.conn:
+            embedded += embed_issues(db, collection, batch, batch_size)
+        seen += len(batch)
+        logging.info(f"store_embedding_vectors_for_existing_issues: {embedded} of {seen} issues embedded")
+    return embedded
+
+
+def gh_find_similar_issues(title: str, issue_body: str, gh_issues_db: str, collection: str, related_threshold: float = 0.80,
+                           index_kind: Optional[str] = None, shards: Optional[Sequence[Shard]] = None) -> Tuple[List, Any]:
     """
     Finds similar issues in a given database collection based on the title and issue body.
 
@@ -425,20 +593,32 @@ def gh_find_similar_issues(title: str, issue_body: str, gh_issues_db: str, colle
         gh_issues_db (str): The path to the SQLite database file containing the GitHub issues.
         collection (str): The name of the collection in the database.
         related_threshold (float, optional): The threshold score for considering issues as related. Defaults to 0.80.
+        index_kind (Optional[str], optional): The index to search: "float32", "int8", "float16", "binary", "ivf" or "hnsw".
+            Compact kinds re-rank exactly, so scores are unchanged. Defaults to $LABEL_MAKER_INDEX_KIND or "float32".
+        shards (Optional[Sequence[Shard]], optional): Repository shards to search concurrently instead of
+            `collection`; the hits are then ShardHits tagged with their repository. Defaults to None.
 
     Returns:
-        Tuple[List[llm.Result], Any]: A tuple containing a list of filtered results and the embedding of the input content.
+        Tuple[List[SimilarItem], Any]: A tuple containing a list of filtered results and the embedding of the input content.
     """
     logging.info(f"gh_find_similar_issues: gh_issues_db: {gh_issues_db} collection: {collection}")
+    from similarity_index import get_index
+
     try:
-        db = sqlite_utils.Database(gh_issues_db)
-        embedding_model = llm.get_embedding_model("jina-embeddings-v2-base-en")
-        collection_obj = llm.Collection(collection, db, create=False)
+        embedding_model = get_embedding_model()
         content = f"{title} {issue_body}"
         
-        embedding = embedding_model.embed(content)
+        with span("embed"):
+            embedding = embedding_model.embed(content)
 
-        results = collection_obj.similar_by_vector(embedding, 6)
+        with span("similarity_search") as search_span:
+            if shards:
+                results = search_shards(embedding, shards, 6, index_kind)
+            else:
+                index = get_index(gh_issues_db, collection, index_kind)
+                results = index.search(embedding, 6)
+                search_span.set(collection_size=len(index))
+            search_span.set(index_kind=index_kind)
         
         filtered_results = [entry for entry in results if entry.score > related_threshold]
     except Exception as e:
@@ -454,6 +634,7 @@ def generate_embedding_for_gh_issues(gh_repo, database):
     return None
 
 
+@traced("db_write_embedding")
 def store_embedding(
     database: str,
     id: str,
@@ -478,8 +659,9 @@ def store_embedding(
     Returns:
         None: This function does not return anything.
     """
-    
-    db = sqlite_utils.Database(database)
+    import llm
+
+    db = get_db(database)
 
     collection_obj = llm.Collection(collection_name, db, create=False)
     content_hash = collection_obj.content_hash(value)
@@ -501,6 +683,10 @@ def store_embedding(
         },
         replace=True,
     )
+    if embedding is not None:
+        from similarity_index import add_to_indexes
+
+        add_to_indexes(database, collection_name, id, embedding)
     return None
 
 
@@ -511,41 +697,78 @@ def issue_exists(issue_number, repository_full_name):
     return response.ok
 
 
-def main(args: argparse.Namespace):
+@traced("bookmark")
+def main(args: argparse.Namespace) -> Optional[Dict[str, Any]]:
+    """
+    Runs the bookmark pipeline: labels, formats, deduplicates and creates the issue.
+
+    Args:
+        args (argparse.Namespace): The parsed bookmark arguments.
+
+    Returns:
+        Optional[Dict[str, Any]]: The created issue, or None if no issue was created.
+    """
     logging.basicConfig(filename='/tmp/ai_gh_issues.log', level=logging.INFO)
     logging.info(f"args:\n{args}")
-    
-    labels_json = generate_labels(args.url, args.title, args.snippet, args.repo)
+    current_span().set(url=args.url, repo=args.repo)
+
+    # An exact or near-exact re-save is caught locally, before any API call is paid for.
+    if args.prefilter:
+        with span("prefilter") as prefilter_span:
+            match = find_duplicate(args.embedding_db, args.url, args.title, args.snippet)
+            prefilter_span.set(duplicate=match.number if match else None)
+        if match:
+            logging.info(f"Duplicate issue found by prefilter: {match.number} ({match.reason}, distance {match.distance})")
+            if args.browser:
+                gh_view_issue(match.number, web=True, repo=args.repo)
+            return None
+    
+    # Labeling and formatting are independent LLM round trips, so they run concurrently.
+    results = run_pipeline([
+        Stage("labels", lambda: generate_labels(args.url, args.title, args.snippet, args.repo, max_labels=args.max_labels,
+                                                database=args.embedding_db if args.predict_labels else None, collection=args.collection)),
+        Stage("content", lambda: gh_format_issue_content(args.title, args.url, args.snippet, llm=args.llm_format)),
+    ])
+    labels_json = results["labels"]
 
     try:
         generated_labels = labels_json['generated_labels']
     except KeyError:
         generated_labels = ""
     logging.info(f"generated_labels: {generated_labels}")
-    page_title, body = gh_format_issue(args.title, args.url, args.snippet, generated_labels)
+    page_title, formatted_snippet = results["content"]
+    body = gh_issue_body(page_title, args.url, formatted_snippet, generated_labels)
     
-    related_issues, embedding = gh_find_similar_issues(page_title, body, args.embedding_db, args.collection)
+    shards = load_shards(args.shard, Shard(args.repo, args.embedding_db, args.collection))
+    related_issues, embedding = gh_find_similar_issues(page_title, body, args.embedding_db, args.collection,
+                                                       index_kind=args.index_kind, shards=shards)
     logging.info(f"related_issues: {len(related_issues)}")
-    related_threshold = 0.80
-    dup_threshold = 0.94
     duplicate=False
+    issue = None
+    related_content = []
     if related_issues:
-        related_issues_md = "### Related content\n"
+        hits_by_repo: Dict[str, List[str]] = {}
         for related in related_issues:
-            if related.score > dup_threshold:
-                duplicate = True            
-                logging.info(f"Duplicate issue found: {related.id}")
-                if issue_exists(related.id, args.repo):
-                    gh_view_issue(related.id, web=True)
-                else:
-                    logging.error(f"Related issue # {related.id} found in local db does not exist in remote.")
-            elif issue_exists(related.id, args.repo) and related.score > related_threshold:
-                entry_title, entry_body = gh_view_issue(related.id)
-                related_issues_md += f"""### #{related.id}: {entry_title}
-<details><summary>### Details</summary>Similarity score: {round(related.score, 2)}\n{entry_body}</details>\n
-"""
+            hits_by_repo.setdefault(related.repo, []).append(related.id)
+        hydrated = {repo: hydrate_issues(repo, ids, shard_database(shards, repo)) for repo, ids in hits_by_repo.items()}
+        found = []
+        for related in related_issues:
+            entry = hydrated[related.repo].get(int(related.id))
+            if entry is None:
+                logging.error(f"Related issue {related.repo}#{related.id} found in local db does not exist in remote.")
             else:
-                logging.error(f"Related issue # {related.id} found in local db does not exist in remote.")
+                found.append((related, entry))
+        # All candidates are judged in a single round trip; the cosine cutoff is only the fallback.
+        # Only the target repository's issues can be duplicates; matches elsewhere are linked as related.
+        duplicate_probabilities = adjudicate_duplicates(page_title, body, [(related, entry) for related, entry in found if related.repo == args.repo])
+        for related, entry in found:
+            if related.repo == args.repo and duplicate_probabilities.get(str(related.id), 0.0) >= DUPLICATE_PROBABILITY:
+                duplicate = True
+                logging.info(f"Duplicate issue found: {related.id}")
+                if args.browser:
+                    gh_view_issue(related.id, web=True, repo=related.repo)
+            elif related.score > RELATED_THRESHOLD:
+                related_content.append((related, entry))
 
     if not duplicate:
         issue = bookmark_to_gh_issues(page_title, labels_json, args.repo, body, args.draft)
@@ -553,13 +776,15 @@ def main(args: argparse.Namespace):
         if issue:
             url = issue['html_url']
             id = issue['number']
-            os.system(f"nyxt {url}")
-            save_gh_issue_to_db(id, args.embedding_db)
-            store_embedding(args.embedding_db, id, "gh-issues", f"{page_title} {body}", {"title": page_title, "body": body}, True, embedding)
-            if related_issues:    
-                gh_add_issue_comment(args.repo, id, related_issues_md)
-    
-    
+            if args.browser:
+                os.system(f"nyxt {url}")
+            save_gh_issue_to_db(id, args.embedding_db, issue, args.repo)
+            store_embedding(args.embedding_db, id, args.collection, f"{page_title} {body}", {"title": page_title, "body": body}, True, embedding)
+            # The neighbour set is recorded even when empty, so related_refresh.py can
+            # later edit the comment in place as new issues arrive.
+            publish_related(args.repo, id, related_content, args.embedding_db, args.collection)
+    return issue
+
 
 parser = argparse.ArgumentParser(description='Generate labels for a given bookmark.')
 parser.add_argument('--url', metavar='url', type=str, help='The url of the bookmark.')
@@ -569,8 +794,16 @@ parser.add_argument('--repo', metavar='repo', type=str, help='The repo to get la
 parser.add_argument('--draft', metavar='draft', type=bool, help='Create a draft issue.', default=False)
 parser.add_argument('--embedding_db', metavar='embedding_db', type=str, help='The database to store embeddings.', default="github-issues.db")
 parser.add_argument('--collection', metavar='collection', type=str, help='The collection to store embeddings.', default="gh-issues")
+parser.add_argument('--shard', metavar='shard', action='append', default=[], help='Another repo to search for related issues, as owner/repo[=database[#collection]]. Repeat for more repos; $LABEL_MAKER_SHARDS adds more.')
+parser.add_argument('--index-kind', metavar='index_kind', type=str, choices=["float32", "int8", "float16", "binary", "ivf", "hnsw"], help='The similarity index: exact float32, compact codes re-ranked exactly, or approximate ivf/hnsw (default: $LABEL_MAKER_INDEX_KIND or float32).')
+parser.add_argument('--no-prefilter', dest='prefilter', action='store_false', help='Skip the local URL and SimHash duplicate check.')
+parser.add_argument('--no-label-prediction', dest='predict_labels', action='store_false', help='Always ask the LLM to pick labels instead of voting them from similar issues.')
+parser.add_argument('--llm-format', action='store_true', help='Have the LLM write the markdown (and a missing title) instead of formatting locally.')
+parser.add_argument('--no-browser', dest='browser', action='store_false', help='Do not open the new or duplicate issue in the browser.')
+parser.add_argument('--max-labels', metavar='max_labels', type=int, help='The number of most similar labels shown to the LLM (0 for all).', default=LABEL_SHORTLIST_SIZE)
 
-args = parser.parse_args()
 
 if __name__ == "__main__":
-    main(args=args)
\ No newline at end of file
+    args = parser.parse_args()
+    redirect_stdout_to_terminal()
+    main(args=args)
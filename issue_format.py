@@ -0,0 +1,150 @@
+import re
+from typing import List
+from urllib.parse import unquote, urlsplit
+
+_BULLET = re.compile(r"^(\s*)[•◦▪▫●○·‣⁃∙–—*+]\s+")
+_NUMBERED = re.compile(r"^(\s*)(\d{1,3})[.)]\s+")
+_FENCE = re.compile(r"^\s*(```|~~~)")
+_PROMPT = re.compile(r"^\s*(\$|>>>|In \[\d+\]:|PS [A-Z]:\\.*>)\s")
+_SHELL = re.compile(r"^\s*(sudo|pip3?|npm|npx|yarn|pnpm|git|curl|wget|docker|kubectl|brew|apt(-get)?|cd|ls|cat|export|make|cargo|go|uv|pipx|conda|python3?|node)\s+\S")
+_PYTHON = re.compile(r"^\s*(def |class |import |from \S+ import |async def |@\w+|print\(|return\b|if __name__)")
+_CODE_PUNCTUATION = re.compile(r"[{}();=<>\[\]]")
+_HTML_TAG = re.compile(r"<(?=[A-Za-z/!])")
+_SLUG_NOISE = re.compile(r"\.(html?|php|aspx?|jsp|md)$|^(index|default)$", re.I)
+
+
+def _code_language(lines: List[str]) -> str:
+    if any(_PYTHON.match(line) or line.lstrip().startswith(">>> ") for line in lines):
+        return "python"
+    if any(_SHELL.match(line) or line.lstrip().startswith("$ ") for line in lines):
+        return "bash"
+    return ""
+
+
+def _looks_like_code(line: str) -> bool:
+    """Guesses whether a line of a plain-text selection was code on the page."""
+    stripped = line.strip()
+    if not stripped or re.fullmatch(r"=+|-+", stripped):
+        return False
+    if _PROMPT.match(line) or _SHELL.match(line) or _PYTHON.match(line):
+        return True
+    if line.startswith(("    ", "\t")):
+        return True
+    # Prose has few brackets and operators; code lines are dense with them and rarely end in a full stop.
+    punctuation = len(_CODE_PUNCTUATION.findall(stripped))
+    return punctuation >= 3 and punctuation / len(stripped) > 0.08 and not stripped.endswith(".")
+
+
+def _prose_line(line: str) -> str:
+    """Converts bullet and number styles to markdown lists and escapes what would otherwise be markup."""
+    bullet = _BULLET.match(line)
+    if bullet:
+        return f"{bullet.group(1)}- {line[bullet.end():]}"
+    numbered = _NUMBERED.match(line)
+    if numbered:
+        return f"{numbered.group(1)}{numbered.group(2)}. {line[numbered.end():]}"
+    if re.match(r"^#{1,6}\s", line):
+        line = "\\" + line  # a "#" starting a sentence is not meant as a heading
+    elif re.fullmatch(r"\s*(=+|-+)\s*", line):
+        line = "\\" + line.strip()  # would turn the previous line into a heading
+    return _HTML_TAG.sub("&lt;", line)
+
+
+def format_snippet(snippet: str) -> str:
+    """
+    Formats a plain-text selection as GitHub flavoured markdown, keeping the wording exact.
+
+    Runs of code-like lines become fenced code blocks, bullet characters and
+    "1)" numbering become markdown lists, quoted (">") lines stay quotes, and
+    text that markdown would misread, such as HTML tags or a leading "#", is
+    escaped. Existing code fences are kept as they are.
+
+    Args:
+        snippet (str): The selected text of the page.
+
+    Returns:
+        str: The snippet as markdown.
+    """
+    lines = [line.rstrip() for line in (snippet or "").replace("\r\n", "\n").replace("\r", "\n").split("\n")]
+    output: List[str] = []
+    code: List[str] = []
+    fenced = False
+
+    def flush_code() -> None:
+        if not code:
+            return
+        while code and not code[-1].strip():
+            code.pop()
+        indent = min((len(line) - len(line.lstrip()) for line in code if line.strip()), default=0)
+        output.extend([f"```{_code_language(code)}", *(line[indent:] for line in code), "```"])
+        code.clear()
+
+    for line in lines:
+        if _FENCE.match(line):
+            flush_code()
+            fenced = not fenced
+            output.append(line.strip())
+        elif fenced:
+            output.append(line)
+        elif _looks_like_code(line) or (code and not line.strip()):
+            code.append(line)
+        else:
+            flush_code()
+            output.append(_prose_line(line))
+    flush_code()
+    if fenced:
+        while output and not output[-1].strip():
+            output.pop()
+        output.append("```")
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(output)).strip()
+
+
+def title_from_url(url: str) -> str:
+    """
+    Makes a title from a URL: its last meaningful path segment and the site name.
+
+    Args:
+        url (str): The page URL.
+
+    Returns:
+        str: e.g. "What is embedded machine learning anyway - docs.edgeimpulse.com",
+        "owner/repo" for GitHub repositories, or just the host.
+    """
+    parts = urlsplit(url or "")
+    host = parts.hostname or ""
+    if host.startswith("www."):
+        host = host[4:]
+    segments = [unquote(segment) for segment in parts.path.split("/") if segment]
+    if host == "github.com" and len(segments) >= 2:
+        return "/".join(segments[:2]) + (f": {segments[-1]}" if len(segments) > 3 else "")
+    for segment in reversed(segments):
+        words = _SLUG_NOISE.sub("", segment)
+        words = re.sub(r"[-_+.]+", " ", words).strip()
+        # Ids, hashes and one-letter route prefixes make poor titles, so fall back to the parent segment.
+        if len(words) > 2 and not re.fullmatch(r"[\d\s]+|[0-9a-f]{8,}", words, re.I):
+            return f"{words[0].upper()}{words[1:]} - {host}" if host else words
+    return host or url
+
+
+def _link_text(text: str) -> str:
+    return text.replace("[", "\\[").replace("]", "\\]")
+
+
+def format_issue_content(page_title: str, page_url: str, page_snippet: str) -> str:
+    """
+    Renders a bookmark in the layout the issues have always had: heading, description and source link.
+
+    Args:
+        page_title (str): The title of the page.
+        page_url (str): The URL of the page.
+        page_snippet (str): The selected text of the page.
+
+    Returns:
+        str: The markdown content placed between the task-list link and the suggested labels.
+    """
+    sections = [f"# {page_title}"]
+    snippet = format_snippet(page_snippet)
+    if snippet:
+        sections.append(f"**Description:**\n{snippet}")
+    sections.append(f"**URL:** [{_link_text(page_title)}]({page_url})")
+    return "\n\n".join(sections)
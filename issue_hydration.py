@@ -0,0 +1,103 @@
+import time
+import logging
+from typing import Any, Dict, Iterable, Optional
+
+from gh_client import get_github_client
+from issue_sync import get_last_sync
+from tracing import current_span, traced
+
+LOCAL_ISSUE_MAX_AGE = 3600
+# Issues fetched per GraphQL query, which keeps each query well under GitHub's node and complexity limits.
+HYDRATION_BATCH_SIZE = 50
+
+
+def local_issues(repo: str, numbers: Iterable[int], database: str, max_age: float = LOCAL_ISSUE_MAX_AGE) -> Dict[int, Dict[str, Any]]:
+    """
+    Reads issues from the local github_issues table if the repo was synced recently enough.
+
+    Args:
+        repo (str): The name of the repository including the owner.
+        numbers (Iterable[int]): The issue numbers to read.
+        database (str): The path to the SQLite database file.
+        max_age (float, optional): How old the last sync may be, in seconds. Defaults to LOCAL_ISSUE_MAX_AGE.
+
+    Returns:
+        Dict[int, Dict[str, Any]]: The issues found locally, keyed by number.
+    """
+    import sqlite_utils
+
+    numbers = list(numbers)
+    db = sqlite_utils.Database(database)
+    if not numbers or "sync_state" not in db.table_names():
+        return {}
+    last_sync = get_last_sync(db, repo)
+    if last_sync is None or time.time() - last_sync > max_age:
+        return {}
+    rows = db.query(
+        f"SELECT number, title, body FROM github_issues WHERE number IN ({','.join('?' * len(numbers))})",
+        numbers,
+    )
+    return {row["number"]: row for row in rows}
+
+
+def remote_issues(repo: str, numbers: Iterable[int]) -> Optional[Dict[int, Dict[str, Any]]]:
+    """
+    Fetches the title and body of several issues in a single GraphQL query.
+
+    Args:
+        repo (str): The name of the repository including the owner.
+        numbers (Iterable[int]): The issue numbers to fetch, at most about HYDRATION_BATCH_SIZE.
+
+    Returns:
+        Optional[Dict[int, Dict[str, Any]]]: The existing issues keyed by number, or None if the query failed.
+    """
+    numbers = list(numbers)
+    if not numbers:
+        return {}
+    owner, name = repo.split("/", 1)
+    fields = "\n".join(f"i{number}: issue(number: {number}) {{ number title body }}" for number in numbers)
+    query = f"query($owner: String!, $name: String!) {{ repository(owner: $owner, name: $name) {{ {fields} }} }}"
+    response = get_github_client().graphql(query, {"owner": owner, "name": name})
+    if not response.ok:
+        logging.error(f"Failed to hydrate issues: {response.text}")
+        return None
+    result = response.json()
+    repository = (result.get("data") or {}).get("repository")
+    if repository is None:
+        logging.error(f"Failed to hydrate issues: {result.get('errors')}")
+        return None
+    # Issues that don't exist come back as null, with a NOT_FOUND error we don't need.
+    return {issue["number"]: issue for issue in repository.values() if issue}
+
+
+@traced("hydration")
+def hydrate_issues(repo: str, numbers: Iterable[Any], database: Optional[str] = None,
+                   max_age: float = LOCAL_ISSUE_MAX_AGE) -> Dict[int, Dict[str, Any]]:
+    """
+    Looks up the title and body of candidate issues, dropping those that no longer exist.
+
+    Issues are read from the local table when it was synced within `max_age`
+    seconds, and the remaining issues are fetched with one GraphQL query per
+    HYDRATION_BATCH_SIZE issues.
+
+    Args:
+        repo (str): The name of the repository including the owner.
+        numbers (Iterable[Any]): The issue numbers, as ints or numeric strings.
+        database (Optional[str], optional): The path to the SQLite database file. Defaults to None.
+        max_age (float, optional): How old the last local sync may be, in seconds. Defaults to LOCAL_ISSUE_MAX_AGE.
+
+    Returns:
+        Dict[int, Dict[str, Any]]: The existing issues keyed by number, each with number, title and body.
+    """
+    numbers = list(dict.fromkeys(int(number) for number in numbers))
+    issues = local_issues(repo, numbers, database, max_age) if database else {}
+    current_span().set(candidates=len(numbers), local_hits=len(issues))
+    missing = [number for number in numbers if number not in issues]
+    for start in range(0, len(missing), HYDRATION_BATCH_SIZE):
+        batch = missing[start:start + HYDRATION_BATCH_SIZE]
+        remote = remote_issues(repo, batch)
+        if remote is None and database:
+            # Stale local rows are better than nothing when GitHub is unreachable.
+            remote = local_issues(repo, batch, database, max_age=float("inf"))
+        issues.update(remote or {})
+    return issues
@@ -0,0 +1,223 @@
+import json
+import time
+import logging
+import argparse
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional
+
+from duplicate_prefilter import refresh as refresh_prefilter
+from embeddings import EMBEDDING_MODEL
+from gh_client import get_github_client
+from rate_limit import BULK, request_priority
+
+if TYPE_CHECKING:
+    import sqlite_utils
+
+GITHUB_ISSUES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS github_issues (
+    number INTEGER PRIMARY KEY,
+    title TEXT,
+    body TEXT,
+    body_url TEXT,
+    author_login TEXT,
+    created_at TIMESTAMP WITH TIME ZONE,
+    updated_at TIMESTAMP WITH TIME ZONE,
+    labels_src JSONB,
+    labels JSONB
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    repo TEXT PRIMARY KEY,
+    last_updated_at TEXT,
+    synced_at REAL
+);
+"""
+
+
+def _timestamp(value: Optional[str]) -> Optional[str]:
+    """Converts GitHub's ISO 8601 timestamps to the format already stored in github_issues."""
+    return value.replace("T", " ").rstrip("Z") if value else value
+
+
+def issue_row(issue: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Converts a GitHub REST issue into a github_issues row.
+
+    Args:
+        issue (Dict[str, Any]): The issue as returned by the GitHub API.
+
+    Returns:
+        Dict[str, Any]: The row, in the same shape steampipe used to write.
+    """
+    labels = issue.get("labels") or []
+    return {
+        "number": issue["number"],
+        "title": issue["title"],
+        "body": issue.get("body") or "",
+        "body_url": f"{issue['html_url']}#issue-{issue['id']}",
+        "author_login": (issue.get("user") or {}).get("login"),
+        "created_at": _timestamp(issue.get("created_at")),
+        "updated_at": _timestamp(issue.get("updated_at")),
+        "labels_src": json.dumps([
+            {
+                "node_id": label.get("node_id"),
+                "name": label["name"],
+                "description": label.get("description"),
+                "is_default": label.get("default", False),
+                "color": label.get("color"),
+            }
+            for label in labels
+        ], separators=(",", ":")),
+        "labels": json.dumps({label["name"]: True for label in labels}, separators=(",", ":")),
+    }
+
+
+def issue_content(issue: Dict[str, Any]) -> str:
+    """The text an issue is embedded as."""
+    return f"{issue['title']} {issue.get('body') or ''}"
+
+
+def setup_tables(db: "sqlite_utils.Database") -> None:
+    db.conn.executescript(GITHUB_ISSUES_SCHEMA)
+
+
+def upsert_issues(db: "sqlite_utils.Database", issues: Iterable[Dict[str, Any]]) -> int:
+    """
+    Inserts or updates GitHub issues in the github_issues table.
+
+    Args:
+        db (sqlite_utils.Database): The issues database.
+        issues (Iterable[Dict[str, Any]]): Issues as returned by the GitHub API.
+
+    Returns:
+        int: The number of rows written.
+    """
+    rows = [issue_row(issue) for issue in issues]
+    if rows:
+        db["github_issues"].upsert_all(rows, pk="number")
+    return len(rows)
+
+
+def embed_issues(db: "sqlite_utils.Database", collection: str, issues: List[Dict[str, Any]], batch_size: int = 100) -> int:
+    """
+    Embeds the issues whose content changed since they were last embedded.
+
+    Args:
+        db (sqlite_utils.Database): The database holding the embeddings collection.
+        collection (str): The name of the collection.
+        issues (List[Dict[str, Any]]): Issues as returned by the GitHub API.
+        batch_size (int, optional): The number of issues embedded per model call. Defaults to 100.
+
+    Returns:
+        int: The number of issues embedded.
+    """
+    if not issues:
+        return 0
+    import llm
+
+    collection_obj = llm.Collection(collection, db, model_id=EMBEDDING_MODEL)
+    ids = [str(issue["number"]) for issue in issues]
+    existing = {
+        row["id"]: row["content_hash"]
+        for row in db.query(
+            f"SELECT id, content_hash FROM embeddings WHERE collection_id = ? AND id IN ({','.join('?' * len(ids))})",
+            [collection_obj.id, *ids],
+        )
+    }
+    changed = [
+        (str(issue["number"]), issue_content(issue), {"title": issue["title"], "issue_number": issue["number"]})
+        for issue in issues
+        if existing.get(str(issue["number"])) != collection_obj.content_hash(issue_content(issue))
+    ]
+    if changed:
+        collection_obj.embed_multi_with_metadata(changed, store=True, batch_size=batch_size)
+    return len(changed)
+
+
+def get_watermark(db: "sqlite_utils.Database", repo: str) -> Optional[str]:
+    row = db.execute("SELECT last_updated_at FROM sync_state WHERE repo = ?", [repo]).fetchone()
+    return row[0] if row else None
+
+
+def get_last_sync(db: "sqlite_utils.Database", repo: str) -> Optional[float]:
+    """Returns when the repo was last synced, as a unix timestamp."""
+    row = db.execute("SELECT synced_at FROM sync_state WHERE repo = ?", [repo]).fetchone()
+    return row[0] if row else None
+
+
+def _flush(db: "sqlite_utils.Database", repo: str, collection: Optional[str], batch: List[Dict[str, Any]]) -> int:
+    watermark = max(issue["updated_at"] for issue in batch)
+    watermark = max(watermark, get_watermark(db, repo) or watermark)
+    with db.conn:
+        upsert_issues(db, batch)
+    refresh_prefilter(db.conn)
+    # The watermark only moves once the batch is embedded, so issues whose embedding
+    # failed are fetched again by the next sync instead of being skipped for good.
+    embedded = embed_issues(db, collection, batch) if collection else 0
+    with db.conn:
+        db.execute(
+            "INSERT OR REPLACE INTO sync_state (repo, last_updated_at, synced_at) VALUES (?, ?, ?)",
+            [repo, watermark, time.time()],
+        )
+    return embedded
+
+
+@request_priority(BULK)
+def sync_issues(repo: str, database: str, collection: Optional[str] = "gh-issues", full: bool = False, batch_size: int = 100) -> int:
+    """
+    Brings the github_issues table up to date with GitHub.
+
+    Only issues updated since the stored watermark are requested, oldest first.
+    Each page is upserted, its changed issues are re-embedded into
+    `collection`, and only then is the watermark moved past it, so an
+    interrupted sync resumes where it stopped without leaving issues unembedded.
+
+    Args:
+        repo (str): The name of the repository including the owner.
+        database (str): The path to the SQLite database file.
+        collection (Optional[str], optional): The embeddings collection to keep in sync, None to skip. Defaults to "gh-issues".
+        full (bool, optional): Ignore the watermark and resync every issue. Defaults to False.
+        batch_size (int, optional): The number of issues per transaction. Defaults to 100.
+
+    Returns:
+        int: The number of issues synced.
+    """
+    import sqlite_utils
+
+    db = sqlite_utils.Database(database)
+    setup_tables(db)
+    params = {"state": "all", "sort": "updated", "direction": "asc"}
+    watermark = None if full else get_watermark(db, repo)
+    if watermark:
+        params["since"] = watermark
+    logging.info(f"sync_issues: repo: {repo} since: {watermark}")
+
+    synced = embedded = 0
+    batch = []
+    for issue in get_github_client().paginate(f"/repos/{repo}/issues", params=params, per_page=batch_size):
+        if "pull_request" in issue:
+            continue
+        batch.append(issue)
+        if len(batch) >= batch_size:
+            embedded += _flush(db, repo, collection, batch)
+            synced += len(batch)
+            batch = []
+    if batch:
+        embedded += _flush(db, repo, collection, batch)
+        synced += len(batch)
+    elif not synced:
+        with db.conn:
+            db.execute("UPDATE sync_state SET synced_at = ? WHERE repo = ?", [time.time(), repo])
+    logging.info(f"sync_issues: synced {synced} issues, re-embedded {embedded}")
+    return synced
+
+
+parser = argparse.ArgumentParser(description='Sync GitHub issues into the local SQLite database.')
+parser.add_argument('--repo', metavar='repo', type=str, help='The repo to sync.', default="irthomasthomas/undecidability")
+parser.add_argument('--embedding_db', metavar='embedding_db', type=str, help='The database to sync into.', default="github-issues.db")
+parser.add_argument('--collection', metavar='collection', type=str, help='The collection to re-embed changed issues into.', default="gh-issues")
+parser.add_argument('--full', action='store_true', help='Resync every issue instead of only those updated since the last sync.')
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    logging.basicConfig(filename='/tmp/ai_gh_issues.log', level=logging.INFO)
+    print(f"Synced {sync_issues(args.repo, args.embedding_db, args.collection, args.full)} issues")
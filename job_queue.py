@@ -0,0 +1,365 @@
+import os
+import json
+import time
+import uuid
+import random
+import socket
+import sqlite3
+import logging
+import argparse
+import threading
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from duplicate_prefilter import normalize_url
+
+JOB_QUEUE_DB = os.getenv("LABEL_MAKER_QUEUE_DB", os.path.expanduser("~/.cache/label-maker/jobs.db"))
+
+JOB_QUEUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    url_key TEXT,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_run_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    locked_at REAL,
+    locked_by TEXT,
+    error TEXT,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status_next_run_at ON jobs (status, next_run_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_url_key ON jobs (url_key, created_at);
+"""
+
+
+class Job(NamedTuple):
+    id: int
+    payload: Dict[str, Any]
+    attempts: int
+
+
+class JobQueue:
+    """
+    A durable SQLite queue of bookmark captures.
+
+    A capture is committed before `enqueue` returns, so nothing is lost if the
+    process dies. Captures of the same normalized URL within `coalesce_window`
+    seconds of a pending job are merged into it, with the newer fields winning.
+    Failed jobs are retried with exponential backoff up to `max_attempts` times.
+    A running job is locked by the worker that claimed it, which renews the lock
+    with `heartbeat` while the job runs; jobs whose lock hasn't been renewed for
+    `stale_after` seconds, because their worker crashed, are requeued.
+    """
+
+    def __init__(self, database: str = JOB_QUEUE_DB, coalesce_window: float = 300, max_attempts: int = 5,
+                 backoff: float = 30, stale_after: float = 900):
+        """
+        Args:
+            database (str, optional): The path to the queue database. Defaults to JOB_QUEUE_DB.
+            coalesce_window (float, optional): Seconds within which captures of one URL are merged. Defaults to 300.
+            max_attempts (int, optional): Attempts before a job is marked failed. Defaults to 5.
+            backoff (float, optional): The first retry delay in seconds, doubled on every attempt. Defaults to 30.
+            stale_after (float, optional): Seconds without a heartbeat after which a running job is presumed abandoned. Defaults to 900.
+        """
+        self.database = database
+        self.coalesce_window = coalesce_window
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.stale_after = stale_after
+        self._initialized = False
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.database != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(self.database)), exist_ok=True)
+        # Autocommit mode, so each operation can take the write lock up front with BEGIN IMMEDIATE.
+        conn = sqlite3.connect(self.database, timeout=30, isolation_level=None)
+        if not self._initialized:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(JOB_QUEUE_SCHEMA)
+            if "locked_by" not in {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}:
+                conn.execute("ALTER TABLE jobs ADD COLUMN locked_by TEXT")
+            self._initialized = True
+        return conn
+
+    def _transaction(self, func: Callable[[sqlite3.Connection], Any]) -> Any:
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(conn)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return result
+        finally:
+            conn.close()
+
+    def enqueue(self, payload: Dict[str, Any]) -> Tuple[int, bool]:
+        """
+        Adds a capture to the queue, or merges it into a pending job for the same URL.
+
+        Args:
+            payload (Dict[str, Any]): The bookmark fields (url, title, snippet, ...).
+
+        Returns:
+            Tuple[int, bool]: The job id, and whether the capture was merged into an existing job.
+        """
+        url_key = normalize_url(payload["url"]) if payload.get("url") else None
+
+        def enqueue(conn: sqlite3.Connection) -> Tuple[int, bool]:
+            now = time.time()
+            if url_key:
+                row = conn.execute(
+                    """
+                    SELECT id, payload FROM jobs
+                    WHERE url_key = ? AND status = 'queued' AND created_at >= ?
+                    ORDER BY id DESC LIMIT 1
+                    """,
+                    (url_key, now - self.coalesce_window),
+                ).fetchone()
+                if row:
+                    merged = {**json.loads(row[1]), **{key: value for key, value in payload.items() if value not in (None, "")}}
+                    conn.execute("UPDATE jobs SET payload = ?, updated_at = ? WHERE id = ?", (json.dumps(merged), now, row[0]))
+                    return row[0], True
+            cursor = conn.execute(
+                "INSERT INTO jobs (url_key, payload, next_run_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (url_key, json.dumps(payload), now, now, now),
+            )
+            return cursor.lastrowid, False
+
+        return self._transaction(enqueue)
+
+    def claim(self, worker: str) -> Optional[Job]:
+        """Takes the oldest job that is due, locking it for `worker`, or returns None if there is none."""
+        def claim(conn: sqlite3.Connection) -> Optional[Job]:
+            now = time.time()
+            row = conn.execute(
+                "SELECT id, payload, attempts FROM jobs WHERE status = 'queued' AND next_run_at <= ? ORDER BY next_run_at, id LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_at = ?, locked_by = ?, updated_at = ? WHERE id = ?",
+                (now, worker, now, row[0]),
+            )
+            return Job(row[0], json.loads(row[1]), row[2] + 1)
+
+        return self._transaction(claim)
+
+    def heartbeat(self, job_ids: List[int], worker: str) -> int:
+        """Renews `worker`'s locks on running jobs, returning how many it still holds."""
+        if not job_ids:
+            return 0
+
+        def heartbeat(conn: sqlite3.Connection) -> int:
+            return conn.execute(
+                f"UPDATE jobs SET locked_at = ? WHERE status = 'running' AND locked_by = ? AND id IN ({','.join('?' * len(job_ids))})",
+                (time.time(), worker, *job_ids),
+            ).rowcount
+
+        return self._transaction(heartbeat)
+
+    def complete(self, job_id: int, worker: str, result: Any = None) -> bool:
+        """
+        Records a job's result, if `worker` still holds its lock.
+
+        Returns:
+            bool: False if the lock was lost, e.g. because the job was requeued as stale.
+        """
+        def complete(conn: sqlite3.Connection) -> bool:
+            return conn.execute(
+                """
+                UPDATE jobs SET status = 'done', result = ?, error = NULL, locked_at = NULL, locked_by = NULL, updated_at = ?
+                WHERE id = ? AND status = 'running' AND locked_by = ?
+                """,
+                (json.dumps(result), time.time(), job_id, worker),
+            ).rowcount > 0
+
+        return self._transaction(complete)
+
+    def fail(self, job_id: int, worker: str, error: str) -> Optional[bool]:
+        """
+        Records a failed attempt, scheduling a retry if attempts remain and `worker` still holds the job's lock.
+
+        Returns:
+            Optional[bool]: True if the job will be retried, False if it is now marked failed, and None if the lock was lost.
+        """
+        def fail(conn: sqlite3.Connection) -> Optional[bool]:
+            now = time.time()
+            row = conn.execute(
+                "SELECT attempts FROM jobs WHERE id = ? AND status = 'running' AND locked_by = ?", (job_id, worker)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[0] >= self.max_attempts:
+                conn.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, locked_at = NULL, locked_by = NULL, updated_at = ? WHERE id = ?",
+                    (error, now, job_id),
+                )
+                return False
+            delay = self.backoff * 2 ** (row[0] - 1) * random.uniform(0.8, 1.2)
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', error = ?, next_run_at = ?, locked_at = NULL, locked_by = NULL, updated_at = ? WHERE id = ?",
+                (error, now + delay, now, job_id),
+            )
+            return True
+
+        return self._transaction(fail)
+
+    def requeue_stale(self) -> int:
+        """Requeues running jobs whose lock hasn't been renewed for `stale_after` seconds, returning how many."""
+        def requeue(conn: sqlite3.Connection) -> int:
+            now = time.time()
+            return conn.execute(
+                """
+                UPDATE jobs SET status = 'queued', next_run_at = ?, locked_at = NULL, locked_by = NULL, updated_at = ?
+                WHERE status = 'running' AND locked_at < ?
+                """,
+                (now, now, now - self.stale_after),
+            ).rowcount
+
+        return self._transaction(requeue)
+
+    def get(self, job_id: int) -> Optional[Dict[str, Any]]:
+        """Returns a job's status, attempts, error and result, or None if it doesn't exist."""
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT id, status, attempts, error, result, payload FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return {
+            "id": row[0], "status": row[1], "attempts": row[2], "error": row[3],
+            "result": json.loads(row[4]) if row[4] else None, "url": json.loads(row[5]).get("url"),
+        }
+
+    def counts(self) -> Dict[str, int]:
+        """Returns the number of jobs in each status."""
+        conn = self._connect()
+        try:
+            return dict(conn.execute("SELECT status, count(*) FROM jobs GROUP BY status").fetchall())
+        finally:
+            conn.close()
+
+
+class WorkerPool:
+    """
+    A fixed number of threads draining a JobQueue.
+
+    Workers poll every `poll_interval` seconds and are woken immediately by
+    `notify`, so a capture is picked up as soon as a worker is free. A
+    heartbeat thread renews the locks of running jobs every
+    `heartbeat_interval` seconds, so a long job is never requeued while it runs.
+    """
+
+    def __init__(self, queue: JobQueue, handler: Callable[[Dict[str, Any]], Any], workers: int = 2, poll_interval: float = 5,
+                 heartbeat_interval: Optional[float] = None):
+        """
+        Args:
+            queue (JobQueue): The queue to drain.
+            handler (Callable[[Dict[str, Any]], Any]): Runs one job's payload; its JSON-serializable return value is stored as the result.
+            workers (int, optional): The number of concurrent jobs. Defaults to 2.
+            poll_interval (float, optional): Seconds between polls when idle. Defaults to 5.
+            heartbeat_interval (Optional[float], optional): Seconds between lock renewals. Defaults to a third of the queue's stale_after.
+        """
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval or queue.stale_after / 3
+        # Locks are held per pool, so another process sharing the queue can't finish this pool's jobs.
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._wake = threading.Condition()
+        self._stopping = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._running: Set[int] = set()
+        self._running_lock = threading.Lock()
+
+    def start(self) -> None:
+        requeued = self.queue.requeue_stale()
+        if requeued:
+            logging.info(f"Requeued {requeued} abandoned jobs")
+        threads = [threading.Thread(target=self._heartbeat, name="bookmark-heartbeat", daemon=True)]
+        threads += [threading.Thread(target=self._run, name=f"bookmark-worker-{number}", daemon=True) for number in range(self.workers)]
+        for thread in threads:
+            thread.start()
+            self._threads.append(thread)
+
+    def notify(self) -> None:
+        """Wakes an idle worker, e.g. after a job was enqueued."""
+        with self._wake:
+            self._wake.notify()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Stops the workers after their current job."""
+        self._stopping.set()
+        with self._wake:
+            self._wake.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def run_once(self) -> bool:
+        """Runs a single due job, returning False if there was none."""
+        job = self.queue.claim(self.worker_id)
+        if job is None:
+            return False
+        logging.info(f"Job {job.id}: attempt {job.attempts} for {job.payload.get('url')}")
+        with self._running_lock:
+            self._running.add(job.id)
+        try:
+            result = self.handler(job.payload)
+        except Exception as e:
+            logging.exception(f"Job {job.id} failed")
+            retrying = self.queue.fail(job.id, self.worker_id, f"{type(e).__name__}: {e}")
+            if retrying is None:
+                logging.warning(f"Job {job.id}: lost its lock, leaving it to its new owner")
+            else:
+                logging.info(f"Job {job.id}: {'retry scheduled' if retrying else 'giving up'}")
+        else:
+            if not self.queue.complete(job.id, self.worker_id, result):
+                logging.warning(f"Job {job.id}: lost its lock, result {result} not recorded")
+        finally:
+            with self._running_lock:
+                self._running.discard(job.id)
+        return True
+
+    def _heartbeat(self) -> None:
+        while not self._stopping.wait(self.heartbeat_interval):
+            with self._running_lock:
+                job_ids = list(self._running)
+            try:
+                held = self.queue.heartbeat(job_ids, self.worker_id)
+            except sqlite3.Error as e:
+                logging.error(f"Job queue heartbeat error: {e}")
+                continue
+            if held < len(job_ids):
+                logging.warning(f"Lost the locks of {len(job_ids) - held} of the running jobs {job_ids}")
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                if self.run_once():
+                    continue
+                self.queue.requeue_stale()
+            except sqlite3.Error as e:
+                logging.error(f"Job queue error: {e}")
+            with self._wake:
+                self._wake.wait(self.poll_interval)
+
+
+parser = argparse.ArgumentParser(description='Inspect the bookmark job queue.')
+parser.add_argument('--queue-db', metavar='queue_db', type=str, help='The job queue database.', default=JOB_QUEUE_DB)
+parser.add_argument('--job', metavar='job', type=int, help='Show a single job.')
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    queue = JobQueue(args.queue_db)
+    print(json.dumps(queue.get(args.job) if args.job else queue.counts(), indent=4))
@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from contextlib import closing
+from typing import Any, Callable, Dict, List, Optional
+
+from rate_limit import BULK, request_priority
+
+LABEL_CACHE_DB = os.getenv("LABEL_MAKER_CACHE_DB", os.path.expanduser("~/.cache/label-maker/labels.db"))
+LABELS_PER_PAGE = 100
+
+
+class LabelCatalog:
+    """
+    A persistent, self-revalidating cache of each repository's labels.
+
+    Labels are stored per page together with the page's ETag. Cached labels are
+    returned immediately; once they are older than `revalidate_after` seconds they
+    are revalidated in the background with `If-None-Match`, so an unchanged label
+    set costs one 304 per page and labeling never waits on a re-download.
+    """
+
+    def __init__(self, request: Callable[..., Any], database: str = LABEL_CACHE_DB, revalidate_after: float = 300):
+        """
+        Args:
+            request (Callable[..., Any]): A `gh_api_request`-compatible function.
+            database (str, optional): The path to the SQLite cache. Defaults to LABEL_CACHE_DB.
+            revalidate_after (float, optional): Seconds before cached labels are revalidated. Defaults to 300.
+        """
+        self.request = request
+        self.database = database
+        self.revalidate_after = revalidate_after
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._revalidating = set()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.database != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(self.database)), exist_ok=True)
+        conn = sqlite3.connect(self.database, timeout=30)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS label_catalog (repo TEXT PRIMARY KEY, pages TEXT, fetched_at REAL)"
+        )
+        return conn
+
+    def _load(self, repo: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            if repo in self._entries:
+                return self._entries[repo]
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute("SELECT pages, fetched_at FROM label_catalog WHERE repo = ?", (repo,)).fetchone()
+        if row is None:
+            return None
+        entry = {"pages": json.loads(row[0]), "fetched_at": row[1]}
+        with self._lock:
+            return self._entries.setdefault(repo, entry)
+
+    def _save(self, repo: str, entry: Dict[str, Any]) -> None:
+        with self._lock:
+            self._entries[repo] = entry
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO label_catalog (repo, pages, fetched_at) VALUES (?, ?, ?)",
+                (repo, json.dumps(entry["pages"]), entry["fetched_at"]),
+            )
+
+    @staticmethod
+    def _labels(entry: Dict[str, Any]) -> List[Dict[str, Any]]:
+        return [label for page in entry["pages"] for label in page["labels"]]
+
+    def get(self, repo: str) -> List[Dict[str, Any]]:
+        """
+        Returns the labels of a repository.
+
+        Only the very first call for a repository waits on GitHub; afterwards the
+        cached labels are returned and stale ones are revalidated in the background.
+
+        Args:
+            repo (str): The name of the repository.
+
+        Returns:
+            list: A list of labels, or an empty list if none could be fetched.
+        """
+        entry = self._load(repo)
+        if entry is None:
+            return self.refresh(repo)
+        if time.time() - entry["fetched_at"] > self.revalidate_after:
+            self._revalidate_in_background(repo)
+        return self._labels(entry)
+
+    def _revalidate_in_background(self, repo: str) -> None:
+        with self._lock:
+            if repo in self._revalidating:
+                return
+            self._revalidating.add(repo)
+
+        def revalidate():
+            try:
+                with request_priority(BULK):
+                    self.refresh(repo)
+            except Exception as e:
+                logging.error(f"Failed to revalidate labels for {repo}: {e}")
+            finally:
+                with self._lock:
+                    self._revalidating.discard(repo)
+
+        threading.Thread(target=revalidate, daemon=True).start()
+
+    def refresh(self, repo: str) -> List[Dict[str, Any]]:
+        """
+        Revalidates the cached labels of a repository page by page.
+
+        Pages whose ETag still matches come back as 304 and are reused; changed
+        pages are replaced, and pages are followed for as long as GitHub reports
+        a next page.
+
+        Args:
+            repo (str): The name of the repository.
+
+        Returns:
+            list: The current list of labels.
+        """
+        entry = self._load(repo)
+        cached_pages = entry["pages"] if entry else []
+        pages = []
+        page_number = 1
+        while True:
+            cached = cached_pages[page_number - 1] if page_number <= len(cached_pages) else None
+            headers = {"If-None-Match": cached["etag"]} if cached and cached.get("etag") else None
+            response = self.request(
+                repo, endpoint=f"/labels?per_page={LABELS_PER_PAGE}&page={page_number}", headers=headers
+            )
+            if response.status_code == 304:
+                pages.append(cached)
+                has_next = page_number < len(cached_pages) or len(cached["labels"]) >= LABELS_PER_PAGE
+            elif response.ok:
+                pages.append({"etag": response.headers.get("ETag"), "labels": response.json()})
+                has_next = "next" in response.links
+            else:
+                print(f"Failed to get labels: {response.text}")
+                return self._labels(entry) if entry else []
+            if not has_next:
+                break
+            page_number += 1
+
+        entry = {"pages": pages, "fetched_at": time.time()}
+        self._save(repo, entry)
+        labels = self._labels(entry)
+        print(f"Got {len(labels)} labels")
+        return labels
+
+    def add(self, repo: str, labels: List[Dict[str, Any]]) -> None:
+        """
+        Adds newly created labels to the cached catalog without refetching it.
+
+        Args:
+            repo (str): The name of the repository.
+            labels (list): The label objects returned by GitHub when they were created.
+        """
+        entry = self._load(repo)
+        if entry is None:
+            return
+        names = {label["name"].lower() for label in labels}
+        pages = [
+            {"etag": page.get("etag"), "labels": [label for label in page["labels"] if label["name"].lower() not in names]}
+            for page in entry["pages"]
+        ] or [{"etag": None, "labels": []}]
+        # The last page no longer matches its ETag, so forget the ETag to have it refetched on the next revalidation.
+        pages[-1] = {"etag": None, "labels": pages[-1]["labels"] + list(labels)}
+        self._save(repo, {"pages": pages, "fetched_at": entry["fetched_at"]})
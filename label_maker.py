@@ -1,75 +1,86 @@
 import os
 import json
+import math
 import argparse
 import sys
-import requests
-import numpy as np
-from openai import OpenAI
+from functools import lru_cache
 from tenacity import (
     retry,
     stop_after_attempt,
     wait_random_exponential,
 )  # for exponential backoff
+from gh_client import get_github_client
+from label_catalog import LabelCatalog
+from label_predictor import LABEL_HINT_CONFIDENCE, confident_labels, predict_labels
+from label_prompt import render_labels
+from label_shortlist import LABEL_SHORTLIST_SIZE, bookmark_embedding, shortlist_labels
+from llm_cache import cached_chat_completion, create_chat_completion
+from pipeline import Stage, run_pipeline
+from rate_limit import wait_unless_rate_limited
+from tracing import record_retry, traced
 
-client = OpenAI(
-    api_key=os.environ["OPENAI_API_KEY"],
-)
 
-if os.name == 'nt':
-    sys.stdout = open('CON', 'w')
-else:
-    sys.stdout = open('/dev/tty', 'w')
+@lru_cache(maxsize=None)
+def get_client():
+    """Creates the OpenAI client on first use, so importing this module needs neither openai nor a key."""
+    from openai import OpenAI
 
-print(f"openai version: {client._version}")
+    # The rate limiter and tenacity decide when to retry; the SDK's own retries would bypass both.
+    return OpenAI(api_key=os.environ["OPENAI_API_KEY"], max_retries=0)
 
 
-def gh_api_request(repo, method="GET", endpoint="", data=None):
+def redirect_stdout_to_terminal():
+    """
+    Sends progress output to the terminal, leaving the real stdout free for the script's JSON result.
+
+    Only the command-line entry points call this; importing the module leaves sys.stdout alone.
+    """
+    try:
+        sys.stdout = open('CON' if os.name == 'nt' else '/dev/tty', 'w')
+    except OSError:
+        return  # no controlling terminal, e.g. under a service manager
+    from openai import __version__
+    print(f"openai version: {__version__}")
+
+
+def gh_api_request(repo, method="GET", endpoint="", data=None, headers=None):
     """
     General-purpose GitHub API request function.
+
+    Requests go through the shared pooled client, so connections are kept alive
+    between calls.
     
     :param repo: Repository name including the owner (e.g., "owner/repo")
-    :param method: HTTP method (e.g., "GET", "POST")
+    :param method: HTTP method (e.g., "GET", "POST", "PATCH")
     :param endpoint: API endpoint after the repo URL (e.g., "/labels")
-    :param data: Data payload for POST requests
+    :param data: Data payload for POST and PATCH requests
+    :param headers: Extra request headers (e.g., "If-None-Match")
     :return: Response object
     """
-    token = os.getenv("GITHUB_TOKEN")
-    headers = {
-        "Authorization": f"token {token}",
-        "Accept": "application/vnd.github.v3+json",
-    }
-    url = f"https://api.github.com/repos/{repo}{endpoint}"
-    
-    if method.upper() == "GET":
-        response = requests.get(url, headers=headers)
-    elif method.upper() == "POST":
-        response = requests.post(url, json=data, headers=headers)
-    else:
-        raise ValueError(f"Unsupported HTTP method: {method}")
-    
-    return response
+    return get_github_client().request(method, f"/repos/{repo}{endpoint}", data=data, headers=headers)
+
 
+label_catalog = LabelCatalog(gh_api_request)
 
+
+@traced("label_fetch")
 def request_labels_list(repo):
     """
     Requests the list of labels for a given repository.
 
+    Labels come from the local label catalog, which pages through every label
+    on first use and afterwards revalidates them in the background by ETag.
+
     Args:
         repo (str): The name of the repository.
 
     Returns:
         list: A list of labels if the request is successful, otherwise an empty list.
     """
-    response = gh_api_request(repo, endpoint="/labels?per_page=100")
-    if response.ok:
-        labels = response.json()
-        print(f"Got {len(labels)} labels")
-        return labels
-    else:
-        print(f"Failed to get labels: {response.text}")
-        return []
+    return label_catalog.get(repo)
 
 
+@traced("create_labels")
 def create_new_labels(repo, label_list):
     """
     Creates new GitHub issues labels for a given repository.
@@ -81,8 +92,7 @@ def create_new_labels(repo, label_list):
     Returns:
         list: A list of label names that were successfully created.
     """
-    new_labels_created = []
-    for label in label_list:
+    def create_label(label):
         label_name = label["name"]
         label_description = label.get("description", "")  # Use .get() to avoid KeyError if 'description' is missing
         data = {
@@ -90,18 +100,30 @@ def create_new_labels(repo, label_list):
             "description": label_description,
             "color": "f29513",  # Consider dynamically setting or randomizing color
         }
-        response = gh_api_request(repo, method="POST", endpoint="/labels", data=data)
+        return gh_api_request(repo, method="POST", endpoint="/labels", data=data)
+
+    new_labels_created = []
+    responses = get_github_client().map_concurrent(create_label, label_list)
+    for label, response in zip(label_list, responses):
+        label_name = label["name"]
         if response.ok:
             print(f"Created label: {label_name}")
             new_labels_created.append(label_name)
+            label_catalog.add(repo, [response.json()])
         else:
             print(f"Failed to create label {label_name}: {response.text}")
     return new_labels_created
 
 
-@retry(stop=stop_after_attempt(8), wait=wait_random_exponential(multiplier=1, max=60))
-def check_if_new_labels_needed(current_labels, page_url, page_title, page_snippet):
-    
+@traced("need_check")
+@retry(stop=stop_after_attempt(8), wait=wait_unless_rate_limited(wait_random_exponential(multiplier=1, max=60)), before_sleep=record_retry)
+def check_if_new_labels_needed(current_labels, page_url, page_title, page_snippet, cache=True):
+    """
+    Asks whether the existing labels are adequate, returning the answer and its confidence.
+
+    The call is deterministic, so identical requests are answered from the LLM
+    response cache unless `cache` is False.
+    """
     system_message = """You are a helpful assistant designed to answer binary questions with True or False."""
 
     adequate_labels_query = f"""
@@ -117,7 +139,7 @@ def check_if_new_labels_needed(current_labels, page_url, page_title, page_snippe
         Only reply with True or False.
 
         **labels:**
-        {current_labels}
+        {render_labels(current_labels)}
 
         **Important**: Say nothing except true or false."""
     
@@ -126,7 +148,9 @@ def check_if_new_labels_needed(current_labels, page_url, page_title, page_snippe
         {"role": "user", "content": adequate_labels_query}
     ]
     
-    response = client.chat.completions.create(
+    response = cached_chat_completion(
+        get_client(),
+        cache=cache,
         model="gpt-3.5-turbo-0125",
         temperature=0,
         seed=1234,
@@ -138,7 +162,7 @@ def check_if_new_labels_needed(current_labels, page_url, page_title, page_snippe
     
     top_two_logprobs = response.choices[0].logprobs.content[0].top_logprobs
     for i, logprob in enumerate(top_two_logprobs, start=1): 
-        confidence = np.round(np.exp(logprob.logprob)*100,2)
+        confidence = round(math.exp(logprob.logprob)*100,2)
         if logprob.token == "True":
             if confidence > 99:
                 print(f"New Label required: \033[1;32;40mTrue: {confidence}\033[0m")
@@ -161,9 +185,15 @@ def check_if_new_labels_needed(current_labels, page_url, page_title, page_snippe
     return False,0
 
 
-@retry(stop=stop_after_attempt(8), wait=wait_random_exponential(multiplier=1, max=60))
+@traced("generate_new_labels")
+@retry(stop=stop_after_attempt(8), wait=wait_unless_rate_limited(wait_random_exponential(multiplier=1, max=60)), before_sleep=record_retry)
 def generate_new_labels(current_labels, page_url, page_title, page_snippet):
-    """Generate new labels if the existing labels are inadequate."""
+    """
+    Generate new labels if the existing labels are inadequate.
+
+    `current_labels` are the existing labels most relevant to the bookmark, so
+    the new labels follow their style without duplicating them.
+    """
     tools = [
         {
             "type": "function",
@@ -199,7 +229,7 @@ def generate_new_labels(current_labels, page_url, page_title, page_snippet):
          description: {page_snippet}\n
          
          **current labels:**
-         {current_labels}\n
+         {render_labels(current_labels)}\n
 
         Write A MAXIMUM OF TWO NEW label,description pairs to describe this link.
         *IMPORTANT* Make sure the labels are useful. They should delineate the topic without being overly specific.
@@ -213,7 +243,8 @@ def generate_new_labels(current_labels, page_url, page_title, page_snippet):
     ]
     max_retries = 3
     while max_retries > 0:
-        response = client.chat.completions.create(
+        response = create_chat_completion(
+            get_client(),
             model="gpt-3.5-turbo-0125",
             temperature=1,
             seed=1234,
@@ -233,10 +264,14 @@ def generate_new_labels(current_labels, page_url, page_title, page_snippet):
     raise Exception("Failed to get labels")
 
 
-@retry(stop=stop_after_attempt(8), wait=wait_random_exponential(multiplier=1, max=60))
-def pick_labels(page_url, page_title, page_snippet, labels):
+@traced("pick_labels")
+@retry(stop=stop_after_attempt(8), wait=wait_unless_rate_limited(wait_random_exponential(multiplier=1, max=60)), before_sleep=record_retry)
+def pick_labels(page_url, page_title, page_snippet, labels, hints=None):
     """
     Choose the labels to assign to a bookmark, with improved handling for different formats.
+
+    `hints` are label votes of the most similar issues (see predict_for_bookmark). Those in
+    `labels` are listed in the prompt as suggestions, which the LLM is free to ignore.
     """
     tools = [
         {
@@ -277,10 +312,19 @@ def pick_labels(page_url, page_title, page_snippet, labels):
 
     <labels_list>
     
-    {labels}
+    {render_labels(labels)}
     
     </labels_list>
     """
+    shortlisted = {label['name'].lower() for label in labels}
+    hints = [hint for hint in hints or [] if hint.confidence >= LABEL_HINT_CONFIDENCE and hint.name.lower() in shortlisted]
+    if hints:
+        pick_labels_query += f"""
+    <similar_issues>
+    The most similar existing issues carry these labels, with the share of them that carry each: {", ".join(f"{hint.name} ({hint.confidence:.2f})" for hint in hints)}.
+    Only pick them if they apply to this content.
+    </similar_issues>
+    """
 
     messages = [
         {"role": "system", "content": system_message},
@@ -288,7 +332,8 @@ def pick_labels(page_url, page_title, page_snippet, labels):
     ]
     max_retries = 6
     while max_retries > 0:
-        response = client.chat.completions.create(
+        response = create_chat_completion(
+            get_client(),
             model="gpt-3.5-turbo-0125",
             temperature=0.9,
             seed=0,
@@ -318,16 +363,110 @@ def pick_labels(page_url, page_title, page_snippet, labels):
     raise Exception("Failed to get labels")
 
 
-@retry(stop=stop_after_attempt(8), wait=wait_random_exponential(multiplier=1, max=60))
-def generate_labels(page_url, page_title, page_snippet, target_repo):
+@traced("shortlist")
+def shortlist_for_bookmark(labels, page_url, page_title, page_snippet, embedding=None, max_labels=LABEL_SHORTLIST_SIZE):
+    """
+    Narrows the label catalog to the labels most similar to the bookmark.
+
+    Falls back to the full catalog if the bookmark or labels cannot be embedded.
+    A catalog that already fits is only embedded to be ranked when the
+    bookmark's embedding is at hand, since ranking is what lets render_labels
+    drop the least relevant labels.
+
+    Args:
+        labels (list): The label catalog.
+        page_url (str): The URL of the page.
+        page_title (str): The title of the page.
+        page_snippet (str): The snippet of the page.
+        embedding (list, optional): A precomputed embedding of the bookmark. Defaults to None.
+        max_labels (int, optional): The shortlist size, 0 to disable shortlisting. Defaults to LABEL_SHORTLIST_SIZE.
+
+    Returns:
+        list: The shortlisted labels.
+    """
+    if embedding is None and (not max_labels or len(labels) <= max_labels):
+        return labels
+    try:
+        if embedding is None:
+            embedding = bookmark_embedding(page_url, page_title, page_snippet)
+        shortlist = shortlist_labels(labels, embedding, max_labels)
+    except Exception as e:
+        print(f"Failed to shortlist labels: {e}")
+        return labels
+    print(f"Shortlisted {len(shortlist)} of {len(labels)} labels")
+    return shortlist
+
+
+def embed_bookmark(page_url, page_title, page_snippet):
+    """Embeds a bookmark for label prediction and shortlisting, returning None if embedding fails."""
+    try:
+        return bookmark_embedding(page_url, page_title, page_snippet)
+    except Exception as e:
+        print(f"Failed to embed bookmark: {e}")
+        return None
+
+
+@traced("predict_labels")
+def predict_for_bookmark(labels, embedding, database, collection="gh-issues"):
+    """
+    Votes labels for a bookmark from its nearest labeled issues, without an LLM call.
+
+    Args:
+        labels (list): The label catalog; predicted labels that no longer exist are dropped.
+        embedding (list): The embedding of the bookmark.
+        database (str): The issues database.
+        collection (str, optional): The embeddings collection. Defaults to "gh-issues".
+
+    Returns:
+        list: The LabelPredictions, most confident first, or an empty list if there are none.
+    """
+    if embedding is None or not database:
+        return []
+    try:
+        predictions = predict_labels(embedding, database, collection)
+    except Exception as e:
+        print(f"Failed to predict labels: {e}")
+        return []
+    existing = {label['name'].lower() for label in labels}
+    return [prediction for prediction in predictions if prediction.name.lower() in existing]
+
+
+def predicted_labels(predictions):
+    """
+    Returns the confident predictions in the same shape pick_labels returns, or None if there are none.
+    """
+    predictions = confident_labels(predictions)
+    if not predictions:
+        return None
+    print(f"Predicted labels: {', '.join(f'{p.name} ({p.confidence:.2f})' for p in predictions)}")
+    return {
+        'label_names': ",".join(prediction.name.lower() for prediction in predictions),
+        'missing_labels': {},
+        'confidences': {prediction.name: round(prediction.confidence, 3) for prediction in predictions},
+    }
+
+
+@traced("generate_labels")
+@retry(stop=stop_after_attempt(8), wait=wait_unless_rate_limited(wait_random_exponential(multiplier=1, max=60)), before_sleep=record_retry)
+def generate_labels(page_url, page_title, page_snippet, target_repo, embedding=None, max_labels=LABEL_SHORTLIST_SIZE,
+                    database=None, collection="gh-issues"):
     """
     Generates labels for a given page based on its URL, title, and snippet.
 
+    Only the `max_labels` labels closest to the bookmark's embedding are shown to the LLM.
+    If `database` is given, labels are first voted from the nearest labeled issues, and
+    the LLM is only asked to pick labels when no label is confident enough, with the
+    votes as hints.
+
     Args:
         page_url (str): The URL of the page.
         page_title (str): The title of the page.
         page_snippet (str): The snippet of the page.
         target_repo (str): The target repository to generate labels for.
+        embedding (list, optional): A precomputed embedding of the bookmark. Defaults to None.
+        max_labels (int, optional): The label shortlist size, 0 to send every label. Defaults to LABEL_SHORTLIST_SIZE.
+        database (str, optional): The issues database used to predict labels locally. Defaults to None.
+        collection (str, optional): The embeddings collection in `database`. Defaults to "gh-issues".
 
     Returns:
         dict: A dictionary containing the generated labels and the picked labels.
@@ -341,18 +480,29 @@ def generate_labels(page_url, page_title, page_snippet, target_repo):
     while MAX_RETRIES > 0:
         MAX_RETRIES -= 1
         try:
-            original_labels = request_labels_list(target_repo)
+            # pick_labels and check_if_new_labels_needed only depend on the shortlist, so they run concurrently.
+            # A confident local prediction replaces the pick_labels call; otherwise the votes are hints for it.
+            results = run_pipeline([
+                Stage("labels", lambda: request_labels_list(target_repo)),
+                Stage("embedding", lambda: embedding if embedding is not None or not database else embed_bookmark(page_url, page_title, page_snippet)),
+                Stage("shortlist", lambda labels, embedding: shortlist_for_bookmark(labels, page_url, page_title, page_snippet, embedding, max_labels), ("labels", "embedding")),
+                Stage("predicted", lambda labels, embedding: predict_for_bookmark(labels, embedding, database, collection), ("labels", "embedding")),
+                Stage("picked", lambda shortlist, predicted: predicted_labels(predicted) or pick_labels(page_url, page_title, page_snippet, shortlist, predicted), ("shortlist", "predicted")),
+                Stage("needed", lambda shortlist: check_if_new_labels_needed(shortlist, page_url, page_title, page_snippet), ("shortlist",)),
+            ])
+            original_labels = results["labels"]
             label_mapping = {label['name'].lower(): label['name'] for label in original_labels}
-            picked_labels = pick_labels(page_url, page_title, page_snippet, original_labels)
+            picked_labels = results["picked"]
             picked_labels['label_names'] = ",".join([label_mapping[label] for label in picked_labels['label_names'].split(",")]) 
 
             # NEW LABELS GENERATION
-            labels_needed, confidence = check_if_new_labels_needed(original_labels, page_url, page_title, page_snippet)
+            labels_needed, confidence = results["needed"]
             if labels_needed:
-                generated_labels = generate_new_labels(picked_labels, page_url, page_title, page_snippet)
+                generated_labels = generate_new_labels(results["shortlist"], page_url, page_title, page_snippet)
                 generated_labels['confidence'] = confidence
                 if confidence >= 99:
-                    labels_created = create_new_labels(target_repo, generated_labels)
+                    new_label = {"name": generated_labels["label-name"], "description": generated_labels["label-description"]}
+                    labels_created = create_new_labels(target_repo, [new_label])
                     picked_labels['label_names'] = picked_labels['label_names'] + "," + ",".join(labels_created)
 
                 if "New-Label" not in picked_labels['label_names']:
@@ -374,10 +524,15 @@ parser.add_argument('--url', metavar='url', type=str, help='The url of the bookm
 parser.add_argument('--title', metavar='title', type=str, help='The title of the bookmark.')
 parser.add_argument('--snippet', metavar='snippet', type=str, help='The selected text of the bookmark.')
 parser.add_argument('--repo', metavar='repo', type=str, help='The repo to get labels from.', default="irthomasthomas/undecidability")
+parser.add_argument('--max-labels', metavar='max_labels', type=int, help='The number of most similar labels shown to the LLM (0 for all).', default=LABEL_SHORTLIST_SIZE)
+parser.add_argument('--embedding_db', metavar='embedding_db', type=str, help='An issues database to predict labels from before asking the LLM.')
+parser.add_argument('--collection', metavar='collection', type=str, help='The embeddings collection in the issues database.', default="gh-issues")
 
 
 if __name__ == "__main__":
     args = parser.parse_args()
-    labels = generate_labels(args.url, args.title, args.description, args.repo)
+    redirect_stdout_to_terminal()
+    labels = generate_labels(args.url, args.title, args.snippet, args.repo, max_labels=args.max_labels,
+                             database=args.embedding_db, collection=args.collection)
     sys.stdout = sys.__stdout__
     print(f"{json.dumps(labels, indent=4)}")
\ No newline at end of file
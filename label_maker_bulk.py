@@ -1,28 +1,127 @@
-def bulk_label_maker():
-    try:
-        conn = sqlite3.connect("logs.db")
-        cur = conn.cursor()
-        cur.execute("CREATE TABLE IF NOT EXISTS labels (responses_id TEXT PRIMARY KEY REFERENCES [responses]([id]), prompt TEXT, labels TEXT);")
+import json
+import sqlite3
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+
+from label_maker import generate_labels
+from rate_limit import BULK, request_priority
+
+
+def setup_tables(conn: sqlite3.Connection) -> None:
+    """Creates the labels table and the checkpoint table used to resume interrupted runs."""
+    conn.execute("CREATE TABLE IF NOT EXISTS labels (responses_id TEXT PRIMARY KEY REFERENCES [responses]([id]), prompt TEXT, labels TEXT);")
+    conn.execute("CREATE TABLE IF NOT EXISTS labels_checkpoint (name TEXT PRIMARY KEY, last_rowid INTEGER);")
+    conn.commit()
+
+
+def read_checkpoint(conn: sqlite3.Connection, name: str) -> int:
+    row = conn.execute("SELECT last_rowid FROM labels_checkpoint WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else 0
+
+
+def stream_responses(conn: sqlite3.Connection, after_rowid: int, batch_size: int) -> Iterator[List[Tuple[int, str, str]]]:
+    """
+    Yields unlabeled responses in rowid order, one batch at a time.
+
+    Each batch is a separate keyset query, so no read transaction is held open
+    while results are being written.
 
-        cur.execute("SELECT id, prompt FROM responses;")
-        data = cur.fetchall()
+    Args:
+        conn (sqlite3.Connection): The logs database.
+        after_rowid (int): Only rows after this rowid are read.
+        batch_size (int): The number of rows per batch.
 
-        for i, row in enumerate(data, start=1):
-            id, prompt = row
-            truncated_prompt = prompt[:400]  # Truncate prompt to 400 characters
-            print(f"Truncated Prompt: {truncated_prompt}")
+    Yields:
+        List[Tuple[int, str, str]]: (rowid, id, prompt) tuples.
+    """
+    while True:
+        batch = conn.execute(
+            """
+            SELECT rowid, id, prompt FROM responses
+            WHERE rowid > ? AND id NOT IN (SELECT responses_id FROM labels)
+            ORDER BY rowid LIMIT ?;
+            """,
+            (after_rowid, batch_size),
+        ).fetchall()
+        if not batch:
+            return
+        yield batch
+        after_rowid = batch[-1][0]
 
-            labels = generate_labels(truncated_prompt)
-            print(labels)
 
-            if i > 1000:
-                break
+def label_response(prompt: str, repo: str, max_chars: int) -> Optional[str]:
+    """Returns the labels of one logged prompt as JSON, or None if they couldn't be generated."""
+    truncated_prompt = (prompt or "")[:max_chars]
+    # Bulk labeling yields the API budget to bookmarks being captured at the same time.
+    with request_priority(BULK):
+        labels = generate_labels("", "", truncated_prompt, repo)
+    return json.dumps(labels) if labels is not None else None
 
-        conn.commit()
-        print("All data committed to the database.")
-    except Error as e:
-        print(e)
+
+def bulk_label_maker(database: str = "logs.db", repo: str = "irthomasthomas/undecidability", workers: int = 8,
+                     batch_size: int = 50, limit: int = 0, max_chars: int = 400, checkpoint: str = "default") -> int:
+    """
+    Labels logged LLM responses with a bounded worker pool.
+
+    Each batch is labeled concurrently and its results are written in a single
+    transaction together with the checkpoint, so a crashed run resumes after the
+    last committed batch. Rows whose labels couldn't be generated are left
+    unlabeled and the checkpoint stays before the first of them, so the next
+    run retries them.
+
+    Args:
+        database (str, optional): The path to the llm logs database. Defaults to "logs.db".
+        repo (str, optional): The repo to get labels from. Defaults to "irthomasthomas/undecidability".
+        workers (int, optional): The number of concurrent labeling calls. Defaults to 8.
+        batch_size (int, optional): The number of rows per transaction. Defaults to 50.
+        limit (int, optional): Stop after this many rows, 0 for no limit. Defaults to 0.
+        max_chars (int, optional): Prompts are truncated to this many characters. Defaults to 400.
+        checkpoint (str, optional): The name of the checkpoint to resume from. Defaults to "default".
+
+    Returns:
+        int: The number of rows labeled.
+    """
+    conn = sqlite3.connect(database)
+    try:
+        setup_tables(conn)
+        labeled = attempted = failed = 0
+        resume_after = None
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for batch in stream_responses(conn, read_checkpoint(conn, checkpoint), batch_size):
+                if limit:
+                    batch = batch[:limit - attempted]
+                results = list(executor.map(lambda row: label_response(row[2], repo, max_chars), batch))
+                rows = [(id, prompt, labels) for (_, id, prompt), labels in zip(batch, results) if labels is not None]
+                if resume_after is None:
+                    resume_after = next((rowid - 1 for (rowid, _, _), labels in zip(batch, results) if labels is None), None)
+                with conn:
+                    conn.executemany("INSERT OR REPLACE INTO labels (responses_id, prompt, labels) VALUES (?, ?, ?);", rows)
+                    conn.execute(
+                        "INSERT OR REPLACE INTO labels_checkpoint (name, last_rowid) VALUES (?, ?);",
+                        (checkpoint, batch[-1][0] if resume_after is None else resume_after),
+                    )
+                attempted += len(batch)
+                labeled += len(rows)
+                failed += len(batch) - len(rows)
+                print(f"Labeled {labeled} responses, {failed} failed (last rowid {batch[-1][0]})")
+                if limit and attempted >= limit:
+                    break
+        print("All data committed to the database." if not failed else f"All data committed to the database; rerun to retry {failed} failed responses.")
+        return labeled
     finally:
-        if conn:
-            conn.close()
+        conn.close()
+
+
+parser = argparse.ArgumentParser(description='Label logged LLM responses in bulk.')
+parser.add_argument('--db', metavar='db', type=str, help='The llm logs database.', default="logs.db")
+parser.add_argument('--repo', metavar='repo', type=str, help='The repo to get labels from.', default="irthomasthomas/undecidability")
+parser.add_argument('--workers', metavar='workers', type=int, help='The number of concurrent labeling calls.', default=8)
+parser.add_argument('--batch-size', metavar='batch_size', type=int, help='The number of rows committed per transaction.', default=50)
+parser.add_argument('--limit', metavar='limit', type=int, help='Stop after this many rows (0 for no limit).', default=0)
+parser.add_argument('--checkpoint', metavar='checkpoint', type=str, help='The name of the checkpoint to resume from.', default="default")
+
 
+if __name__ == "__main__":
+    args = parser.parse_args()
+    bulk_label_maker(args.db, args.repo, args.workers, args.batch_size, args.limit, checkpoint=args.checkpoint)
@@ -0,0 +1,172 @@
+import os
+import json
+import sqlite3
+import logging
+import argparse
+import threading
+from collections import defaultdict
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+LABEL_PREDICTION_K = 10
+# Leave-one-out on undecidability_gh_issues.db: 0.7 labels 17% of issues at 74% precision, 0.85 labels 3% at 89%.
+LABEL_CONFIDENCE = float(os.getenv("LABEL_MAKER_LABEL_CONFIDENCE", "0.85"))
+# Votes this confident are passed to pick_labels as hints when none clears LABEL_CONFIDENCE.
+LABEL_HINT_CONFIDENCE = 0.3
+# Neighbours less similar than this say little about the bookmark and are ignored.
+LABEL_NEIGHBOUR_MIN_SCORE = 0.75
+# A vote needs at least this many labeled neighbours before it is trusted.
+LABEL_MIN_NEIGHBOURS = 3
+# Labels the pipeline adds itself rather than describing the content.
+EXCLUDED_LABELS = {"new-label"}
+
+
+class LabelPrediction(NamedTuple):
+    """A label voted for by the nearest labeled issues, with the share of their similarity behind it."""
+    name: str
+    confidence: float
+
+
+_labels: Dict[str, Tuple[Any, Dict[str, List[str]]]] = {}
+_labels_lock = threading.Lock()
+
+
+def issue_labels(database: str) -> Dict[str, List[str]]:
+    """
+    Returns the label names of every labeled issue, keyed by issue number as a string.
+
+    The mapping is cached per database and reloaded when the database file changes.
+
+    Args:
+        database (str): The path to the issues database.
+
+    Returns:
+        Dict[str, List[str]]: The labels of each issue that has any.
+    """
+    from similarity_index import database_state
+
+    state = database_state(database)
+    with _labels_lock:
+        cached = _labels.get(database)
+        if cached and cached[0] == state:
+            return cached[1]
+    with sqlite3.connect(database, timeout=30) as conn:
+        labels = {}
+        for number, names in conn.execute("SELECT number, labels FROM github_issues WHERE labels IS NOT NULL"):
+            try:
+                names = [name for name in json.loads(names) if name.lower() not in EXCLUDED_LABELS]
+            except (TypeError, ValueError):
+                continue
+            if names:
+                labels[str(number)] = names
+    with _labels_lock:
+        _labels[database] = (state, labels)
+    return labels
+
+
+def predict_labels(embedding: Any, database: str, collection: str = "gh-issues", k: int = LABEL_PREDICTION_K,
+                   min_score: float = LABEL_NEIGHBOUR_MIN_SCORE, exclude: Optional[str] = None) -> List[LabelPrediction]:
+    """
+    Votes labels for a bookmark from its nearest labeled issues, weighted by similarity.
+
+    A label's confidence is the similarity of the neighbours carrying it divided
+    by the similarity of all labeled neighbours, so 1.0 means every close issue
+    has it.
+
+    Args:
+        embedding (Any): The embedding of the bookmark.
+        database (str): The path to the issues database.
+        collection (str, optional): The name of the collection in the database. Defaults to "gh-issues".
+        k (int, optional): The number of neighbours searched. Defaults to LABEL_PREDICTION_K.
+        min_score (float, optional): The least similarity of a voting neighbour. Defaults to LABEL_NEIGHBOUR_MIN_SCORE.
+        exclude (Optional[str], optional): An issue number to leave out, e.g. the issue being evaluated. Defaults to None.
+
+    Returns:
+        List[LabelPrediction]: The labels, most confident first, or an empty list if fewer
+        than LABEL_MIN_NEIGHBOURS labeled neighbours are close enough to vote.
+    """
+    from similarity_index import get_index
+
+    labels = issue_labels(database)
+    hits = get_index(database, collection).search(embedding, k + (exclude is not None))
+    voters = [hit for hit in hits if hit.score >= min_score and hit.id in labels and hit.id != exclude][:k]
+    if len(voters) < LABEL_MIN_NEIGHBOURS:
+        return []
+    votes: Dict[str, float] = defaultdict(float)
+    for hit in voters:
+        for name in labels[hit.id]:
+            votes[name] += hit.score
+    total = sum(hit.score for hit in voters)
+    return sorted(
+        (LabelPrediction(name, weight / total) for name, weight in votes.items()), key=lambda prediction: -prediction.confidence
+    )
+
+
+def confident_labels(predictions: List[LabelPrediction], threshold: float = LABEL_CONFIDENCE) -> List[LabelPrediction]:
+    """
+    Returns the predictions at or above the confidence threshold.
+
+    The threshold trades precision for coverage: confident labels replace the
+    pick_labels call, so a lower threshold skips more LLM calls but assigns more
+    wrong labels. The default of 0.85 only takes the shortcut for the few
+    bookmarks whose neighbours nearly all agree, and otherwise leaves the votes
+    to pick_labels as hints. `python3 label_predictor.py --threshold` measures
+    both on a database.
+
+    Args:
+        predictions (List[LabelPrediction]): The votes of predict_labels.
+        threshold (float, optional): The confidence a label needs. Defaults to LABEL_CONFIDENCE.
+
+    Returns:
+        List[LabelPrediction]: The confident predictions, most confident first.
+    """
+    return [prediction for prediction in predictions if prediction.confidence >= threshold]
+
+
+def evaluate(database: str, collection: str = "gh-issues", threshold: float = LABEL_CONFIDENCE) -> Dict[str, float]:
+    """
+    Measures the predictor by predicting every labeled issue from the others.
+
+    Args:
+        database (str): The path to the issues database.
+        collection (str, optional): The name of the collection in the database. Defaults to "gh-issues".
+        threshold (float, optional): The confidence threshold. Defaults to LABEL_CONFIDENCE.
+
+    Returns:
+        Dict[str, float]: The share of issues the fast path would label (coverage), and the
+        precision and recall of the labels it would assign.
+    """
+    import numpy as np
+    from similarity_index import _collection_rows
+
+    labels = issue_labels(database)
+    covered = correct = predicted = expected = 0
+    with sqlite3.connect(database, timeout=30) as conn:
+        for ids, matrix, updated in _collection_rows(conn, collection):
+            for id, vector in zip(ids, np.asarray(matrix)):
+                if id not in labels:
+                    continue
+                confident = {prediction.name for prediction in confident_labels(predict_labels(vector, database, collection, exclude=id), threshold)}
+                if not confident:
+                    continue
+                covered += 1
+                correct += len(confident & set(labels[id]))
+                predicted += len(confident)
+                expected += len(labels[id])
+    return {
+        "labeled_issues": len(labels),
+        "coverage": covered / len(labels) if labels else 0.0,
+        "precision": correct / predicted if predicted else 0.0,
+        "recall": correct / expected if expected else 0.0,
+    }
+
+
+parser = argparse.ArgumentParser(description='Evaluate the kNN label predictor against the labeled issues.')
+parser.add_argument('--embedding_db', metavar='embedding_db', type=str, help='The issues database.', default="github-issues.db")
+parser.add_argument('--collection', metavar='collection', type=str, help='The embeddings collection.', default="gh-issues")
+parser.add_argument('--threshold', metavar='threshold', type=float, help='The confidence a label needs.', default=LABEL_CONFIDENCE)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    logging.basicConfig(filename='/tmp/ai_gh_issues.log', level=logging.INFO)
+    print(json.dumps(evaluate(args.embedding_db, args.collection, args.threshold), indent=4))
@@ -0,0 +1,90 @@
+import os
+import math
+from functools import lru_cache
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+LABEL_PROMPT_TOKEN_BUDGET = int(os.getenv("LABEL_MAKER_LABEL_TOKEN_BUDGET", "1200"))
+LABEL_DESCRIPTION_MAX_TOKENS = 24
+
+
+@lru_cache(maxsize=None)
+def _get_encoding():
+    """Loads the gpt-3.5 tokenizer on first use, or returns None if tiktoken is unavailable."""
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:  # tiktoken is optional; without it token counts are estimated
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """Counts the tokens of a text with the gpt-3.5 tokenizer, or estimates them at four characters per token."""
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return math.ceil(len(text) / 4)
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    encoding = _get_encoding()
+    if encoding is not None:
+        tokens = encoding.encode(text)
+        return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens]).rstrip() + "…"
+    max_chars = max_tokens * 4
+    return text if len(text) <= max_chars else text[:max_chars].rstrip() + "…"
+
+
+@lru_cache(maxsize=16384)
+def _render_label(name: str, description: str, max_description_tokens: Optional[int] = None) -> Tuple[str, int]:
+    """Renders one label as a `name: description` line, with its token count (including the newline)."""
+    description = " ".join(description.split())
+    if description and max_description_tokens is not None:
+        description = _truncate(description, max_description_tokens)
+    line = f"{name}: {description}" if description else name
+    return line, count_tokens(line) + 1
+
+
+@lru_cache(maxsize=32)
+def _render(labels: Tuple[Tuple[str, str], ...], budget: int, ranked: bool) -> str:
+    lines = [_render_label(name, description) for name, description in labels]
+    if budget and sum(tokens for line, tokens in lines) > budget:
+        lines = [_render_label(name, description, LABEL_DESCRIPTION_MAX_TOKENS) for name, description in labels]
+    if budget and ranked:
+        total = 0
+        for kept, (line, tokens) in enumerate(lines):
+            total += tokens
+            if total > budget:
+                lines = lines[:kept]
+                break
+    return "\n".join(line for line, tokens in lines)
+
+
+def render_labels(labels: Sequence[Dict[str, Any]], budget: int = LABEL_PROMPT_TOKEN_BUDGET) -> str:
+    """
+    Renders labels for a prompt as one `name: description` line each.
+
+    The GitHub label fields the model has no use for (id, node_id, url, color,
+    default) are left out. Renderings are cached on the label names and
+    descriptions, so an unchanged catalog is only rendered once, and an edited
+    label invalidates only its own line.
+
+    If the labels don't fit in `budget` tokens, descriptions are first cut to
+    LABEL_DESCRIPTION_MAX_TOKENS. If they still don't fit and every label has
+    the "score" shortlist_labels gives it, the lowest-scoring labels are
+    dropped. Unranked labels, such as a catalog in GitHub's order, are all kept,
+    since there is no telling which of them matter least.
+
+    Args:
+        labels (Sequence[Dict[str, Any]]): The labels.
+        budget (int, optional): The most tokens the rendering may take, 0 for no limit.
+            Defaults to $LABEL_MAKER_LABEL_TOKEN_BUDGET or 1200.
+
+    Returns:
+        str: The rendered labels.
+    """
+    ranked = bool(labels) and all("score" in label for label in labels)
+    if ranked:
+        labels = sorted(labels, key=lambda label: -label["score"])
+    key = tuple((label["name"], label.get("description") or "") for label in labels)
+    return _render(key, budget, ranked)
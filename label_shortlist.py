@@ -0,0 +1,104 @@
+import os
+import sqlite3
+import hashlib
+import threading
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+from embeddings import EMBEDDING_MODEL, get_embedding_model
+from label_catalog import LABEL_CACHE_DB
+
+if TYPE_CHECKING:
+    from similarity_index import SimilarityIndex
+
+LABEL_SHORTLIST_SIZE = int(os.getenv("LABEL_SHORTLIST_SIZE", "40"))
+
+
+def label_text(label: Dict[str, Any]) -> str:
+    """The text a label is embedded as: its name and description."""
+    return f"{label['name']}: {label.get('description') or ''}"
+
+
+def _text_hash(text: str, model_id: str) -> str:
+    return hashlib.sha256(f"{model_id}\n{text}".encode()).hexdigest()
+
+
+_indexes: Dict[Tuple[str, ...], "SimilarityIndex"] = {}
+_indexes_lock = threading.Lock()
+
+
+def label_index(labels: List[Dict[str, Any]], database: str = LABEL_CACHE_DB, model_id: str = EMBEDDING_MODEL) -> "SimilarityIndex":
+    """
+    Returns a similarity index over the given labels, ids being positions in `labels`.
+
+    Label embeddings are cached in SQLite by a hash of the model and label text,
+    so only new or edited labels are embedded.
+
+    Args:
+        labels (List[Dict[str, Any]]): The label catalog.
+        database (str, optional): The path to the SQLite cache. Defaults to LABEL_CACHE_DB.
+        model_id (str, optional): The embedding model. Defaults to EMBEDDING_MODEL.
+
+    Returns:
+        SimilarityIndex: The index over the labels.
+    """
+    import numpy as np
+    from similarity_index import SimilarityIndex
+
+    hashes = tuple(_text_hash(label_text(label), model_id) for label in labels)
+    with _indexes_lock:
+        if hashes in _indexes:
+            return _indexes[hashes]
+
+    if database != ":memory:":
+        os.makedirs(os.path.dirname(os.path.abspath(database)), exist_ok=True)
+    with sqlite3.connect(database, timeout=30) as conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS label_embeddings (content_hash TEXT PRIMARY KEY, embedding BLOB)")
+        cached = {}
+        unique = list(set(hashes))
+        for start in range(0, len(unique), 500):
+            chunk = unique[start:start + 500]
+            rows = conn.execute(
+                f"SELECT content_hash, embedding FROM label_embeddings WHERE content_hash IN ({','.join('?' * len(chunk))})",
+                chunk,
+            ).fetchall()
+            cached.update({row[0]: np.frombuffer(row[1], dtype="<f4") for row in rows})
+
+        missing = {content_hash: label for content_hash, label in zip(hashes, labels) if content_hash not in cached}
+        if missing:
+            vectors = get_embedding_model(model_id).embed_multi([label_text(label) for label in missing.values()])
+            new_rows = [(content_hash, np.asarray(vector, dtype="<f4").tobytes()) for content_hash, vector in zip(missing, vectors)]
+            conn.executemany("INSERT OR REPLACE INTO label_embeddings (content_hash, embedding) VALUES (?, ?)", new_rows)
+            cached.update({row[0]: np.frombuffer(row[1], dtype="<f4") for row in new_rows})
+
+    index = SimilarityIndex([str(i) for i in range(len(labels))], np.vstack([cached[h] for h in hashes]))
+    with _indexes_lock:
+        _indexes.clear()  # only the current catalog is worth keeping
+        _indexes[hashes] = index
+    return index
+
+
+def shortlist_labels(labels: List[Dict[str, Any]], embedding: Any, top_n: int = LABEL_SHORTLIST_SIZE,
+                     database: str = LABEL_CACHE_DB) -> List[Dict[str, Any]]:
+    """
+    Picks the labels most similar to a bookmark so prompts don't carry the whole catalog.
+
+    Args:
+        labels (List[Dict[str, Any]]): The label catalog.
+        embedding (Any): The embedding of the bookmark.
+        top_n (int, optional): The number of labels to keep, 0 to keep them all. Defaults to LABEL_SHORTLIST_SIZE.
+        database (str, optional): The path to the SQLite cache. Defaults to LABEL_CACHE_DB.
+
+    Returns:
+        List[Dict[str, Any]]: Copies of the shortlisted labels with their similarity as "score", most similar
+            first, or `labels` unchanged without an embedding.
+    """
+    if embedding is None or not labels:
+        return labels
+    results = label_index(labels, database).search(embedding, min(top_n or len(labels), len(labels)))
+    return [{**labels[int(result.id)], "score": result.score} for result in results]
+
+
+def bookmark_embedding(page_url: str, page_title: str, page_snippet: str, model_id: str = EMBEDDING_MODEL) -> Optional[List[float]]:
+    """Embeds a bookmark the same way issues are embedded, as title followed by text."""
+    content = f"{page_title or page_url} {page_snippet or ''}".strip()
+    return get_embedding_model(model_id).embed(content) if content else None
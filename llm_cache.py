@@ -0,0 +1,226 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+from contextlib import closing
+from typing import Any, Dict, List, Optional
+
+from rate_limit import get_rate_limiter
+from tracing import current_span, record_llm_usage, record_usage
+
+LLM_CACHE_DB = os.getenv("LABEL_MAKER_LLM_CACHE_DB", os.path.expanduser("~/.cache/label-maker/llm_cache.db"))
+LLM_CACHE_TTL = float(os.getenv("LABEL_MAKER_LLM_CACHE_TTL", str(30 * 24 * 3600)))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LABEL_MAKER_LLM_CACHE_MAX_ENTRIES", "20000"))
+LLM_CACHE_DISABLED = os.getenv("LABEL_MAKER_NO_LLM_CACHE", "") not in ("", "0")
+
+
+class ResponseCache:
+    """
+    A SQLite-backed cache of LLM responses.
+
+    Entries are keyed on the model, a hash of the messages and the sampling
+    parameters. They expire after `ttl` seconds, and the least recently used
+    entries are evicted once there are more than `max_entries`.
+    """
+
+    def __init__(self, database: str = LLM_CACHE_DB, ttl: float = LLM_CACHE_TTL, max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        self.database = database
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._initialized = False
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.database != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(self.database)), exist_ok=True)
+        conn = sqlite3.connect(self.database, timeout=30)
+        if not self._initialized:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY, model TEXT, value TEXT, created_at REAL, accessed_at REAL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_accessed_at ON llm_cache (accessed_at)")
+            self._initialized = True
+        return conn
+
+    @staticmethod
+    def key(model: str, messages: List[Dict[str, Any]], params: Dict[str, Any]) -> str:
+        """Hashes a request into a cache key."""
+        payload = json.dumps({"model": model, "messages": messages, "params": params}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Returns the cached value for a key, or None if it is missing or expired."""
+        now = time.time()
+        # `with conn` only commits; closing() releases the connection too.
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute(
+                "SELECT value FROM llm_cache WHERE key = ? AND created_at > ?", (key, now - self.ttl)
+            ).fetchone()
+            if row:
+                conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        return row[0] if row else None
+
+    def set(self, key: str, model: str, value: str) -> None:
+        """Stores a value, then evicts expired and least recently used entries."""
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, model, value, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, model, value, now, now),
+            )
+            conn.execute("DELETE FROM llm_cache WHERE created_at <= ?", (now - self.ttl,))
+            conn.execute(
+                """
+                DELETE FROM llm_cache WHERE key IN (
+                    SELECT key FROM llm_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_entries,),
+            )
+
+
+response_cache = ResponseCache()
+
+
+def _mark_cache_hit() -> None:
+    current = current_span()
+    if current is not None:
+        current.add("cache_hits")
+
+
+def _estimated_tokens(kwargs: Dict[str, Any]) -> int:
+    """What a request counts against the token limit: its prompt plus the most tokens it may generate."""
+    from label_prompt import count_tokens
+
+    prompt = sum(count_tokens(str(message.get("content") or "")) for message in kwargs.get("messages", []))
+    return prompt + (kwargs.get("max_tokens") or 0)
+
+
+def create_chat_completion(client, **kwargs):
+    """
+    Calls `client.chat.completions.create` once the model's rate limits allow it.
+
+    The raw response is requested so the `x-ratelimit-*` headers can update the
+    scheduler's budgets; a 429 blocks the model's budgets for as long as its
+    `retry-after` says before the error is re-raised for the caller to retry.
+
+    Args:
+        client (OpenAI): The OpenAI client.
+        **kwargs: The arguments for `chat.completions.create`.
+
+    Returns:
+        ChatCompletion: The API response.
+    """
+    limiter = get_rate_limiter()
+    model = kwargs["model"]
+    limiter.acquire_openai(model, _estimated_tokens(kwargs))
+    try:
+        raw = client.chat.completions.with_raw_response.create(**kwargs)
+    except Exception as e:
+        response = getattr(e, "response", None)
+        if response is not None:
+            limiter.observe_openai(model, response.status_code, response.headers)
+        raise
+    limiter.observe_openai(model, raw.status_code, raw.headers)
+    response = raw.parse()
+    record_usage(response)
+    return response
+
+
+def cached_chat_completion(client, cache: bool = True, **kwargs):
+    """
+    Calls `client.chat.completions.create`, serving repeated identical requests from the cache.
+
+    Only worth using for deterministic calls (temperature 0 and a fixed seed).
+
+    Args:
+        client (OpenAI): The OpenAI client.
+        cache (bool, optional): Set to False to always call the API. Defaults to True.
+        **kwargs: The arguments for `chat.completions.create`.
+
+    Returns:
+        ChatCompletion: The API or cached response.
+    """
+    if not cache or LLM_CACHE_DISABLED:
+        return create_chat_completion(client, **kwargs)
+
+    from openai.types.chat import ChatCompletion
+
+    params = {name: value for name, value in kwargs.items() if name not in ("model", "messages")}
+    key = response_cache.key(kwargs["model"], kwargs["messages"], params)
+    try:
+        cached = response_cache.get(key)
+    except sqlite3.Error as e:
+        logging.error(f"LLM cache read failed: {e}")
+        cached = None
+    if cached is not None:
+        logging.info(f"LLM cache hit: {kwargs['model']} {key[:12]}")
+        _mark_cache_hit()
+        return ChatCompletion.model_validate_json(cached)
+
+    response = create_chat_completion(client, **kwargs)
+    try:
+        response_cache.set(key, kwargs["model"], response.model_dump_json())
+    except sqlite3.Error as e:
+        logging.error(f"LLM cache write failed: {e}")
+    return response
+
+
+def _run_prompt(model, prompt: str, **options) -> str:
+    """
+    Runs an `llm` model prompt once the model's rate limits allow it.
+
+    `llm` doesn't expose the response headers, so only a 429 updates the budgets.
+    """
+    limiter = get_rate_limiter()
+    limiter.acquire_openai(model.model_id, _estimated_tokens({"messages": [{"content": prompt}], "max_tokens": options.get("max_tokens")}))
+    try:
+        response = model.prompt(prompt, **options)
+        text = response.text()
+    except Exception as e:
+        error_response = getattr(e, "response", None)
+        if error_response is not None:
+            limiter.observe_openai(model.model_id, error_response.status_code, error_response.headers)
+        raise
+    record_llm_usage(response)
+    return text
+
+
+def cached_prompt(model, prompt: str, cache: bool = True, **options) -> str:
+    """
+    Runs an `llm` model prompt and returns its text, serving repeated identical prompts from the cache.
+
+    Args:
+        model (llm.Model): The `llm` model.
+        prompt (str): The prompt.
+        cache (bool, optional): Set to False to always call the model. Defaults to True.
+        **options: The model options, such as temperature.
+
+    Returns:
+        str: The response text.
+    """
+    if not cache or LLM_CACHE_DISABLED:
+        return _run_prompt(model, prompt, **options)
+
+    key = response_cache.key(model.model_id, [{"role": "user", "content": prompt}], options)
+    try:
+        cached = response_cache.get(key)
+    except sqlite3.Error as e:
+        logging.error(f"LLM cache read failed: {e}")
+        cached = None
+    if cached is not None:
+        logging.info(f"LLM cache hit: {model.model_id} {key[:12]}")
+        _mark_cache_hit()
+        return json.loads(cached)
+
+    text = _run_prompt(model, prompt, **options)
+    try:
+        response_cache.set(key, model.model_id, json.dumps(text))
+    except sqlite3.Error as e:
+        logging.error(f"LLM cache write failed: {e}")
+    return text
@@ -1,18 +1,29 @@
 (define-command-global send-snippet-to-gh-issue
     nil
-  "Sends URL, title, and selected text to a new GitHub issue using github_issues.py."
+  "Sends URL, title, and selected text to the bookmark server started with bookmark_server.py."
   (let* ((title (title (current-buffer)))
          (myurl (quri:render-uri (url (current-buffer))))
          (selection
           (ps-eval
             (parenscript:chain window (get-selection) (to-string))))
-         (escaped-selection (uiop/launch-program:escape-sh-token selection))
          (repo "irthomasthomas/undecidability")
-         (python-script
-          "/home/thomas/Development/LLMs/label-maker/github_issues.py")
-         (python-interpreter
-          "/home/thomas/Development/Projects/llm/.venv/bin/python3")
+         (server-url "http://127.0.0.1:8765/bookmark")
+         (token
+          (string-trim '(#\Space #\Newline #\Return)
+                       (uiop:read-file-string
+                        (merge-pathnames ".cache/label-maker/server_token" (user-homedir-pathname)))))
+         (payload
+          (njson:encode
+           (alexandria:alist-hash-table
+            `(("title" . ,title)
+              ("url" . ,myurl)
+              ("snippet" . ,selection)
+              ("repo" . ,repo))
+            :test 'equal)))
          (command
-          (list python-interpreter python-script  "--title" title "--url" myurl
-                "--snippet" escaped-selection "--repo" repo "--embedding_db" "undecidability_gh_issues.db")))
-    (uiop/run-program:run-program command :output t)))
\ No newline at end of file
+          (list "curl" "--silent" "--show-error"
+                "--header" "Content-Type: application/json"
+                "--header" (format nil "X-Label-Maker-Token: ~a" token)
+                "--data-binary" payload
+                server-url)))
+    (uiop:launch-program command)))
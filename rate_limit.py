@@ -0,0 +1,398 @@
+import os
+import re
+import json
+import time
+import logging
+import argparse
+import threading
+import contextvars
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Dict, Iterator, Mapping, Optional
+
+from tracing import current_span
+
+# Priority classes, most urgent first. A bookmark being captured is interactive;
+# syncs, refreshes, bulk labeling and background revalidation are bulk.
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+# The share of a bucket's burst that bulk requests leave for interactive ones.
+BULK_RESERVE = float(os.getenv("LABEL_MAKER_BULK_RESERVE", "0.2"))
+# The share of a limit that may be spent in one burst before requests are spaced out.
+BURST_FRACTION = 0.1
+# A throttled GitHub request is retried if the wait is at most this many seconds, otherwise its response is returned.
+GITHUB_MAX_RATE_LIMIT_WAIT = float(os.getenv("LABEL_MAKER_MAX_RATE_LIMIT_WAIT", "60"))
+GITHUB_RATE_LIMIT_RETRIES = 2
+
+_priority: contextvars.ContextVar[int] = contextvars.ContextVar("request_priority", default=INTERACTIVE)
+
+
+@contextmanager
+def request_priority(priority: int) -> Iterator[None]:
+    """
+    Runs the block's API requests at the given priority.
+
+    The priority is a context variable, so it follows the stages and fan-outs
+    that copy the caller's context (run_pipeline, map_concurrent). It can also
+    decorate a function, e.g. `@request_priority(BULK)`.
+    """
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    """
+    The request (or token) budget of one rate-limited endpoint.
+
+    Until the server reports a limit the bucket never delays a request. Once it
+    has, up to a tenth of the limit may be spent at once, and the rest is spaced
+    out so it lasts until the limit resets: evenly over what is left of a fixed
+    window (GitHub), or at the rate the budget replenishes (OpenAI). A
+    `Retry-After` or an exhausted budget blocks the bucket until it reopens.
+
+    Waiting interactive requests always go first, and bulk requests leave
+    BULK_RESERVE of the burst untouched for them.
+    """
+
+    def __init__(self, name: str, period: float, fixed_window: bool = False):
+        """
+        Args:
+            name (str): The bucket name, e.g. "github:core" or "openai:gpt-3.5-turbo:tokens".
+            period (float): The length of the limit's window in seconds, e.g. 3600 for GitHub's hourly limit.
+            fixed_window (bool, optional): Whether the whole budget comes back at once when the window resets. Defaults to False.
+        """
+        self.name = name
+        self.period = period
+        self.fixed_window = fixed_window
+        self.limit: Optional[float] = None
+        self.remaining: Optional[float] = None
+        self.capacity = 0.0
+        self.tokens = 0.0
+        self.rate = 0.0
+        self.reset_at: Optional[float] = None
+        self.blocked_until = 0.0
+        self.updated = time.monotonic()
+        self.waiting = {priority: 0 for priority in PRIORITY_NAMES}
+        self.acquired = 0
+        self.delayed = 0
+        self.waited = 0.0
+        self.throttled = 0
+        self._cond = threading.Condition()
+
+    def _refill(self, now: float) -> None:
+        if self.reset_at is not None and now >= self.reset_at:
+            # The window has reset: the full budget is back, spread over a whole window until the server says otherwise.
+            self.reset_at = None
+            self.remaining = self.limit
+            self.rate = self.limit / self.period
+            if self.fixed_window:
+                self.tokens = self.capacity
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def observe(self, limit: float, remaining: float, reset_in: float) -> None:
+        """
+        Updates the budget from the limit, remaining budget and time to reset reported by the server.
+
+        Args:
+            limit (float): The size of the budget per window.
+            remaining (float): What is left of it.
+            reset_in (float): Seconds until it resets (fixed window) or is fully replenished.
+        """
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            first = self.limit is None
+            self.limit, self.remaining = limit, remaining
+            self.capacity = max(1.0, limit * BURST_FRACTION)
+            # The first response grants a full burst; after that, spent tokens stay spent and only the rate refills them.
+            self.tokens = min(self.capacity if first else self.tokens, self.capacity, remaining)
+            if reset_in <= 0:
+                self.rate, self.reset_at = limit / self.period, None
+            elif self.fixed_window:
+                # What is left after the burst lasts until the reset.
+                self.rate, self.reset_at = max(remaining - self.tokens, 0.0) / reset_in, now + reset_in
+            else:
+                self.rate, self.reset_at = max(limit - remaining, 1.0) / reset_in, now + reset_in
+            if remaining <= 0 and reset_in > 0:
+                self.blocked_until = max(self.blocked_until, now + reset_in)
+            self._cond.notify_all()
+
+    def block(self, seconds: float) -> None:
+        """Holds every request for `seconds`, after the server throttled one."""
+        with self._cond:
+            now = time.monotonic()
+            self.blocked_until = max(self.blocked_until, now + seconds)
+            self.tokens = min(self.tokens, 0.0)
+            self.throttled += 1
+            self._cond.notify_all()
+
+    def blocked_for(self) -> float:
+        """Seconds until the bucket lets requests through again."""
+        with self._cond:
+            return max(0.0, self.blocked_until - time.monotonic())
+
+    def acquire(self, cost: float = 1, priority: Optional[int] = None) -> float:
+        """
+        Waits until the budget allows a request, then spends `cost` of it.
+
+        Args:
+            cost (float, optional): What the request costs, e.g. its estimated tokens. Defaults to 1.
+            priority (Optional[int], optional): INTERACTIVE or BULK. Defaults to the priority of the current context.
+
+        Returns:
+            float: The seconds spent waiting.
+        """
+        priority = _priority.get() if priority is None else priority
+        started = time.monotonic()
+        with self._cond:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if now < self.blocked_until:
+                        delay = self.blocked_until - now
+                    elif any(self.waiting[other] for other in self.waiting if other < priority):
+                        delay = 1.0  # woken as soon as the more urgent requests are through
+                    elif self.limit is None:
+                        break
+                    else:
+                        reserve = self.capacity * BULK_RESERVE if priority > INTERACTIVE else 0.0
+                        needed = min(cost + reserve, self.capacity)
+                        if self.tokens >= needed:
+                            break
+                        delay = (needed - self.tokens) / self.rate if self.rate > 0 else 1.0
+                    self._cond.wait(min(delay, 5.0))
+                # A request costing more than the burst is let through once the bucket is full and repaid by waiting later.
+                self.tokens -= cost if self.limit is not None else 0
+                if self.remaining is not None:
+                    self.remaining -= cost
+                waited = time.monotonic() - started
+                self.acquired += 1
+                if waited > 0.001:
+                    self.delayed += 1
+                    self.waited += waited
+                return waited
+            finally:
+                self.waiting[priority] -= 1
+                self._cond.notify_all()
+
+    def metrics(self) -> Dict[str, Any]:
+        """Returns the bucket's current budget, queue depth and counters."""
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            return {
+                "limit": self.limit,
+                "remaining": None if self.remaining is None else round(max(self.remaining, 0)),
+                "burst_available": round(self.tokens, 2) if self.limit is not None else None,
+                "rate_per_second": round(self.rate, 4) if self.limit is not None else None,
+                "reset_in": round(self.reset_at - now, 1) if self.reset_at else None,
+                "blocked_for": round(max(0.0, self.blocked_until - now), 1),
+                "queued": {PRIORITY_NAMES[priority]: count for priority, count in self.waiting.items()},
+                "requests": self.acquired,
+                "delayed": self.delayed,
+                "seconds_waited": round(self.waited, 3),
+                "throttled": self.throttled,
+            }
+
+
+def _lower(headers: Mapping[str, str]) -> Dict[str, str]:
+    """Lower-cases header names, for lookups that work on plain dicts as well as case-insensitive ones."""
+    return {name.lower(): value for name, value in headers.items()}
+
+
+def _header(headers: Mapping[str, str], name: str) -> Optional[str]:
+    value = headers.get(name)
+    return value if value not in (None, "") else None
+
+
+def _duration(value: str) -> float:
+    """Parses OpenAI's reset durations, e.g. "1s", "6m0s", "20ms" or "1h2m3.5s", into seconds."""
+    seconds = 0.0
+    for amount, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value):
+        seconds += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return seconds
+
+
+def retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    """Returns the seconds a `Retry-After` (or OpenAI's `retry-after-ms`) header asks to wait, if any."""
+    headers = _lower(headers)
+    value = _header(headers, "retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = _header(headers, "retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+def github_resource(path: str) -> str:
+    """Guesses the GitHub rate limit resource a request counts against, as named by `X-RateLimit-Resource`."""
+    path = re.sub(r"^https?://[^/]+", "", path)
+    if path.startswith("/graphql"):
+        return "graphql"
+    if path.startswith("/search/code"):
+        return "code_search"
+    if path.startswith("/search/"):
+        return "search"
+    return "core"
+
+
+class RateLimiter:
+    """
+    The process-wide scheduler of GitHub and OpenAI requests, one TokenBucket per rate-limited endpoint.
+    """
+
+    def __init__(self):
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, name: str, period: float = 60, fixed_window: bool = False) -> TokenBucket:
+        with self._lock:
+            if name not in self._buckets:
+                self._buckets[name] = TokenBucket(name, period, fixed_window)
+            return self._buckets[name]
+
+    def _acquire(self, bucket: TokenBucket, cost: float = 1) -> float:
+        waited = bucket.acquire(cost)
+        if waited > 0.001:
+            logging.info(f"Rate limit: waited {waited:.2f}s for {bucket.name}")
+            current = current_span()
+            if current is not None:
+                current.add("rate_limit_wait", round(waited, 3))
+        return waited
+
+    def _github_bucket(self, resource: str) -> TokenBucket:
+        # GitHub's search limits are per minute, the others per hour, and all reset at once.
+        return self.bucket(f"github:{resource}", 60 if resource.endswith("search") else 3600, fixed_window=True)
+
+    def acquire_github(self, path: str) -> float:
+        """Waits for the budget of the GitHub resource `path` counts against. Returns the seconds waited."""
+        return self._acquire(self._github_bucket(github_resource(path)))
+
+    def observe_github(self, path: str, status_code: int, headers: Mapping[str, str]) -> Optional[float]:
+        """
+        Updates the budget from a GitHub response's `X-RateLimit-*` and `Retry-After` headers.
+
+        Returns:
+            Optional[float]: The seconds to wait before retrying if the request was rate limited, else None.
+        """
+        headers = _lower(headers)
+        bucket = self._github_bucket(_header(headers, "x-ratelimit-resource") or github_resource(path))
+        limit, remaining, reset = (_header(headers, f"x-ratelimit-{name}") for name in ("limit", "remaining", "reset"))
+        if limit is not None and remaining is not None and reset is not None:
+            bucket.observe(float(limit), float(remaining), max(0.0, float(reset) - time.time()))
+        if status_code not in (403, 429):
+            return None
+        wait = retry_after(headers)
+        if wait is None and remaining == "0" and reset is not None:
+            wait = max(0.0, float(reset) - time.time())
+        if wait is None:
+            return None  # a 403 that is not about rate limits
+        bucket.block(wait)
+        return wait
+
+    def _openai_buckets(self, model: str):
+        return self.bucket(f"openai:{model}:requests"), self.bucket(f"openai:{model}:tokens")
+
+    def acquire_openai(self, model: str, tokens: float) -> float:
+        """Waits for the request and token budget of an OpenAI model. Returns the seconds waited."""
+        requests, token_bucket = self._openai_buckets(model)
+        return self._acquire(requests) + self._acquire(token_bucket, tokens)
+
+    def observe_openai(self, model: str, status_code: int, headers: Mapping[str, str]) -> Optional[float]:
+        """
+        Updates the budgets from an OpenAI response's `x-ratelimit-*` and `retry-after` headers.
+
+        Returns:
+            Optional[float]: The seconds to wait before retrying if the request was rate limited, else None.
+        """
+        headers = _lower(headers)
+        buckets = dict(zip(("requests", "tokens"), self._openai_buckets(model)))
+        for kind, bucket in buckets.items():
+            limit, remaining, reset = (_header(headers, f"x-ratelimit-{name}-{kind}") for name in ("limit", "remaining", "reset"))
+            if limit is not None and remaining is not None:
+                bucket.observe(float(limit), float(remaining), _duration(reset) if reset else 0.0)
+        if status_code != 429:
+            return None
+        wait = retry_after(headers) or 1.0
+        for bucket in buckets.values():
+            bucket.block(wait)
+        return wait
+
+    def metrics(self) -> Dict[str, Dict[str, Any]]:
+        """Returns the budget, queue depth and counters of every bucket, keyed by bucket name."""
+        with self._lock:
+            buckets = dict(self._buckets)
+        return {name: bucket.metrics() for name, bucket in sorted(buckets.items())}
+
+
+_limiter: Optional[RateLimiter] = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    """Returns the process-wide RateLimiter, creating it on first use."""
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter()
+        return _limiter
+
+
+def is_rate_limited(error: Optional[BaseException]) -> bool:
+    """Whether an exception is an HTTP 429 from an API client, such as openai.RateLimitError."""
+    response = getattr(error, "response", None)
+    return getattr(error, "status_code", None) == 429 or getattr(response, "status_code", None) == 429
+
+
+def wait_unless_rate_limited(fallback: Callable[[Any], float]) -> Callable[[Any], float]:
+    """
+    A tenacity wait strategy that retries rate limited calls without sleeping.
+
+    The scheduler already holds the next attempt until the endpoint's budget
+    reopens, so backing off on top of that would only waste time. Other
+    failures wait as `fallback` says.
+
+    Args:
+        fallback (Callable[[Any], float]): The wait strategy for other failures, e.g. wait_random_exponential().
+    """
+    def wait(retry_state: Any) -> float:
+        outcome = retry_state.outcome
+        if outcome is not None and outcome.failed and is_rate_limited(outcome.exception()):
+            return 0.0
+        return fallback(retry_state)
+    return wait
+
+
+parser = argparse.ArgumentParser(description="Show GitHub's current rate limits, as the scheduler would see them.")
+
+
+if __name__ == "__main__":
+    parser.parse_args()
+    from gh_client import get_github_client
+
+    # /rate_limit itself doesn't count against any limit.
+    client = get_github_client()
+    response = client.get("/rate_limit")
+    response.raise_for_status()
+    limiter = client.limiter
+    for resource, limits in response.json().get("resources", {}).items():
+        limiter._github_bucket(resource).observe(limits["limit"], limits["remaining"], max(0.0, limits["reset"] - time.time()))
+    print(json.dumps(limiter.metrics(), indent=4))
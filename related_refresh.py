@@ -0,0 +1,393 @@
+import json
+import time
+import sqlite3
+import logging
+import argparse
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+from gh_client import get_github_client
+from issue_hydration import hydrate_issues
+from rate_limit import BULK, request_priority
+from repo_shards import Shard, ShardHit, load_shards, shard_database
+from tracing import span, traced
+
+RELATED_THRESHOLD = 0.80
+RELATED_TOP_K = 6
+# How many hits of a new issue are checked for entering other issues' top k. An
+# issue further down its list than this is assumed to have closer neighbours.
+RELATED_CANDIDATES = 64
+RELATED_REFRESH_WORKERS = 4
+RELATED_HEADING = "### Related content"
+
+RELATED_SCHEMA = """
+CREATE TABLE IF NOT EXISTS related_sets (
+    collection TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    neighbours TEXT NOT NULL,
+    comment_id INTEGER,
+    pending INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL,
+    cross_repo TEXT,
+    PRIMARY KEY (collection, number)
+);
+CREATE INDEX IF NOT EXISTS idx_related_sets_pending ON related_sets (collection, pending);
+CREATE TABLE IF NOT EXISTS related_state (
+    collection TEXT PRIMARY KEY,
+    last_updated INTEGER
+);
+"""
+
+Neighbours = List[Tuple[int, float]]
+# Neighbours in other repositories, as [repo, number, score].
+CrossRepoNeighbours = List[Tuple[str, int, float]]
+
+
+class RefreshReport(NamedTuple):
+    """What a refresh looked at and changed."""
+    scanned: int
+    recomputed: int
+    changed: int
+    published: int
+    failed: int
+
+
+def format_related_comment(related: Iterable[Tuple[Any, Dict[str, Any]]], repo: Optional[str] = None) -> str:
+    """
+    Formats the "Related content" comment of an issue.
+
+    Args:
+        related (Iterable[Tuple[Any, Dict[str, Any]]]): (search hit, issue) pairs, most similar first.
+            Hits need `id` and `score`, and a `repo` if they may be in another repository;
+            issues need `title` and `body`.
+        repo (Optional[str], optional): The repository of the commented issue. Hits in other
+            repositories are linked as owner/repo#number. Defaults to None.
+
+    Returns:
+        str: The comment markdown.
+    """
+    comment = f"{RELATED_HEADING}\n"
+    for item, entry in related:
+        other = getattr(item, "repo", None)
+        reference = f"{other}#{item.id}" if other and other != repo else f"#{item.id}"
+        comment += f"""### {reference}: {entry['title']}
+<details><summary>### Details</summary>Similarity score: {round(item.score, 2)}\n{entry['body']}</details>\n
+"""
+    return comment
+
+
+def _setup(conn: sqlite3.Connection) -> None:
+    conn.executescript(RELATED_SCHEMA)
+    if "cross_repo" not in {row[1] for row in conn.execute("PRAGMA table_info(related_sets)")}:
+        conn.execute("ALTER TABLE related_sets ADD COLUMN cross_repo TEXT")
+
+
+def _write_set(conn: sqlite3.Connection, collection: str, number: int, neighbours: Neighbours,
+               comment_id: Optional[int], pending: bool, cross_repo: Optional[CrossRepoNeighbours] = None) -> None:
+    """Stores an issue's neighbour set. `cross_repo` None keeps the stored cross-repository neighbours."""
+    conn.execute(
+        """
+        INSERT OR REPLACE INTO related_sets (collection, number, neighbours, comment_id, pending, updated_at, cross_repo)
+        VALUES (?, ?, ?, ?, ?, ?, COALESCE(?, (SELECT cross_repo FROM related_sets WHERE collection = ? AND number = ?)))
+        """,
+        (collection, number, json.dumps([[n, round(s, 4)] for n, s in neighbours]), comment_id, int(pending), time.time(),
+         json.dumps([[r, n, round(s, 4)] for r, n, s in cross_repo]) if cross_repo else None, collection, number),
+    )
+
+
+def _post_comment(repo: str, number: int, body: str) -> Optional[int]:
+    response = get_github_client().post(f"/repos/{repo}/issues/{number}/comments", data={"body": body})
+    if not response.ok:
+        logging.error(f"Failed to add related comment to #{number}: {response.text}")
+        return None
+    return response.json()["id"]
+
+
+def _find_comment(repo: str, number: int) -> Optional[int]:
+    """Finds a related comment posted before comment ids were recorded."""
+    found = None
+    try:
+        for comment in get_github_client().paginate(f"/repos/{repo}/issues/{number}/comments"):
+            if (comment.get("body") or "").startswith(RELATED_HEADING):
+                found = comment["id"]
+    except Exception as e:
+        logging.error(f"Failed to list comments of #{number}: {e}")
+    return found
+
+
+def _edit_comment(repo: str, number: int, comment_id: Optional[int], body: str) -> Optional[int]:
+    """Rewrites an issue's related comment in place, posting one if it has none. Returns its id."""
+    if comment_id is None:
+        comment_id = _find_comment(repo, number)
+    if comment_id is not None:
+        response = get_github_client().patch(f"/repos/{repo}/issues/comments/{comment_id}", data={"body": body})
+        if response.ok:
+            return comment_id
+        if response.status_code != 404:
+            logging.error(f"Failed to update related comment on #{number}: {response.text}")
+            return None
+    return _post_comment(repo, number, body)
+
+
+@traced("comment")
+def publish_related(repo: str, number: int, related: Sequence[Tuple[Any, Dict[str, Any]]], database: str,
+                    collection: str) -> bool:
+    """
+    Posts the related comment of a new issue and records its neighbour set.
+
+    If the comment can't be posted, the set is stored as pending so the next
+    refresh posts it. Hits in other repositories are kept apart from the set:
+    refreshes recompute the neighbours within `collection` and keep the
+    cross-repository ones as they were found.
+
+    Args:
+        repo (str): The name of the repository including the owner.
+        number (int): The new issue's number.
+        related (Sequence[Tuple[Any, Dict[str, Any]]]): (search hit, issue) pairs, most similar first.
+            Hits with a `repo` other than `repo` are in another repository.
+        database (str): The path to the SQLite database file.
+        collection (str): The name of the collection the repository's own hits came from.
+
+    Returns:
+        bool: True if the comment was posted or there was nothing to post.
+    """
+    related = list(related)[:RELATED_TOP_K]
+    comment_id = _post_comment(repo, number, format_related_comment(related, repo)) if related else None
+    neighbours = [(int(item.id), item.score) for item, entry in related if getattr(item, "repo", repo) == repo]
+    cross_repo = [(item.repo, int(item.id), item.score) for item, entry in related if getattr(item, "repo", repo) != repo]
+    with sqlite3.connect(database, timeout=30) as conn:
+        _setup(conn)
+        _write_set(conn, collection, number, neighbours, comment_id, pending=bool(related) and comment_id is None,
+                   cross_repo=cross_repo)
+    return not related or comment_id is not None
+
+
+def _vectors(conn: sqlite3.Connection, collection: str, ids: Sequence[str], chunk_size: int = 500):
+    import numpy as np
+
+    found: Dict[str, bytes] = {}
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        found.update(conn.execute(
+            f"""
+            SELECT embeddings.id, embeddings.embedding
+            FROM embeddings JOIN collections ON collections.id = embeddings.collection_id
+            WHERE collections.name = ? AND embeddings.id IN ({','.join('?' * len(chunk))})
+            """,
+            [collection, *chunk],
+        ).fetchall())
+    ids = [id for id in ids if id in found]
+    if not ids:
+        return ids, np.zeros((0, 0), dtype=np.float32)
+    return ids, np.frombuffer(b"".join(found[id] for id in ids), dtype="<f4").reshape(len(ids), -1)
+
+
+def _top_k(number: int, hits: Iterable[Tuple[int, float]], top_k: int, threshold: float) -> Neighbours:
+    best: Dict[int, float] = {}
+    for other, score in hits:
+        if other != number and score > threshold:
+            best[other] = max(score, best.get(other, score))
+    # Scores are compared as stored, so ties between identical issues order the same way on every run.
+    return sorted(best.items(), key=lambda hit: (-round(hit[1], 4), hit[0]))[:top_k]
+
+
+def compute_changes(conn: sqlite3.Connection, database: str, collection: str, top_k: int = RELATED_TOP_K,
+                    threshold: float = RELATED_THRESHOLD, index_kind: Optional[str] = None,
+                    batch_size: int = 256) -> Tuple[Dict[int, Neighbours], Set[int], Optional[int], int, int]:
+    """
+    Works out which issues' neighbour sets changed since the last refresh.
+
+    Only issues whose embedding changed, and issues whose stored set contains a
+    changed or deleted issue, are searched again. Every other issue can only gain
+    a new issue as a neighbour, which is read off the new issues' own hits.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the issues database.
+        database (str): The path to the same database, for the similarity index.
+        collection (str): The name of the collection in the database.
+        top_k (int, optional): The neighbours kept per issue. Defaults to RELATED_TOP_K.
+        threshold (float, optional): The minimum similarity of a neighbour. Defaults to RELATED_THRESHOLD.
+        index_kind (Optional[str], optional): The similarity index to search. Defaults to $LABEL_MAKER_INDEX_KIND.
+        batch_size (int, optional): Issues searched per batch. Defaults to 256.
+
+    Returns:
+        Tuple: The new sets of the issues whose neighbours changed, the numbers of deleted
+        issues, the new watermark, and how many issues were scanned and searched.
+    """
+    from similarity_index import _collection_rows, get_index
+
+    _setup(conn)
+    stored: Dict[int, Neighbours] = {
+        number: [tuple(hit) for hit in json.loads(neighbours)]
+        for number, neighbours in conn.execute("SELECT number, neighbours FROM related_sets WHERE collection = ?", (collection,))
+    }
+    row = conn.execute("SELECT last_updated FROM related_state WHERE collection = ?", (collection,)).fetchone()
+    watermark = row[0] if row else None
+
+    current = {
+        int(id) for (id,) in conn.execute(
+            "SELECT embeddings.id FROM embeddings JOIN collections ON collections.id = embeddings.collection_id WHERE collections.name = ?",
+            (collection,),
+        ) if str(id).isdigit()
+    }
+    changed: Set[int] = set()
+    last_updated = watermark
+    for ids, matrix, updated in _collection_rows(conn, collection, updated_after=watermark):
+        changed.update(int(id) for id in ids if str(id).isdigit())
+        last_updated = max(last_updated or 0, updated)
+    if last_updated is not None:
+        # `updated` is in whole seconds, so rows can still be written with the current second's
+        # timestamp; stopping the watermark short of it reads them on the next run.
+        last_updated = min(last_updated, int(time.time()) - 1)
+    deleted = set(stored) - current
+
+    stale = changed | deleted
+    recompute = sorted(changed | {number for number, neighbours in stored.items()
+                                  if number in current and any(other in stale for other, score in neighbours)})
+    index = get_index(database, collection, index_kind)
+    new_sets: Dict[int, Neighbours] = {}
+    gained: Dict[int, List[Tuple[int, float]]] = {}
+
+    def search(numbers: List[int]) -> None:
+        for start in range(0, len(numbers), batch_size):
+            ids, matrix = _vectors(conn, collection, [str(number) for number in numbers[start:start + batch_size]])
+            if not ids:
+                continue
+            for id, hits in zip(ids, index.search_batch(matrix, RELATED_CANDIDATES + 1)):
+                number = int(id)
+                hits = [(int(hit.id), hit.score) for hit in hits if str(hit.id).isdigit()]
+                new_sets[number] = _top_k(number, hits, top_k, threshold)
+                if number in changed:
+                    for other, score in hits:
+                        if other != number and score > threshold:
+                            gained.setdefault(other, []).append((number, score))
+
+    search(recompute)
+    # Issues a new issue entered the neighbourhood of, but with no stored set to merge into.
+    search([number for number in gained if number not in new_sets and number not in stored and number in current])
+    for number, hits in gained.items():
+        if number not in new_sets and number in stored:
+            new_sets[number] = _top_k(number, stored[number] + hits, top_k, threshold)
+
+    changes = {
+        number: neighbours for number, neighbours in new_sets.items()
+        if [other for other, score in neighbours] != [other for other, score in stored.get(number, [])]
+        or number not in stored
+    }
+    return changes, deleted, last_updated, len(changed), len(recompute)
+
+
+def _publish(repo: str, database: str, collection: str, workers: int, shards: Sequence[Shard] = ()) -> Tuple[int, int]:
+    with sqlite3.connect(database, timeout=30) as conn:
+        _setup(conn)
+        rows = conn.execute(
+            "SELECT number, neighbours, comment_id, cross_repo FROM related_sets WHERE collection = ? AND pending = 1", (collection,)
+        ).fetchall()
+    if not rows:
+        return 0, 0
+    pending = [(number, json.loads(neighbours), comment_id) for number, neighbours, comment_id, cross_repo in rows]
+    cross_repo = {number: json.loads(others) for number, neighbours, comment_id, others in rows if others}
+    wanted: Dict[str, Set[int]] = {repo: {other for number, neighbours, comment_id in pending for other, score in neighbours}}
+    for others in cross_repo.values():
+        for other_repo, other, score in others:
+            wanted.setdefault(other_repo, set()).add(other)
+    # Issues of other repositories are read from their own shard's database, or fetched if it isn't known.
+    issues = {
+        other_repo: hydrate_issues(other_repo, numbers, database if other_repo == repo else shard_database(shards, other_repo))
+        for other_repo, numbers in wanted.items()
+    }
+
+    def publish(job: Tuple[int, Neighbours, Optional[int]]) -> Optional[int]:
+        number, neighbours, comment_id = job
+        hits = [ShardHit(str(other), score, repo) for other, score in neighbours]
+        hits += [ShardHit(str(other), score, other_repo) for other_repo, other, score in cross_repo.get(number, [])]
+        hits.sort(key=lambda hit: -hit.score)
+        related = [(hit, issues[hit.repo][int(hit.id)]) for hit in hits if int(hit.id) in issues[hit.repo]][:RELATED_TOP_K]
+        return _edit_comment(repo, number, comment_id, format_related_comment(related, repo))
+
+    with span("related_publish", issues=len(pending)):
+        comment_ids = get_github_client().map_concurrent(publish, pending, max_workers=workers)
+    with sqlite3.connect(database, timeout=30) as conn:
+        for (number, neighbours, old_comment_id), comment_id in zip(pending, comment_ids):
+            if comment_id is not None:
+                conn.execute(
+                    "UPDATE related_sets SET comment_id = ?, pending = 0 WHERE collection = ? AND number = ?",
+                    (comment_id, collection, number),
+                )
+    published = sum(1 for comment_id in comment_ids if comment_id is not None)
+    return published, len(pending) - published
+
+
+@traced("related_refresh")
+@request_priority(BULK)
+def refresh_related(repo: str, database: str, collection: str = "gh-issues", top_k: int = RELATED_TOP_K,
+                    threshold: float = RELATED_THRESHOLD, workers: int = RELATED_REFRESH_WORKERS,
+                    index_kind: Optional[str] = None, dry_run: bool = False, shards: Sequence[Shard] = ()) -> RefreshReport:
+    """
+    Brings the "Related content" comments up to date with the embeddings added since the last run.
+
+    The first run only records every issue's neighbour set, since the existing
+    comments were written when their issues were created. Later runs edit the
+    comment of each issue whose neighbours changed in place, at most `workers`
+    at a time. Comments that fail to update stay pending and are retried on the
+    next run. Neighbours in other repositories, recorded when the issue was
+    created, are kept in the rewritten comment.
+
+    Args:
+        repo (str): The name of the repository including the owner.
+        database (str): The path to the SQLite database file.
+        collection (str, optional): The name of the collection in the database. Defaults to "gh-issues".
+        top_k (int, optional): The neighbours listed per issue. Defaults to RELATED_TOP_K.
+        threshold (float, optional): The minimum similarity of a neighbour. Defaults to RELATED_THRESHOLD.
+        workers (int, optional): The number of comments updated concurrently. Defaults to RELATED_REFRESH_WORKERS.
+        index_kind (Optional[str], optional): The similarity index to search. Defaults to $LABEL_MAKER_INDEX_KIND.
+        dry_run (bool, optional): Only report which issues changed. Defaults to False.
+        shards (Sequence[Shard], optional): The repository shards, to read cross-repository
+            neighbours locally instead of fetching them. Defaults to ().
+
+    Returns:
+        RefreshReport: What was scanned, recomputed, changed and published.
+    """
+    with sqlite3.connect(database, timeout=30) as conn:
+        seeding = not conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'related_state'"
+        ).fetchone() or not conn.execute("SELECT 1 FROM related_state WHERE collection = ?", (collection,)).fetchone()
+        with span("related_diff") as diff_span:
+            changes, deleted, last_updated, scanned, recomputed = compute_changes(conn, database, collection, top_k, threshold, index_kind)
+            diff_span.set(scanned=scanned, recomputed=recomputed, changed=len(changes), deleted=len(deleted))
+        logging.info(f"refresh_related: {scanned} new embeddings, {recomputed} searched, {len(changes)} changed")
+        if dry_run:
+            return RefreshReport(scanned, recomputed, len(changes), 0, 0)
+        comment_ids = dict(conn.execute("SELECT number, comment_id FROM related_sets WHERE collection = ?", (collection,)))
+        for number, neighbours in changes.items():
+            comment_id = comment_ids.get(number)
+            _write_set(conn, collection, number, neighbours, comment_id,
+                       pending=not seeding and (bool(neighbours) or comment_id is not None))
+        conn.executemany(
+            "DELETE FROM related_sets WHERE collection = ? AND number = ?", [(collection, number) for number in deleted]
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO related_state (collection, last_updated) VALUES (?, ?)", (collection, last_updated)
+        )
+    published, failed = _publish(repo, database, collection, workers, shards)
+    return RefreshReport(scanned, recomputed, len(changes), published, failed)
+
+
+parser = argparse.ArgumentParser(description='Update the "Related content" comments whose neighbours changed.')
+parser.add_argument('--repo', metavar='repo', type=str, help='The repo the issues belong to.', default="irthomasthomas/undecidability")
+parser.add_argument('--embedding_db', metavar='embedding_db', type=str, help='The database with the issue embeddings.', default="github-issues.db")
+parser.add_argument('--collection', metavar='collection', type=str, help='The embeddings collection.', default="gh-issues")
+parser.add_argument('--top-k', metavar='top_k', type=int, help='The neighbours listed per issue.', default=RELATED_TOP_K)
+parser.add_argument('--workers', metavar='workers', type=int, help='The number of comments updated concurrently.', default=RELATED_REFRESH_WORKERS)
+parser.add_argument('--index-kind', metavar='index_kind', type=str, help='The similarity index to search.')
+parser.add_argument('--dry-run', action='store_true', help='Only report how many issues changed.')
+parser.add_argument('--shard', metavar='shard', action='append', default=[], help='Another repository shard, as owner/repo[=database[#collection]], for reading cross-repo neighbours.')
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    logging.basicConfig(filename='/tmp/ai_gh_issues.log', level=logging.INFO)
+    shards = load_shards(args.shard, Shard(args.repo, args.embedding_db, args.collection))
+    report = refresh_related(args.repo, args.embedding_db, args.collection, args.top_k, workers=args.workers,
+                             index_kind=args.index_kind, dry_run=args.dry_run, shards=shards)
+    print(f"{report.scanned} new embeddings, {report.recomputed} issues searched, {report.changed} neighbour sets changed, "
+          f"{report.published} comments updated, {report.failed} failed")
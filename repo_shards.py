@@ -0,0 +1,172 @@
+import os
+import json
+import logging
+import argparse
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Sequence
+
+from pipeline import Stage, run_pipeline
+from tracing import current_span
+
+DEFAULT_COLLECTION = "gh-issues"
+# Whitespace-separated shard specs added to every run, e.g. "owner/notes=notes.db".
+SHARDS = os.getenv("LABEL_MAKER_SHARDS", "")
+
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """The thread pool shard searches share, so a search doesn't pay for starting threads."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) + 4), thread_name_prefix="shard-search")
+        return _executor
+
+
+class Shard(NamedTuple):
+    """
+    One repository's issues: its github_issues table, sync state and related sets
+    live in `database`, and its embeddings in `collection`.
+    """
+    repo: str
+    database: str
+    collection: str = DEFAULT_COLLECTION
+
+
+class ShardHit(NamedTuple):
+    """A search hit tagged with the repository it belongs to."""
+    id: str
+    score: float
+    repo: str
+
+
+def default_database(repo: str) -> str:
+    """The database a repository is kept in when its shard spec doesn't name one."""
+    owner, name = repo.split("/", 1)
+    return f"github-issues.{owner}.{name}.db"
+
+
+def parse_shard(spec: str) -> Shard:
+    """
+    Parses a shard spec of the form `owner/repo[=database[#collection]]`.
+
+    Args:
+        spec (str): The spec, e.g. "irthomasthomas/undecidability=github-issues.db#gh-issues".
+
+    Returns:
+        Shard: The shard.
+
+    Raises:
+        ValueError: If the repository is not of the form owner/name.
+    """
+    repo, _, location = spec.strip().partition("=")
+    database, _, collection = location.partition("#")
+    if repo.count("/") != 1 or not all(repo.split("/")):
+        raise ValueError(f"Invalid shard {spec!r}: expected owner/repo[=database[#collection]]")
+    return Shard(repo, database or default_database(repo), collection or DEFAULT_COLLECTION)
+
+
+def load_shards(specs: Iterable[str] = (), primary: Optional[Shard] = None) -> List[Shard]:
+    """
+    Returns the shards to search: the primary one first, then those of `specs` and $LABEL_MAKER_SHARDS.
+
+    Every repository has exactly one shard, and no two repositories share a
+    database, since github_issues and the related sets are keyed by issue number.
+
+    Args:
+        specs (Iterable[str], optional): Shard specs, see parse_shard. Defaults to ().
+        primary (Optional[Shard], optional): The shard of the repository issues are created in. Defaults to None.
+
+    Returns:
+        List[Shard]: The shards, primary first.
+
+    Raises:
+        ValueError: If a repository is given two different shards, or two repositories share a database.
+    """
+    shards = [primary] if primary else []
+    for spec in [*specs, *SHARDS.split()]:
+        shard = parse_shard(spec)
+        if shard in shards:
+            continue
+        for other in shards:
+            if other.repo == shard.repo:
+                raise ValueError(f"{shard.repo} is given two shards: {other.database}#{other.collection} and {shard.database}#{shard.collection}")
+            if os.path.abspath(other.database) == os.path.abspath(shard.database):
+                raise ValueError(f"{other.repo} and {shard.repo} can't share the database {shard.database}")
+        shards.append(shard)
+    return shards
+
+
+def shard_database(shards: Sequence[Shard], repo: str) -> Optional[str]:
+    """Returns the database of a repository's shard, or None if it has none."""
+    return next((shard.database for shard in shards if shard.repo == repo), None)
+
+
+def search_shards(embedding: Any, shards: Sequence[Shard], k: int = 6, index_kind: Optional[str] = None) -> List[ShardHit]:
+    """
+    Searches every shard concurrently and merges the hits by score.
+
+    Each shard has its own cached index, so a repository that is added or
+    written to doesn't invalidate or slow the indexes of the others, and the
+    search takes about as long as the largest shard. A shard that can't be
+    searched is logged and left out.
+
+    Args:
+        embedding (Any): The query embedding.
+        shards (Sequence[Shard]): The shards to search.
+        k (int, optional): The number of hits returned. Defaults to 6.
+        index_kind (Optional[str], optional): The similarity index to search. Defaults to $LABEL_MAKER_INDEX_KIND.
+
+    Returns:
+        List[ShardHit]: The k most similar issues across all shards, most similar first.
+    """
+    from similarity_index import get_index
+
+    sizes: Dict[str, int] = {}
+
+    def search(shard: Shard) -> List[ShardHit]:
+        try:
+            index = get_index(shard.database, shard.collection, index_kind)
+            sizes[shard.repo] = len(index)
+            return [ShardHit(hit.id, hit.score, shard.repo) for hit in index.search(embedding, k)]
+        except Exception as e:
+            logging.error(f"Failed to search {shard.repo} ({shard.database}#{shard.collection}): {e}")
+            return []
+
+    if len(shards) == 1:
+        hits = search(shards[0])
+    else:
+        # numpy releases the GIL while scoring, so the shards are really searched side by side.
+        futures = [_get_executor().submit(contextvars.copy_context().run, search, shard) for shard in shards]
+        hits = [hit for future in futures for hit in future.result()]
+    span = current_span()
+    if span is not None:
+        span.set(shards=len(shards), collection_size=sum(sizes.values()))
+    return sorted(hits, key=lambda hit: -hit.score)[:k]
+
+
+parser = argparse.ArgumentParser(description='Sync the issues of every repository shard, or show their sizes.')
+parser.add_argument('--shard', metavar='shard', action='append', default=[], help='A shard, as owner/repo[=database[#collection]]. Repeat for more repos.')
+parser.add_argument('--sync', action='store_true', help='Sync every shard with GitHub and re-embed changed issues.')
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    logging.basicConfig(filename='/tmp/ai_gh_issues.log', level=logging.INFO)
+    shards = load_shards(args.shard)
+    if args.sync:
+        from issue_sync import sync_issues
+
+        # Shards don't share databases, so their syncs run side by side.
+        synced = run_pipeline([Stage(shard.repo, lambda shard=shard: sync_issues(shard.repo, shard.database, shard.collection)) for shard in shards])
+        print(json.dumps(synced, indent=4))
+    else:
+        from similarity_index import get_index
+
+        print(json.dumps({shard.repo: {"database": shard.database, "collection": shard.collection,
+                                       "issues": len(get_index(shard.database, shard.collection))} for shard in shards}, indent=4))
@@ -0,0 +1,531 @@
+import os
+import sqlite3
+import logging
+import threading
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+INDEX_KIND = os.getenv("LABEL_MAKER_INDEX_KIND", "float32")
+COMPACT_KINDS = ("int8", "float16", "binary")
+
+
+class SimilarItem(NamedTuple):
+    """A single search hit, shaped like the `llm.Entry` results it replaces."""
+    id: str
+    score: float
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    """L2-normalizes the rows of a matrix in place, leaving zero rows untouched."""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return matrix
+
+
+class SimilarityIndex:
+    """
+    Exact cosine similarity search over an in-memory float32 matrix.
+
+    Vectors are normalized once when the index is built, so a query is a single
+    matrix-vector product followed by `argpartition` to select the top k.
+
+    The ids and matrix are published together as one tuple and never mutated,
+    so a search running while `add` replaces them sees either the old pair or
+    the new one.
+    """
+
+    def __init__(self, ids: Sequence[str], vectors: Any):
+        ids = np.asarray(list(ids), dtype=object)
+        matrix = np.array(vectors, dtype=np.float32, copy=True)
+        if matrix.ndim == 1:
+            matrix = matrix.reshape(len(ids), -1)
+        self._data: Tuple[np.ndarray, np.ndarray] = (ids, np.ascontiguousarray(_normalize(matrix)))
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self._data[0]
+
+    @property
+    def matrix(self) -> np.ndarray:
+        return self._data[1]
+
+    def __len__(self) -> int:
+        return len(self._data[0])
+
+    @classmethod
+    def from_collection(cls, database: str, collection: str) -> "SimilarityIndex":
+        """
+        Loads every embedding of an `llm` collection into a new index.
+
+        Args:
+            database (str): The path to the SQLite database file.
+            collection (str): The name of the collection in the database.
+
+        Returns:
+            SimilarityIndex: The loaded index.
+        """
+        with sqlite3.connect(database) as conn:
+            rows = conn.execute(
+                """
+                SELECT embeddings.id, embeddings.embedding
+                FROM embeddings JOIN collections ON collections.id = embeddings.collection_id
+                WHERE collections.name = ?
+                """,
+                (collection,),
+            ).fetchall()
+        if not rows:
+            return cls([], np.zeros((0, 0), dtype=np.float32))
+        ids = [row[0] for row in rows]
+        # llm.encode packs vectors as little-endian float32, so the blobs can be decoded in one pass.
+        matrix = np.frombuffer(b"".join(row[1] for row in rows), dtype="<f4").reshape(len(rows), -1)
+        return cls(ids, matrix)
+
+    def add(self, id: str, vector: Any) -> None:
+        """Adds or replaces a single vector in the index."""
+        row = _normalize(np.array(vector, dtype=np.float32).reshape(1, -1))
+        ids, matrix = self._data
+        existing = np.nonzero(ids == str(id))[0]
+        if existing.size:
+            matrix = matrix.copy()
+            matrix[existing[0]] = row[0]
+            self._data = (ids, matrix)
+        elif len(ids):
+            self._data = (np.append(ids, np.asarray([str(id)], dtype=object)), np.ascontiguousarray(np.vstack([matrix, row])))
+        else:
+            self._data = (np.asarray([str(id)], dtype=object), np.ascontiguousarray(row))
+
+    def search(self, vector: Any, k: int = 6) -> List[SimilarItem]:
+        """
+        Finds the k most similar vectors to a query vector.
+
+        Args:
+            vector (Any): The query embedding.
+            k (int, optional): The number of results to return. Defaults to 6.
+
+        Returns:
+            List[SimilarItem]: The results, most similar first.
+        """
+        return self.search_batch([vector], k)[0]
+
+    def search_batch(self, vectors: Any, k: int = 6) -> List[List[SimilarItem]]:
+        """
+        Finds the k most similar vectors for each of a batch of query vectors.
+
+        Args:
+            vectors (Any): A sequence of query embeddings, or a 2-d array.
+            k (int, optional): The number of results to return per query. Defaults to 6.
+
+        Returns:
+            List[List[SimilarItem]]: One result list per query, most similar first.
+        """
+        queries = _normalize(np.array(vectors, dtype=np.float32, ndmin=2))
+        ids, matrix = self._data
+        if not len(ids) or k <= 0:
+            return [[] for _ in range(len(queries))]
+        scores = queries @ matrix.T
+        k = min(k, len(ids))
+        if k < len(ids):
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            top = np.tile(np.arange(len(ids)), (len(queries), 1))
+        results = []
+        for row_scores, row_top in zip(scores, top):
+            ordered = row_top[np.argsort(-row_scores[row_top])]
+            results.append([SimilarItem(ids[i], float(row_scores[i])) for i in ordered])
+        return results
+
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint16)
+_SCAN_CHUNK = 16384
+
+
+def _collection_rows(conn: sqlite3.Connection, collection: str, updated_since: Optional[int] = None,
+                     chunk_size: int = 8192, updated_after: Optional[int] = None) -> Iterator[Tuple[List[str], np.ndarray, int]]:
+    """
+    Streams a collection's embeddings as (ids, float32 matrix, max updated) chunks.
+
+    `updated_since` keeps rows updated at or after a timestamp, and `updated_after` those strictly after it.
+    """
+    query = """
+        SELECT embeddings.id, embeddings.embedding, embeddings.updated
+        FROM embeddings JOIN collections ON collections.id = embeddings.collection_id
+        WHERE collections.name = ?
+    """
+    params: List[Any] = [collection]
+    if updated_since is not None:
+        query += " AND embeddings.updated >= ?"
+        params.append(updated_since)
+    if updated_after is not None:
+        query += " AND embeddings.updated > ?"
+        params.append(updated_after)
+    cursor = conn.execute(query, params)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        matrix = np.frombuffer(b"".join(row[1] for row in rows), dtype="<f4").reshape(len(rows), -1)
+        yield [row[0] for row in rows], matrix, max(row[2] or 0 for row in rows)
+
+
+class CompactIndex:
+    """
+    Approximate-then-exact cosine search over quantized vectors.
+
+    Only compact codes are held in memory: int8 (1 byte per dimension plus a
+    per-vector scale), float16 (2 bytes) or binary sign codes (1 bit). A search
+    scans the codes for `k * rerank_factor` candidates, then re-scores those
+    candidates exactly from the float32 blobs in the `embeddings` table, so the
+    scores returned are the same ones SimilarityIndex would give.
+
+    The codes are persisted in a side file next to the database and refreshed
+    incrementally from the rows updated since it was written. Like
+    SimilarityIndex, the ids, codes and scales are published together in one
+    assignment, so a search running during an add sees either set, never a mix.
+    """
+
+    def __init__(self, database: str, collection: str, kind: str = "int8", rerank_factor: Optional[int] = None):
+        if kind not in COMPACT_KINDS:
+            raise ValueError(f"Unknown index kind {kind!r}, expected one of {COMPACT_KINDS}")
+        self.database = database
+        self.collection = collection
+        self.kind = kind
+        # Sign codes rank far more coarsely than int8/float16, so they need a deeper candidate list.
+        self.rerank_factor = rerank_factor or (64 if kind == "binary" else 4)
+        self._data: Tuple[np.ndarray, Optional[np.ndarray], np.ndarray] = (np.zeros(0, dtype=object), None, np.zeros(0, dtype=np.float32))
+        self.updated = 0
+        self._positions: Dict[str, int] = {}
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self._data[0]
+
+    @property
+    def codes(self) -> Optional[np.ndarray]:
+        return self._data[1]
+
+    @property
+    def scales(self) -> np.ndarray:
+        return self._data[2]
+
+    def __len__(self) -> int:
+        return len(self._data[0])
+
+    @property
+    def path(self) -> str:
+        """The side file holding the codes, e.g. `issues.gh-issues.int8.npz` next to `issues.db`."""
+        return f"{os.path.splitext(self.database)[0]}.{self.collection}.{self.kind}.npz"
+
+    @property
+    def nbytes(self) -> int:
+        """The memory used by the codes, for comparison with the float32 matrix."""
+        return (self.codes.nbytes if self.codes is not None else 0) + self.scales.nbytes
+
+    def encode(self, matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Quantizes float32 rows into (codes, scales); scales are only meaningful for int8."""
+        matrix = _normalize(np.array(matrix, dtype=np.float32, ndmin=2))
+        if self.kind == "binary":
+            return np.packbits(matrix > 0, axis=1), np.ones(len(matrix), dtype=np.float32)
+        if self.kind == "float16":
+            return matrix.astype(np.float16), np.ones(len(matrix), dtype=np.float32)
+        scales = np.abs(matrix).max(axis=1) / 127
+        scales[scales == 0] = 1.0
+        return np.round(matrix / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+    @classmethod
+    def open(cls, database: str, collection: str, kind: str = "int8") -> "CompactIndex":
+        """
+        Loads the side file for a collection, bringing it up to date with the database.
+
+        Args:
+            database (str): The path to the SQLite database file.
+            collection (str): The name of the collection in the database.
+            kind (str, optional): "int8", "float16" or "binary". Defaults to "int8".
+
+        Returns:
+            CompactIndex: The loaded index.
+        """
+        index = cls(database, collection, kind)
+        if os.path.exists(index.path):
+            try:
+                with np.load(index.path, allow_pickle=False) as data:
+                    index._set(data["ids"].astype(object), data["codes"], data["scales"])
+                    index.updated = int(data["updated"])
+            except (OSError, KeyError, ValueError) as e:
+                logging.error(f"Rebuilding unreadable index {index.path}: {e}")
+                index = cls(database, collection, kind)
+        index.sync()
+        return index
+
+    def _set(self, ids: np.ndarray, codes: Optional[np.ndarray], scales: np.ndarray) -> None:
+        self._data = (ids, codes, scales)
+        self._positions = {id: i for i, id in enumerate(ids)}
+
+    def _merge(self, ids: List[str], codes: np.ndarray, scales: np.ndarray) -> None:
+        current_ids, current_codes, current_scales = self._data
+        if current_codes is None or not len(current_ids):
+            current_codes, current_scales = codes[:0], scales[:0]
+        replaced, new = [], []
+        for row, id in enumerate(ids):
+            position = self._positions.get(id)
+            (new if position is None else replaced).append((position, row))
+        if replaced:
+            # Copy rather than write in place: a search may still be reading the old arrays.
+            current_codes, current_scales = current_codes.copy(), current_scales.copy()
+            for position, row in replaced:
+                current_codes[position] = codes[row]
+                current_scales[position] = scales[row]
+        if new:
+            rows = [row for _, row in new]
+            start = len(current_ids)
+            current_ids = np.append(current_ids, np.asarray([ids[row] for row in rows], dtype=object))
+            current_codes = np.concatenate([current_codes, codes[rows]])
+            current_scales = np.concatenate([current_scales, scales[rows]])
+        if replaced or new:
+            self._data = (current_ids, current_codes, current_scales)
+        if new:
+            self._positions.update({ids[row]: start + i for i, row in enumerate(rows)})
+
+    def sync(self) -> int:
+        """
+        Encodes the rows updated since the side file was written, then saves it.
+
+        Falls back to a full rebuild if rows were deleted from the collection.
+
+        Returns:
+            int: The number of rows encoded.
+        """
+        with sqlite3.connect(self.database) as conn:
+            count, updated = _collection_fingerprint_conn(conn, self.collection)
+            if len(self.ids) == count and self.updated == (updated or 0):
+                return 0
+            since = self.updated if len(self.ids) else None
+            encoded = 0
+            for ids, matrix, chunk_updated in _collection_rows(conn, self.collection, since):
+                codes, scales = self.encode(matrix)
+                self._merge(ids, codes, scales)
+                self.updated = max(self.updated, chunk_updated)
+                encoded += len(ids)
+        if len(self.ids) != count:
+            logging.info(f"Rebuilding {self.path}: {len(self.ids)} codes for {count} rows")
+            self._set(np.zeros(0, dtype=object), None, np.zeros(0, dtype=np.float32))
+            self.updated = 0
+            return self.sync()
+        if encoded:
+            self.save()
+        return encoded
+
+    def save(self) -> None:
+        """Writes the codes to the side file atomically."""
+        ids, codes, scales = self._data
+        if codes is None:
+            return
+        tmp = f"{self.path}.tmp.npz"
+        np.savez(tmp, ids=ids.astype(str), codes=codes, scales=scales, updated=np.int64(self.updated))
+        os.replace(tmp, self.path)
+
+    def add(self, id: str, vector: Any) -> None:
+        """Adds or replaces a single vector in memory; the next sync persists it."""
+        codes, scales = self.encode(vector)
+        self._merge([str(id)], codes, scales)
+
+    def _coarse_scores(self, codes: np.ndarray, scales: np.ndarray, query: np.ndarray) -> np.ndarray:
+        if self.kind == "binary":
+            bits = np.packbits(query > 0)
+            hamming = np.concatenate([
+                _POPCOUNT[np.bitwise_xor(codes[start:start + _SCAN_CHUNK], bits)].sum(axis=1)
+                for start in range(0, len(codes), _SCAN_CHUNK)
+            ])
+            return -hamming.astype(np.float32)
+        scores = np.concatenate([
+            codes[start:start + _SCAN_CHUNK].astype(np.float32) @ query
+            for start in range(0, len(codes), _SCAN_CHUNK)
+        ])
+        return scores * scales if self.kind == "int8" else scores
+
+    def _exact(self, conn: sqlite3.Connection, ids: Sequence[str]) -> Tuple[List[str], np.ndarray]:
+        found_ids: List[str] = []
+        blobs = []
+        for start in range(0, len(ids), 500):
+            chunk = list(ids[start:start + 500])
+            rows = conn.execute(
+                f"""
+                SELECT embeddings.id, embeddings.embedding
+                FROM embeddings JOIN collections ON collections.id = embeddings.collection_id
+                WHERE collections.name = ? AND embeddings.id IN ({','.join('?' * len(chunk))})
+                """,
+                [self.collection, *chunk],
+            ).fetchall()
+            found_ids.extend(row[0] for row in rows)
+            blobs.extend(row[1] for row in rows)
+        if not blobs:
+            return [], np.zeros((0, 0), dtype=np.float32)
+        matrix = np.frombuffer(b"".join(blobs), dtype="<f4").reshape(len(blobs), -1)
+        return found_ids, _normalize(matrix.copy())
+
+    def search(self, vector: Any, k: int = 6) -> List[SimilarItem]:
+        """
+        Finds the k most similar vectors to a query vector.
+
+        Args:
+            vector (Any): The query embedding.
+            k (int, optional): The number of results to return. Defaults to 6.
+
+        Returns:
+            List[SimilarItem]: The results with exact cosine scores, most similar first.
+        """
+        return self.search_batch([vector], k)[0]
+
+    def search_batch(self, vectors: Any, k: int = 6) -> List[List[SimilarItem]]:
+        """
+        Finds the k most similar vectors for each of a batch of query vectors.
+
+        Args:
+            vectors (Any): A sequence of query embeddings, or a 2-d array.
+            k (int, optional): The number of results to return per query. Defaults to 6.
+
+        Returns:
+            List[List[SimilarItem]]: One result list per query, most similar first.
+        """
+        queries = _normalize(np.array(vectors, dtype=np.float32, ndmin=2))
+        all_ids, codes, scales = self._data
+        if not len(all_ids) or k <= 0:
+            return [[] for _ in range(len(queries))]
+        n_candidates = min(len(all_ids), max(k * self.rerank_factor, 32))
+        results = []
+        with sqlite3.connect(self.database) as conn:
+            for query in queries:
+                coarse = self._coarse_scores(codes, scales, query)
+                if n_candidates < len(all_ids):
+                    candidates = np.argpartition(-coarse, n_candidates - 1)[:n_candidates]
+                else:
+                    candidates = np.arange(len(all_ids))
+                ids, matrix = self._exact(conn, all_ids[candidates].tolist())
+                if not ids:
+                    results.append([])
+                    continue
+                scores = matrix @ query
+                top = np.argsort(-scores)[:k]
+                results.append([SimilarItem(ids[i], float(scores[i])) for i in top])
+        return results
+
+
+_indexes: Dict[Tuple[str, str, str], Tuple[Any, Union[SimilarityIndex, CompactIndex]]] = {}
+_indexes_lock = threading.Lock()
+# Loading or syncing one collection's index holds only that collection's lock, so
+# a slow load of one repository's collection never delays searches in the others.
+_collection_locks: Dict[Tuple[str, str], threading.Lock] = {}
+
+
+def _collection_lock(database: str, collection: str) -> threading.Lock:
+    with _indexes_lock:
+        return _collection_locks.setdefault((database, collection), threading.Lock())
+
+
+def _collection_fingerprint_conn(conn: sqlite3.Connection, collection: str) -> Tuple[int, Optional[int]]:
+    return conn.execute(
+        """
+        SELECT count(*), max(embeddings.updated)
+        FROM embeddings JOIN collections ON collections.id = embeddings.collection_id
+        WHERE collections.name = ?
+        """,
+        (collection,),
+    ).fetchone()
+
+
+def database_state(database: str) -> Tuple[Tuple[int, int], ...]:
+    """
+    Returns the modification time and size of a database file and its WAL file.
+
+    Every committed write changes one of them, so while the state is unchanged
+    callers can skip querying the database to find out whether it changed.
+    """
+    state = []
+    for path in (database, database + "-wal"):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        state.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(state)
+
+
+_fingerprints: Dict[Tuple[str, str], Tuple[Tuple[Tuple[int, int], ...], Optional[Tuple[int, int]]]] = {}
+
+
+def _collection_fingerprint(database: str, collection: str) -> Optional[Tuple[int, int]]:
+    """Returns a cheap (row count, last update) fingerprint of a collection."""
+    # The state is read before the query, so a write racing the query only causes an extra query next time.
+    state = database_state(database)
+    cached = _fingerprints.get((database, collection))
+    if cached and cached[0] == state:
+        return cached[1]
+    with sqlite3.connect(database) as conn:
+        fingerprint = _collection_fingerprint_conn(conn, collection)
+    _fingerprints[(database, collection)] = (state, fingerprint)
+    return fingerprint
+
+
+def get_index(database: str, collection: str, kind: Optional[str] = None) -> Union[SimilarityIndex, CompactIndex]:
+    """
+    Returns a cached index for a collection, reloading it when the collection has changed.
+
+    Args:
+        database (str): The path to the SQLite database file.
+        collection (str): The name of the collection in the database.
+        kind (Optional[str], optional): "float32" for the exact in-memory index, "int8", "float16"
+            or "binary" for a CompactIndex, or "ivf" or "hnsw" for an approximate index from
+            ann_index. Defaults to $LABEL_MAKER_INDEX_KIND or "float32".
+
+    Returns:
+        Union[SimilarityIndex, CompactIndex]: The index for the collection. If an approximate
+        index cannot be opened (e.g. hnswlib is not installed), the exact index is returned.
+    """
+    kind = kind or INDEX_KIND
+    key = (database, collection, kind)
+    fingerprint = _collection_fingerprint(database, collection)
+    with _collection_lock(database, collection):
+        cached = _indexes.get(key)
+        if cached and cached[0] == fingerprint:
+            return cached[1]
+        if cached and not isinstance(cached[1], SimilarityIndex):
+            index = cached[1]
+            index.sync()
+        elif kind in COMPACT_KINDS:
+            index = CompactIndex.open(database, collection, kind)
+        elif kind != "float32":
+            try:
+                from ann_index import ANN_INDEXES
+
+                index = ANN_INDEXES[kind].open(database, collection)
+            except Exception as e:
+                logging.error(f"Falling back to exact search, {kind} index unavailable: {e}")
+                index = SimilarityIndex.from_collection(database, collection)
+        else:
+            index = SimilarityIndex.from_collection(database, collection)
+        _indexes[key] = (fingerprint, index)
+        return index
+
+
+def add_to_indexes(database: str, collection: str, id: str, vector: Any) -> None:
+    """
+    Adds a newly stored embedding to every loaded index of its collection.
+
+    The exact index is updated in place and stays current. Compact and ANN
+    indexes are updated in memory; they persist the row on their next sync,
+    which only reads rows newer than their side file.
+
+    Args:
+        database (str): The path to the SQLite database file.
+        collection (str): The name of the collection in the database.
+        id (str): The embedding id.
+        vector (Any): The embedding.
+    """
+    with _collection_lock(database, collection):
+        for key, (fingerprint, index) in list(_indexes.items()):
+            if key[:2] != (database, collection):
+                continue
+            index.add(id, vector)
+            if isinstance(index, SimilarityIndex):
+                _indexes[key] = (_collection_fingerprint(database, collection), index)
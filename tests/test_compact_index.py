@@ -0,0 +1,63 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+from similarity_index import CompactIndex, SimilarityIndex
+
+DIMENSIONS = 64
+
+
+@pytest.fixture
+def vectors():
+    return np.random.default_rng(0).standard_normal((300, DIMENSIONS)).astype(np.float32)
+
+
+@pytest.fixture
+def database(tmp_path, vectors):
+    path = str(tmp_path / "issues.db")
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE collections (id INTEGER PRIMARY KEY, name TEXT)")
+        conn.execute("CREATE TABLE embeddings (collection_id INTEGER, id TEXT, embedding BLOB, updated INTEGER)")
+        conn.execute("INSERT INTO collections (id, name) VALUES (1, 'gh-issues')")
+        conn.executemany(
+            "INSERT INTO embeddings (collection_id, id, embedding, updated) VALUES (1, ?, ?, ?)",
+            [(str(i), vector.astype("<f4").tobytes(), 1000 + i) for i, vector in enumerate(vectors)],
+        )
+    return path
+
+
+def test_int8_codes_round_trip_within_half_a_step(vectors):
+    index = CompactIndex("unused.db", "gh-issues", "int8")
+    codes, scales = index.encode(vectors)
+    assert codes.dtype == np.int8 and np.abs(codes).max() == 127
+    unit = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    assert np.all(np.abs(codes * scales[:, None] - unit) <= scales[:, None] / 2 + 1e-6)
+
+
+def test_binary_codes_pack_signs(vectors):
+    codes, _ = CompactIndex("unused.db", "gh-issues", "binary").encode(vectors)
+    assert codes.shape == (len(vectors), DIMENSIONS // 8)
+    assert np.array_equal(np.unpackbits(codes, axis=1).astype(bool), vectors > 0)
+
+
+@pytest.mark.parametrize("kind", ["int8", "float16", "binary"])
+def test_rerank_returns_exact_scores(database, vectors, kind):
+    index = CompactIndex.open(database, "gh-issues", kind)
+    exact = SimilarityIndex([str(i) for i in range(len(vectors))], vectors)
+    queries = vectors[:5] + 0.3 * np.random.default_rng(1).standard_normal((5, DIMENSIONS)).astype(np.float32)
+    for found, expected in zip(index.search_batch(queries, k=5), exact.search_batch(queries, k=5)):
+        assert [item.id for item in found] == [item.id for item in expected]
+        assert np.allclose([item.score for item in found], [item.score for item in expected], atol=1e-5)
+
+
+def test_add_publishes_new_arrays_without_touching_old_ones(database, vectors):
+    index = CompactIndex.open(database, "gh-issues", "int8")
+    ids, codes, scales = index._data
+    before = codes.copy()
+    index.add("3", -vectors[3])
+    index.add("new", vectors[0])
+    assert np.array_equal(codes, before) and len(ids) == len(codes) == len(scales) == len(vectors)
+    assert len(index.ids) == len(index.codes) == len(index.scales) == len(vectors) + 1
+    assert np.array_equal(index.codes[3], index.encode(-vectors[3])[0][0])
+    assert index.ids[-1] == "new"
@@ -0,0 +1,79 @@
+import sqlite3
+
+import pytest
+
+from duplicate_prefilter import SIMHASH_MAX_DISTANCE, _issue_text, find_duplicate, normalize_url, refresh, simhash
+from github_issues import gh_issue_body
+from issue_format import format_issue_content
+
+TITLE = "Speculative decoding with draft models"
+URL = "https://example.com/posts/speculative-decoding"
+SNIPPET = """Speculative decoding runs a small draft model ahead of the large one.
+• The large model verifies several draft tokens in one forward pass.
+• Accepted tokens are kept, and the first rejected one is resampled.
+def accept(draft, target):
+    return [t for t in draft if t in target]
+Latency drops when the draft model agrees with the <target> model most of the time."""
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / "issues.db")
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE github_issues (number INTEGER PRIMARY KEY, title TEXT, body TEXT, body_url TEXT, updated_at TEXT)")
+    return path
+
+
+def save_issue(database, number, title, url, snippet, updated_at="2026-01-01T00:00:00Z"):
+    body = gh_issue_body(title, url, format_issue_content(title, url, snippet))
+    with sqlite3.connect(database) as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO github_issues (number, title, body, body_url, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (number, title, body, None, updated_at),
+        )
+        refresh(conn)
+
+
+@pytest.mark.parametrize("url, expected", [
+    ("https://www.example.com/post/?utm_source=x&id=1#top", "example.com/post?id=1"),
+    ("http://example.com:80/post", "example.com/post"),
+    ("https://example.com:8080/post?b=2&a=1&fbclid=abc", "example.com:8080/post?a=1&b=2"),
+])
+def test_normalize_url(url, expected):
+    assert normalize_url(url) == expected
+
+
+def test_simhash_needs_enough_tokens():
+    assert simhash("too short") is None
+    assert simhash(f"{TITLE} {SNIPPET}") == simhash(f"{TITLE.upper()}  {SNIPPET}")
+
+
+def test_formatted_issue_hashes_like_its_bookmark():
+    body = gh_issue_body(TITLE, URL, format_issue_content(TITLE, URL, SNIPPET), "new labels")
+    distance = bin(simhash(_issue_text(TITLE, body)) ^ simhash(f"{TITLE} {SNIPPET}")).count("1")
+    assert distance <= SIMHASH_MAX_DISTANCE
+
+
+def test_resaved_page_matches_by_simhash(database):
+    save_issue(database, 7, TITLE, URL, SNIPPET)
+    match = find_duplicate(database, "https://mirror.example.org/speculative", TITLE, SNIPPET)
+    assert match is not None and match.number == 7 and match.reason == "simhash"
+
+
+def test_resaved_page_matches_by_url(database):
+    save_issue(database, 7, TITLE, URL, SNIPPET)
+    match = find_duplicate(database, URL.replace("https://", "http://www.") + "?utm_source=feed", "", "")
+    assert match is not None and match.number == 7 and match.reason == "url"
+
+
+def test_unrelated_page_does_not_match(database):
+    save_issue(database, 7, TITLE, URL, SNIPPET)
+    other = "A field guide to sourdough starters, feeding schedules and the flour that keeps them lively through winter."
+    assert find_duplicate(database, "https://example.com/sourdough", "Sourdough starters", other) is None
+
+
+def test_find_duplicate_does_not_write(database):
+    assert find_duplicate(database, URL, TITLE, SNIPPET) is None
+    with sqlite3.connect(database) as conn:
+        tables = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert tables == {"github_issues"}
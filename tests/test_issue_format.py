@@ -0,0 +1,54 @@
+import pytest
+
+from issue_format import format_issue_content, format_snippet, title_from_url
+
+
+def test_shell_commands_are_fenced():
+    snippet = "Install it:\n$ pip install foo\n$ foo --help\nThen run it."
+    assert format_snippet(snippet) == "Install it:\n```bash\n$ pip install foo\n$ foo --help\n```\nThen run it."
+
+
+def test_python_is_fenced_and_dedented():
+    snippet = "The helper:\n    def add(a, b):\n        return a + b\nThat is all."
+    assert format_snippet(snippet) == "The helper:\n```python\ndef add(a, b):\n    return a + b\n```\nThat is all."
+
+
+def test_existing_fences_are_kept_and_closed():
+    assert format_snippet("```\nx = 1\n") == "```\nx = 1\n```"
+
+
+def test_lists_become_markdown():
+    assert format_snippet("• one\n  ◦ nested\n1) first\n2. second") == "- one\n  - nested\n1. first\n2. second"
+
+
+def test_markup_in_prose_is_escaped():
+    assert format_snippet("# not a heading\nA title\n===\n<div> is a tag") == (
+        "\\# not a heading\nA title\n\\===\n&lt;div> is a tag"
+    )
+
+
+def test_wording_is_kept_exactly():
+    snippet = "Plain prose, with commas; and a colon: nothing else.\n\n\n\nA second paragraph."
+    assert format_snippet(snippet) == "Plain prose, with commas; and a colon: nothing else.\n\nA second paragraph."
+
+
+@pytest.mark.parametrize("url, expected", [
+    ("https://www.example.com/blog/what-is-embedded_ml.html", "What is embedded ml - example.com"),
+    ("https://example.com/posts/speculative-decoding/", "Speculative decoding - example.com"),
+    ("https://example.com/notes/caching-layers/1f3a9c2b7d", "Caching layers - example.com"),
+    ("https://github.com/owner/repo", "owner/repo"),
+    ("https://github.com/owner/repo/blob/main/setup.py", "owner/repo: setup.py"),
+    ("https://example.com/", "example.com"),
+])
+def test_title_from_url(url, expected):
+    assert title_from_url(url) == expected
+
+
+def test_issue_content_layout():
+    assert format_issue_content("A [draft] title", "https://example.com/a", "Some text.") == (
+        "# A [draft] title\n\n**Description:**\nSome text.\n\n**URL:** [A \\[draft\\] title](https://example.com/a)"
+    )
+
+
+def test_issue_content_without_snippet_has_no_description():
+    assert format_issue_content("Title", "https://example.com/a", "  ") == "# Title\n\n**URL:** [Title](https://example.com/a)"
@@ -0,0 +1,25 @@
+from label_prompt import render_labels
+
+
+def catalog(count):
+    return [{"name": f"label-{i}", "description": f"Issues about topic number {i} and nothing else"} for i in range(count)]
+
+
+def test_fits_in_budget_unchanged():
+    assert render_labels(catalog(3), budget=0).splitlines() == [
+        "label-0: Issues about topic number 0 and nothing else",
+        "label-1: Issues about topic number 1 and nothing else",
+        "label-2: Issues about topic number 2 and nothing else",
+    ]
+
+
+def test_unranked_labels_are_all_kept():
+    lines = render_labels(catalog(60), budget=100).splitlines()
+    assert [line.split(":")[0] for line in lines] == [f"label-{i}" for i in range(60)]
+
+
+def test_ranked_labels_drop_the_lowest_scores():
+    labels = [{**label, "score": i / 100} for i, label in enumerate(catalog(60))]
+    names = [line.split(":")[0] for line in render_labels(labels, budget=100).splitlines()]
+    assert names and len(names) < 60
+    assert names == [f"label-{i}" for i in range(59, 59 - len(names), -1)]
@@ -0,0 +1,96 @@
+import pytest
+
+import rate_limit
+from rate_limit import BULK, INTERACTIVE, TokenBucket
+
+
+class FakeClock:
+    """A monotonic clock that only moves when a bucket waits on it."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class FakeCondition:
+    def __init__(self, clock: FakeClock):
+        self.clock = clock
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def wait(self, timeout: float) -> None:
+        # Real waits always take some time; a tiny float timeout alone wouldn't move a clock near 1000 s.
+        self.clock.now += max(timeout, 1e-6)
+
+    def notify_all(self) -> None:
+        pass
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit.time, "monotonic", clock)
+    return clock
+
+
+def fixed_window_bucket(clock: FakeClock) -> TokenBucket:
+    bucket = TokenBucket("github:core", 3600, fixed_window=True)
+    bucket._cond = FakeCondition(clock)
+    return bucket
+
+
+def test_fixed_window_spreads_budget_until_reset(clock):
+    bucket = fixed_window_bucket(clock)
+    window_end = clock.now + 3600
+    bucket.observe(5000, 5000, window_end - clock.now)
+    for sent in range(1, 4991):
+        bucket.acquire(priority=INTERACTIVE)
+        assert clock.now < window_end
+        bucket.observe(5000, 5000 - sent, window_end - clock.now)
+    # The first tenth goes out at once, the rest is spaced out over the window instead of running dry early.
+    assert bucket.delayed > 4000
+    assert bucket.waited > 3000
+
+
+def test_spent_burst_is_not_refilled_by_responses(clock):
+    bucket = fixed_window_bucket(clock)
+    bucket.observe(5000, 5000, 3600)
+    for sent in range(1, 501):
+        bucket.acquire(priority=INTERACTIVE)
+        bucket.observe(5000, 5000 - sent, 3600)
+    assert bucket.delayed == 0
+    bucket.acquire(priority=INTERACTIVE)
+    assert bucket.delayed == 1
+
+
+def test_bulk_requests_leave_a_reserve_for_interactive_ones(clock):
+    bucket = fixed_window_bucket(clock)
+    bucket.observe(5000, 5000, 3600)
+    sent = 0
+    while bucket.delayed == 0:
+        bucket.acquire(priority=BULK)
+        sent += 1
+        bucket.observe(5000, 5000 - sent, 3600)
+    # Bulk work stopped with a fifth of the burst unspent.
+    assert sent == 400 + 1
+    waited = bucket.delayed
+    bucket.acquire(priority=INTERACTIVE)
+    assert bucket.delayed == waited
+
+
+def test_exhausted_budget_blocks_until_reset(clock):
+    bucket = fixed_window_bucket(clock)
+    bucket.observe(5000, 0, 120)
+    assert bucket.acquire(priority=INTERACTIVE) >= 120
+
+
+def test_unknown_limit_never_delays(clock):
+    bucket = fixed_window_bucket(clock)
+    for _ in range(100):
+        assert bucket.acquire(priority=BULK) == 0
@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import uuid
+import argparse
+import functools
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+TRACE_FILE = os.getenv("LABEL_MAKER_TRACE_FILE", "/tmp/ai_gh_issues_spans.jsonl")
+TRACING_DISABLED = os.getenv("LABEL_MAKER_NO_TRACING", "") not in ("", "0")
+
+
+class Span:
+    """A timed stage of the pipeline, written as one JSON line when it ends."""
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attrs: Dict[str, Any]):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.start = time.time()
+        self.duration: Optional[float] = None
+        self.retries = 0
+        self.attrs = dict(attrs)
+        self._lock = threading.Lock()
+
+    def set(self, **attrs) -> None:
+        with self._lock:
+            self.attrs.update(attrs)
+
+    def add(self, name: str, value: float = 1) -> None:
+        """Adds to a numeric attribute, such as a token or request count."""
+        with self._lock:
+            self.attrs[name] = self.attrs.get(name, 0) + value
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name, "trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id,
+            "start": self.start, "duration": self.duration, "retries": self.retries, **self.attrs,
+        }
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+_write_lock = threading.Lock()
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def _write(span: Span) -> None:
+    try:
+        with _write_lock, open(TRACE_FILE, "a") as f:
+            f.write(json.dumps(span.to_dict(), default=str) + "\n")
+    except OSError:
+        pass  # tracing must never break the pipeline
+
+
+@contextmanager
+def span(name: str, **attrs) -> Iterator[Span]:
+    """
+    Times a block of code as a span nested under the current one.
+
+    Args:
+        name (str): The stage name, e.g. "pick_labels".
+        **attrs: Extra attributes to record on the span.
+
+    Yields:
+        Span: The span, so the block can attach attributes to it.
+    """
+    parent = _current_span.get()
+    current = Span(name, parent.trace_id if parent else uuid.uuid4().hex, parent.span_id if parent else None, attrs)
+    token = _current_span.set(current)
+    started = time.perf_counter()
+    try:
+        yield current
+    except Exception as e:
+        current.set(error=f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        current.duration = time.perf_counter() - started
+        _current_span.reset(token)
+        if not TRACING_DISABLED:
+            _write(current)
+
+
+def traced(name: Optional[str] = None) -> Callable:
+    """Decorates a function so every call is recorded as a span."""
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name or func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_retry(retry_state: Any) -> None:
+    """A tenacity `before_sleep` callback that counts retries on the current span."""
+    current = _current_span.get()
+    if current is not None:
+        with current._lock:
+            current.retries += 1
+
+
+def record_usage(response: Any) -> None:
+    """Adds the token usage of an OpenAI response to the current span."""
+    current = _current_span.get()
+    usage = getattr(response, "usage", None)
+    if current is None or usage is None:
+        return
+    current.add("prompt_tokens", usage.prompt_tokens or 0)
+    current.add("completion_tokens", usage.completion_tokens or 0)
+
+
+def record_llm_usage(response: Any) -> None:
+    """Adds the token usage of an `llm` response to the current span, if the model reports it."""
+    current = _current_span.get()
+    try:
+        usage = response.usage()
+    except Exception:
+        return
+    if current is None or usage is None:
+        return
+    current.add("prompt_tokens", usage.input or 0)
+    current.add("completion_tokens", usage.output or 0)
+
+
+def record_http(response: Any) -> None:
+    """Records the status of an HTTP response on the current span."""
+    current = _current_span.get()
+    if current is not None:
+        current.add("http_requests")
+        current.set(http_status=response.status_code)
+
+
+def read_spans(path: str = TRACE_FILE, since: Optional[float] = None) -> List[Dict[str, Any]]:
+    spans = []
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if since is None or record.get("start", 0) >= since:
+                spans.append(record)
+    return spans
+
+
+def _percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))] if values else 0.0
+
+
+def summarize(spans: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Aggregates spans per stage.
+
+    Args:
+        spans (List[Dict[str, Any]]): Spans as read by read_spans.
+
+    Returns:
+        List[Dict[str, Any]]: One row per stage with count, p50, p95, errors, retries, tokens and HTTP requests.
+    """
+    stages = defaultdict(list)
+    for record in spans:
+        stages[record["name"]].append(record)
+    rows = []
+    for name, records in stages.items():
+        durations = [record["duration"] or 0 for record in records]
+        rows.append({
+            "stage": name,
+            "count": len(records),
+            "p50_ms": _percentile(durations, 0.5) * 1000,
+            "p95_ms": _percentile(durations, 0.95) * 1000,
+            "errors": sum(1 for record in records if record.get("error")),
+            "retries": sum(record.get("retries", 0) for record in records),
+            "tokens": sum(record.get("prompt_tokens", 0) + record.get("completion_tokens", 0) for record in records),
+            "http_requests": sum(record.get("http_requests", 0) for record in records),
+        })
+    return sorted(rows, key=lambda row: -row["p50_ms"])
+
+
+def print_summary(rows: List[Dict[str, Any]]) -> None:
+    print(f"{'stage':<28} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'errors':>7} {'retries':>8} {'tokens':>8} {'http':>6}")
+    for row in rows:
+        print(
+            f"{row['stage']:<28} {row['count']:>6} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} "
+            f"{row['errors']:>7} {row['retries']:>8} {row['tokens']:>8} {row['http_requests']:>6}"
+        )
+
+
+parser = argparse.ArgumentParser(description='Summarize pipeline spans per stage.')
+parser.add_argument('--file', metavar='file', type=str, help='The span log to read.', default=TRACE_FILE)
+parser.add_argument('--hours', metavar='hours', type=float, help='Only include spans from the last N hours.')
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    since = time.time() - args.hours * 3600 if args.hours else None
+    print_summary(summarize(read_spans(args.file, since)))